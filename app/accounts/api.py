@@ -1,6 +1,7 @@
 import datetime
 from app.core import bcrypt
 from .models import Account, Role
+from .cache import get_account_snapshot, invalidate_account
 from .emailtoken import generate_confirmation_token, confirm_token
 
 
@@ -41,6 +42,7 @@ def confirm_email_token(token):
         user.confirmed = True
         user.confirmed_on = datetime.datetime.now()
         user.save()
+        invalidate_account(user.id)
         return True, user.email
 
 
@@ -58,6 +60,7 @@ def update_account_role(account_id, role_id):
     acc = Account.get(id=account_id)
     acc.role_id = role_id
     acc.save()
+    invalidate_account(account_id)
     return acc
 
 
@@ -132,7 +135,8 @@ def validate_token(token):
 
     :param token: auth token to validate
     :type token: string
-    :returns: created token
-    :rtype: Account
+    :returns: Snapshot of associated account (cached for a short time), or
+    None if account does not exist
+    :rtype: AccountSnapshot
     """
-    return Account.validate_token(token)
+    return get_account_snapshot(Account.decode_token(token))
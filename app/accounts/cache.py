@@ -0,0 +1,117 @@
+from dateutil import parser as date_parser
+from app.core import app, redis_client
+from app.cache import TwoTierCache
+from .models import Account
+
+ACCOUNT_FIELDS = ['id', 'username', 'email', 'role_id', 'confirmed']
+ACCOUNT_TIMESTAMP_FIELDS = ['confirmed_at', 'created_at', 'modified_at']
+
+
+class RoleSnapshot:
+    """
+    Detached, read-only copy of role data needed by authorization checks
+    """
+
+    def __init__(self, role):
+        self.id = role.id
+        self.display_name = role.display_name
+        self.permissions = list(role.permissions or [])
+
+    def to_data(self):
+        return {'id': self.id,
+                'display_name': self.display_name,
+                'permissions': self.permissions}
+
+    @staticmethod
+    def from_data(data):
+        snapshot = RoleSnapshot.__new__(RoleSnapshot)
+        snapshot.id = data['id']
+        snapshot.display_name = data['display_name']
+        snapshot.permissions = data['permissions']
+        return snapshot
+
+
+class AccountSnapshot:
+    """
+    Detached, read-only copy of account data needed by authenticated
+    requests. It can be shared between requests, so it does not require
+    database access after it is created
+    """
+
+    def __init__(self, account):
+        self.id = account.id
+        self.username = account.username
+        self.email = account.email
+        self.role_id = account.role_id
+        self.role = RoleSnapshot(account.role) if account.role else None
+        self.confirmed = account.confirmed
+        self.confirmed_at = account.confirmed_at
+        self.created_at = account.created_at
+        self.modified_at = account.modified_at
+
+    def to_data(self):
+        """
+        Returns JSON compatible copy of snapshot, as stored in account_cache
+        """
+        data = {field: getattr(self, field) for field in ACCOUNT_FIELDS}
+        for field in ACCOUNT_TIMESTAMP_FIELDS:
+            value = getattr(self, field)
+            data[field] = value.isoformat() if value is not None else None
+        data['role'] = self.role.to_data() if self.role else None
+        return data
+
+    @staticmethod
+    def from_data(data):
+        """
+        Creates snapshot from data returned by to_data
+        """
+        snapshot = AccountSnapshot.__new__(AccountSnapshot)
+        for field in ACCOUNT_FIELDS:
+            setattr(snapshot, field, data[field])
+        for field in ACCOUNT_TIMESTAMP_FIELDS:
+            value = data[field]
+            setattr(snapshot, field,
+                    date_parser.parse(value) if value is not None else None)
+        snapshot.role = (RoleSnapshot.from_data(data['role'])
+                         if data['role'] else None)
+        return snapshot
+
+    def __repr__(self):
+        return '<AccountSnapshot (name=%s, role=%s)>' % (self.username,
+                                                         self.role_id)
+
+
+# Maps account id to AccountSnapshot (or None if account does not exist)
+account_cache = TwoTierCache(redis_client, 'accounts',
+                             app.config['ACCOUNT_CACHE_SIZE'],
+                             app.config['ACCOUNT_CACHE_TTL'],
+                             app.config['ACCOUNT_CACHE_TTL'],
+                             lambda snapshot: snapshot.to_data(),
+                             AccountSnapshot.from_data)
+
+
+def load_account_snapshot(account_id):
+    account = Account.get_with_role(account_id)
+    if account is None:
+        return None
+    return AccountSnapshot(account)
+
+
+def get_account_snapshot(account_id):
+    """
+    Gets snapshot of account with given id, loading it from database only if
+    it is not cached
+
+    :returns: AccountSnapshot or None if account does not exist
+    :rtype: AccountSnapshot
+    """
+    return account_cache.get_or_load(
+            account_id, lambda: load_account_snapshot(account_id))
+
+
+def invalidate_account(account_id):
+    """
+    Removes cached snapshot of account with given id, in all processes.
+    Should be called whenever account or its role assignment changes
+    """
+    account_cache.invalidate(account_id)
@@ -1,6 +1,8 @@
 import jwt
 import datetime
-from app.core import db, app
+from app.core import db, app, model_cache
+from app.cache import get_cached_instance
+from sqlalchemy.orm import joinedload
 from calendar import timegm
 
 
@@ -103,11 +105,20 @@ class Account(db.Model):
         ).decode('utf-8')
 
     @staticmethod
-    def validate_token(token):
+    def get_with_role(account_id):
         """
-        Validates given Auth token
-        :rtype: Account
-        :return: Account associated with token
+        Get account with given id, loading its role in the same query
+        """
+        return Account.query.options(
+                joinedload(Account.role)
+                ).filter_by(id=account_id).first()
+
+    @staticmethod
+    def decode_token(token):
+        """
+        Validates given Auth token without loading the account
+        :rtype: int
+        :return: Id of account associated with token
         """
         payload = jwt.decode(
             token,
@@ -117,7 +128,16 @@ class Account(db.Model):
         current_time = timegm(datetime.datetime.utcnow().utctimetuple())
         if current_time > payload['exp']:
             raise ValueError("Expired token")
-        return Account.get(id=payload['sub'])
+        return payload['sub']
+
+    @staticmethod
+    def validate_token(token):
+        """
+        Validates given Auth token
+        :rtype: Account
+        :return: Account associated with token
+        """
+        return Account.get(id=Account.decode_token(token))
 
     def __repr__(self):
         return '<Account (name=%s, role=%s)>' % (self.username, self.role)
@@ -148,13 +168,15 @@ class Role(db.Model):
         """
         db.session.add(self)
         db.session.commit()
+        model_cache.invalidate('roles')
 
     @staticmethod
     def get_all():
         """
-        Get all stored roles
+        Get all stored roles (cached)
         """
-        return Role.query.all()
+        return get_cached_instance(model_cache, Role, 'roles',
+                                   lambda: Role.query.all(), db.session)
 
     @staticmethod
     def get(roleId):
@@ -1,7 +1,9 @@
 from flask_restful import Api
 from marshmallow import ValidationError
 from app.errors import NotPresentError, BadRequestError
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request
+from flask import current_app as app
+from flask_sqlalchemy import get_debug_queries
 
 
 api_bp = Blueprint('api', __name__)
@@ -20,17 +22,22 @@ def add_resources():
     from .resources.device import (DeviceResource,
                                    DeviceRecordingResource,
                                    DeviceLatestRecordingResource,
+                                   DeviceLatestRecordingListResource,
                                    DeviceRecordingQueryResource,
+                                   RecordingQueryBatchResource,
                                    DeviceListResource,
                                    DeviceTypeResource,
                                    DeviceTypeListResource,
                                    DeviceConfigurationResource,
+                                   FleetConfigurationResource,
+                                   FleetConfigurationProgressResource,
                                    DeviceDocumentationResource,
                                    DeviceSecretResource,
                                    DeviceSecretResetResource,
                                    DeviceShareResource,
                                    DeviceShareActivationResource)
     from .resources.dashboard import (DashboardResource,
+                                      DashboardDataResource,
                                       DashboardListResource,
                                       DashboardWidgetResource,
                                       DashboardWidgetListResource)
@@ -52,14 +59,21 @@ def add_resources():
                      '/v1/devices/<int:device_id>/recordings')
     api.add_resource(DeviceLatestRecordingResource,
                      '/v1/devices/<int:device_id>/recordings/latest')
+    api.add_resource(DeviceLatestRecordingListResource,
+                     '/v1/devices/<int:device_id>/recordings/latest/all')
     api.add_resource(DeviceRecordingQueryResource,
                      '/v1/devices/<int:device_id>/recordings/jsonql')
+    api.add_resource(RecordingQueryBatchResource, '/v1/recordings/jsonql')
     api.add_resource(DeviceListResource, '/v1/devices')
     api.add_resource(DeviceTypeResource,
                      '/v1/devices/types/<int:device_type_id>')
     api.add_resource(DeviceTypeListResource, '/v1/devices/types')
     api.add_resource(DeviceConfigurationResource,
                      '/v1/devices/<int:device_id>/configuration')
+    api.add_resource(FleetConfigurationResource,
+                     '/v1/devices/configuration')
+    api.add_resource(FleetConfigurationProgressResource,
+                     '/v1/devices/configuration/<string:push_id>')
     api.add_resource(DeviceDocumentationResource,
                      '/v1/devices/<int:device_id>/documentation')
     api.add_resource(DeviceSecretResource,
@@ -73,6 +87,8 @@ def add_resources():
             '/v1/devices/<int:device_id>/share/activate/<string:token>')
     api.add_resource(DashboardResource,
                      '/v1/dashboards/<int:dashboard_id>')
+    api.add_resource(DashboardDataResource,
+                     '/v1/dashboards/<int:dashboard_id>/data')
     api.add_resource(DashboardListResource, '/v1/dashboards')
     api.add_resource(
             DashboardWidgetResource,
@@ -86,6 +102,16 @@ def add_resources():
 add_resources()
 
 
+@api_bp.after_request
+def log_query_count(response):
+    if app.config['QUERY_COUNT_LOGGING']:
+        queries = get_debug_queries()
+        print('%s %s issued %d SQL statements (%.2f ms)' % (
+            request.method, request.path, len(queries),
+            sum(query.duration for query in queries) * 1000))
+    return response
+
+
 @api_bp.errorhandler(ValidationError)
 @api_bp.errorhandler(422)
 def handle_validation_error(e):
@@ -0,0 +1,92 @@
+from flask import request
+from flask import current_app as app
+from flask_restful import abort
+from itsdangerous import URLSafeSerializer, BadSignature
+
+
+# Largest value of integer columns used in pagination keys
+MAX_INTEGER_KEY = 2 ** 31 - 1
+
+
+def get_cursor_serializer(name):
+    # Every paginated list has its own salt, so tokens of one list are
+    # rejected by the others
+    return URLSafeSerializer(app.config['SECRET_KEY'],
+                             salt='keyset-pagination:' + name)
+
+
+def is_key_value(value, key_type):
+    if isinstance(value, bool) or not isinstance(value, key_type):
+        return False
+    if key_type is int:
+        return -MAX_INTEGER_KEY - 1 <= value <= MAX_INTEGER_KEY
+    return True
+
+
+def encode_cursor(key, name):
+    """
+    Encodes keyset pagination key (values of last returned item) into opaque
+    token, which clients pass back as next parameter. Single value keys are
+    encoded as one item lists
+
+    :param name: Name of paginated list
+    :returns: Token or None if there are no more pages
+    :rtype: string
+    """
+    if key is None:
+        return None
+    if not isinstance(key, (list, tuple)):
+        key = [key]
+    return get_cursor_serializer(name).dumps(list(key))
+
+
+def decode_cursor(token, name, key_types):
+    """
+    Decodes token created by encode_cursor back into pagination key. Aborts
+    request if token is invalid or its key does not have expected shape
+
+    :param name: Name of paginated list
+    :param key_types: Types of key values
+    :type key_types: tuple
+    :returns: Key, or its only value if key has a single value
+    """
+    if not token:
+        return None
+    try:
+        key = get_cursor_serializer(name).loads(token)
+    except BadSignature:
+        abort(400, message='Invalid next token', status='error')
+    if (not isinstance(key, list) or len(key) != len(key_types) or
+            not all(is_key_value(value, key_type)
+                    for value, key_type in zip(key, key_types))):
+        abort(400, message='Invalid next token', status='error')
+    if len(key) == 1:
+        return key[0]
+    return key
+
+
+def get_keyset_page_args(name, key_types=(int,)):
+    """
+    Reads keyset pagination arguments (limit and next) of current request
+
+    :param name: Name of paginated list
+    :param key_types: Types of key values
+    :returns: Tuple (limit, key after which page starts), limit is None if
+    request is not paginated
+    :rtype: tuple
+    """
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return None, None
+    if limit < 1:
+        abort(400, message='Limit must be a positive number', status='error')
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+    return limit, decode_cursor(request.args.get('next'), name, key_types)
+
+
+def with_next_token(dumped_content, next_key, name):
+    """
+    Adds next page token to dumped content envelope
+    """
+    dumped_content['next'] = encode_cursor(next_key, name)
+    return dumped_content
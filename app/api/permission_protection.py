@@ -1,6 +1,7 @@
 from flask import g
 from flask_restful import abort
 from functools import wraps
+import app.devices.api as devices
 
 
 valid_permissions = [
@@ -12,6 +13,16 @@ valid_permissions = [
         'READ_DEVICE_TYPES',
         'READ_ROLES']
 
+valid_device_permissions = [
+        'VIEW_DEVICE',
+        'MODIFY_DEVICE',
+        'DELETE_DEVICE',
+        'WIDGET_READ',
+        'WIDGET_WRITE',
+        'CONFIGURATION_READ',
+        'CONFIGURATION_WRITE',
+        'SECRET_READ']
+
 
 def requires_permission(permission, action_name='Action'):
     if permission not in valid_permissions:
@@ -30,3 +41,23 @@ def requires_permission(permission, action_name='Action'):
         return permission_protected_function
 
     return requires_permission_decorator
+
+
+def validate_device_permission(device_id, permission='VIEW_DEVICE',
+                               action_name='Action'):
+    """
+    Aborts request unless current account can access device with given id,
+    with access level which includes given permission
+    """
+    if permission not in valid_device_permissions:
+        raise ValueError('Permission ' + str(permission) + ' does not exist!')
+
+    permissions = devices.get_device_permissions(g.current_account.id,
+                                                 device_id)
+    if permissions is None:
+        abort(403, message='You are not allowed to access this device',
+              status='error')
+    if permission not in permissions:
+        abort(403,
+              message=(action_name + ' is not allowed on this device'),
+              status='error')
@@ -0,0 +1,108 @@
+import threading
+from sqlalchemy import event
+from app.core import app, db
+from app.accounts.models import Account
+
+# Keyset paginated list endpoints, formatted with ids passed to check
+LIST_ENDPOINTS = {
+    'devices': '/api/v1/devices',
+    'device_recordings': '/api/v1/devices/{device_id}/recordings',
+    'dashboard_widgets': '/api/v1/dashboards/{dashboard_id}/widgets'
+}
+# Unpaginated list endpoints, compared between account with one row and
+# account with many rows (dashboards are listed with their widgets)
+ACCOUNT_LIST_ENDPOINTS = {
+    'dashboards': '/api/v1/dashboards'
+}
+
+
+class StatementCounter:
+    """
+    Counts SQL statements executed by database engine in current thread
+    while active
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.__thread = threading.get_ident()
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self.__count)
+        return self
+
+    def __exit__(self, error_type, error_instance, traceback):
+        event.remove(db.engine, 'before_cursor_execute', self.__count)
+
+    def __count(self, connection, cursor, statement, parameters, context,
+                executemany):
+        if threading.get_ident() == self.__thread:
+            self.count += 1
+
+
+def count_statements(client, path, token, limit=None):
+    """
+    Requests given list endpoint, or one page of it if limit is given
+
+    :returns: Tuple (number of statements, number of rows on page)
+    :rtype: tuple
+    """
+    query_string = {'limit': limit} if limit is not None else {}
+    with StatementCounter() as counter:
+        response = client.get(path,
+                              query_string=query_string,
+                              headers={'Authorization': 'Bearer ' + token})
+    if response.status_code != 200:
+        raise ValueError(path + ' responded with status ' +
+                         str(response.status_code))
+    return counter.count, len(response.get_json()['content'])
+
+
+def check_query_counts(account_id, device_id, dashboard_id, rows,
+                       single_account_id=None):
+    """
+    Requests paginated list endpoints as given account, with page of one row
+    and page of given number of rows, and unpaginated ones as account with
+    one row and as given account. Statement count of an endpoint must not
+    depend on number of rows, otherwise rows are loaded one by one (N+1
+    queries). Every request is preceded by a warm up request, so compared
+    requests see the same cache state
+
+    :param rows: Number of rows on larger page, which visible data must have
+    :param single_account_id: Account with exactly one row in unpaginated
+    lists, which are not checked without it
+    :returns: Tuple (dict of endpoint name to (statements for one row,
+    statements for all rows) for endpoints whose counts differ, list of
+    endpoint names which could not be checked for lack of rows)
+    :rtype: tuple
+    """
+    token = Account.get(id=account_id).create_auth_token()
+    client = app.test_client()
+    failures = {}
+    skipped = []
+    for name, path_format in sorted(LIST_ENDPOINTS.items()):
+        path = path_format.format(device_id=device_id,
+                                  dashboard_id=dashboard_id)
+        count_statements(client, path, token, rows)
+        single_count, single_rows = count_statements(client, path, token, 1)
+        many_count, many_rows = count_statements(client, path, token, rows)
+        if single_rows != 1 or many_rows != rows:
+            skipped.append(name)
+        elif single_count != many_count:
+            failures[name] = (single_count, many_count)
+
+    single_token = (Account.get(id=single_account_id).create_auth_token()
+                    if single_account_id is not None else None)
+    for name, path in sorted(ACCOUNT_LIST_ENDPOINTS.items()):
+        if single_token is None:
+            skipped.append(name)
+            continue
+        count_statements(client, path, single_token)
+        single_count, single_rows = count_statements(client, path,
+                                                     single_token)
+        count_statements(client, path, token)
+        many_count, many_rows = count_statements(client, path, token)
+        if single_rows != 1 or many_rows != rows:
+            skipped.append(name)
+        elif single_count != many_count:
+            failures[name] = (single_count, many_count)
+    return failures, skipped
@@ -6,6 +6,8 @@ from flasgger import swag_from
 import app.dashboards.api as dashboard
 import app.devices.api as device
 from app.api.auth_protection import ProtectedResource
+from app.api.permission_protection import validate_device_permission
+from app.api.pagination import get_keyset_page_args, with_next_token
 from app.api.schemas import (BaseResourceSchema,
                              BaseTimestampedSchema,
                              BaseTimestampedResourceSchema)
@@ -44,12 +46,6 @@ def validate_dashboard_ownership(dashboard_id):
     return requested_dashboard
 
 
-def validate_device_ownership(device_id):
-    if not device.can_user_access_device(g.current_account.id, device_id):
-        abort(403, message='You are not allowed to access this device',
-              status='error')
-
-
 class DashboardResource(ProtectedResource):
     @swag_from('swagger/get_dashboard_spec.yaml')
     def get(self, dashboard_id):
@@ -87,6 +83,30 @@ class DashboardResource(ProtectedResource):
         return '', 204
 
 
+class DashboardDataResource(ProtectedResource):
+    @swag_from('swagger/get_dashboard_data_spec.yaml')
+    def get(self, dashboard_id):
+        requested_dashboard = dashboard.get_dashboard_with_widgets(
+                dashboard_id)
+        if requested_dashboard.account_id != g.current_account.id:
+            abort(403, message='You are not allowed to access this dashboard',
+                  status='error')
+        result_format = request.args.get('format', 'rows')
+        if result_format not in device.RESULT_FORMATS:
+            abort(400, message='Invalid format, must be one of ' +
+                  str(device.RESULT_FORMATS), status='error')
+
+        widgets_data = dashboard.get_dashboard_data(
+                requested_dashboard, g.current_account.id, result_format)
+        dumped_dashboard = DashboardSchema().dump(requested_dashboard)
+        for dumped_widget in dumped_dashboard['content']['widgets']:
+            widget_data = widgets_data[dumped_widget['id']]
+            dumped_widget['data'] = widget_data.get('content')
+            if 'error' in widget_data:
+                dumped_widget['error'] = widget_data['error']
+        return dumped_dashboard, 200
+
+
 class DashboardListResource(ProtectedResource):
     @use_args(DashboardSchema(), locations=('json',))
     @swag_from('swagger/create_dashboard_spec.yaml')
@@ -111,7 +131,8 @@ class DashboardWidgetListResource(ProtectedResource):
     @swag_from('swagger/create_dashboard_widget_spec.yaml')
     def post(self, args, dashboard_id):
         validate_dashboard_ownership(dashboard_id)
-        validate_device_ownership(args['device_id'])
+        validate_device_permission(args['device_id'], 'WIDGET_WRITE',
+                                   'Adding widgets')
         created_widget = dashboard.create_widget(
                 dashboard_id,
                 args['device_id'],
@@ -127,6 +148,13 @@ class DashboardWidgetListResource(ProtectedResource):
     @swag_from('swagger/get_dashboard_widgets_spec.yaml')
     def get(self, dashboard_id):
         validate_dashboard_ownership(dashboard_id)
+        limit, after = get_keyset_page_args('widgets')
+        if limit is not None:
+            widgets, next_key = dashboard.get_widgets_page(
+                    dashboard_id, limit, after)
+            return with_next_token(
+                    DashboardWidgetSchema().dump(widgets, many=True),
+                    next_key, 'widgets'), 200
         return DashboardWidgetSchema().dump(
                 dashboard.get_widgets(dashboard_id), many=True), 200
 
@@ -142,7 +170,8 @@ class DashboardWidgetResource(ProtectedResource):
     @swag_from('swagger/update_dashboard_widget_spec.yaml')
     def put(self, args, dashboard_id, widget_id):
         validate_dashboard_ownership(dashboard_id)
-        validate_device_ownership(args['device_id'])
+        validate_device_permission(args['device_id'], 'WIDGET_WRITE',
+                                   'Updating widgets')
         updated_widget = dashboard.patch_widget(
                 widget_id,
                 args['device_id'],
@@ -160,7 +189,8 @@ class DashboardWidgetResource(ProtectedResource):
     def patch(self, args, dashboard_id, widget_id):
         validate_dashboard_ownership(dashboard_id)
         if args.get('device_id') is not None:
-            validate_device_ownership(args['device_id'])
+            validate_device_permission(args['device_id'], 'WIDGET_WRITE',
+                                       'Updating widgets')
         updated_widget = dashboard.patch_widget(
                 widget_id,
                 args.get('device_id'),
@@ -1,11 +1,14 @@
+import json
 from flask_restful import abort
 from marshmallow import Schema, fields
 from webargs.flaskparser import use_args
 from flasgger import swag_from
-from flask import g, request, redirect
+from flask import g, request, redirect, Response, stream_with_context
 from app.api.blueprint import api
 import app.devices.api as devices
 from app.api.auth_protection import ProtectedResource
+from app.api.permission_protection import validate_device_permission
+from app.api.pagination import get_keyset_page_args, with_next_token
 from app.api.schemas import (BaseResourceSchema,
                              BaseTimestampedSchema,
                              BaseTimestampedResourceSchema)
@@ -32,17 +35,34 @@ class DeviceWithConfigurationSchema(DeviceSchema):
     configuration = fields.Raw(dump_only=True)
 
 
-class RecordingsSchema(BaseResourceSchema):
+class BasicRecordingsSchema(Schema):
     recorded_at = fields.DateTime()
     record_type = fields.Integer()
     record_value = fields.Float()
 
 
+class RecordingsSchema(BaseResourceSchema, BasicRecordingsSchema):
+    pass
+
+
 class RecordingsQuerySchema(Schema):
     selections = fields.Raw()
     filters = fields.Raw()
     groups = fields.Raw()
     orders = fields.Raw()
+    format = fields.String(missing='rows',
+                           validate=lambda value:
+                           value in devices.RESULT_FORMATS)
+
+
+class RecordingsBatchQuerySchema(RecordingsQuerySchema):
+    device_ids = fields.List(fields.Integer(), required=True)
+
+
+class FleetConfigurationSchema(Schema):
+    configuration = fields.Dict(required=True)
+    device_ids = fields.List(fields.Integer())
+    device_type_id = fields.Integer()
 
 
 class DeviceDocumentationSchema(BaseTimestampedResourceSchema):
@@ -65,22 +85,48 @@ class DeviceShareTokenSchema(BaseResourceSchema):
     activation_url = fields.String()
 
 
-def validate_device_ownership(device_id):
-    if not devices.can_user_access_device(g.current_account.id, device_id):
-        abort(403, message='You are not allowed to access this device',
-              status='error')
+STREAM_FORMATS = ['ndjson', 'json']
+
+
+def stream_recordings(chunks, stream_format):
+    """
+    Encodes chunks of recordings incrementally, either as newline delimited
+    JSON or as JSON array in content envelope
+    """
+    schema = BasicRecordingsSchema()
+
+    def generate_ndjson():
+        for chunk in chunks:
+            yield ''.join(json.dumps(recording) + '\n'
+                          for recording in schema.dump(chunk, many=True))
+
+    def generate_json():
+        yield '{"content": ['
+        separator = ''
+        for chunk in chunks:
+            for recording in schema.dump(chunk, many=True):
+                yield separator + json.dumps(recording)
+                separator = ','
+        yield ']}'
+
+    if stream_format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()),
+                    mimetype='application/json')
 
 
 class DeviceResource(ProtectedResource):
     @swag_from('swagger/get_device_spec.yaml')
     def get(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id)
         return DeviceWithConfigurationSchema().dump(
                 devices.get_device(device_id)), 200
 
     @swag_from('swagger/delete_device_spec.yaml')
     def delete(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'DELETE_DEVICE',
+                                   'Deleting device')
         devices.delete_device(device_id)
         return '', 204
 
@@ -112,8 +158,33 @@ class DeviceTypeListResource(ProtectedResource):
 class DeviceRecordingResource(ProtectedResource):
     @swag_from('swagger/get_device_recordings_spec.yaml')
     def get(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id)
         request_args = request.args
+        stream_format = request_args.get('stream')
+        if stream_format is not None:
+            if stream_format not in STREAM_FORMATS:
+                abort(400, message='Invalid stream format. Valid formats: ' +
+                      str(STREAM_FORMATS), status='error')
+            return stream_recordings(
+                    devices.stream_device_recordings_filtered(
+                        device_id,
+                        request_args.get('record_type'),
+                        request_args.get('start_date'),
+                        request_args.get('end_date'),
+                        app.config['RECORDING_STREAM_CHUNK_SIZE']),
+                    stream_format)
+        limit, after = get_keyset_page_args('recordings', (str, int))
+        if limit is not None:
+            recordings, next_key = devices.get_device_recordings_page(
+                    device_id,
+                    limit,
+                    after,
+                    request_args.get('record_type'),
+                    request_args.get('start_date'),
+                    request_args.get('end_date'))
+            return with_next_token(
+                    RecordingsSchema().dump(recordings, many=True),
+                    next_key, 'recordings'), 200
         return RecordingsSchema().dump(
                     devices.get_device_recordings_filtered(
                         device_id,
@@ -123,7 +194,8 @@ class DeviceRecordingResource(ProtectedResource):
 
     @swag_from('swagger/create_device_recording_spec.yaml')
     def post(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'MODIFY_DEVICE',
+                                   'Creating recordings')
         created_recording = devices.create_recording_and_return(
                 device_id, request.json, True)
         return RecordingsSchema().dump(created_recording), 201
@@ -132,21 +204,62 @@ class DeviceRecordingResource(ProtectedResource):
 class DeviceLatestRecordingResource(ProtectedResource):
     @swag_from('swagger/get_latest_device_recording_spec.yaml')
     def get(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id)
         return RecordingsSchema().dump(
-                devices.get_latest_device_recording(device_id)), 200
+                devices.get_latest_device_recording(
+                    device_id,
+                    request.args.get('record_type'))), 200
+
+
+class DeviceLatestRecordingListResource(ProtectedResource):
+    @swag_from('swagger/get_latest_device_recordings_spec.yaml')
+    def get(self, device_id):
+        validate_device_permission(device_id)
+        return RecordingsSchema().dump(
+                devices.get_latest_device_recordings(device_id),
+                many=True), 200
 
 
 class DeviceRecordingQueryResource(ProtectedResource):
     @use_args(RecordingsQuerySchema(), locations=('json',))
     @swag_from('swagger/create_device_recording_query_spec.yaml')
     def post(self, args, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id)
+        result_format = args.pop('format')
         try:
             return {'content':
-                    devices.run_custom_query(device_id, args)}, 200
+                    devices.run_custom_query(device_id, args,
+                                             result_format)}, 200
+        except ValueError as e:
+            abort(400, message=str(e), status='error')
+
+
+class RecordingQueryBatchResource(ProtectedResource):
+    @use_args(RecordingsBatchQuerySchema(), locations=('json',))
+    @swag_from('swagger/create_recording_batch_query_spec.yaml')
+    def post(self, args):
+        device_ids = args.pop('device_ids')
+        result_format = args.pop('format')
+        if not device_ids:
+            abort(400, message='At least one device is required',
+                  status='error')
+        if len(device_ids) > app.config['JSONQL_MAX_BATCH_DEVICES']:
+            abort(400, message='Too many devices, at most ' +
+                  str(app.config['JSONQL_MAX_BATCH_DEVICES']) +
+                  ' are allowed', status='error')
+        accessible_ids = devices.get_accessible_device_ids(
+                g.current_account.id, device_ids, 'VIEW_DEVICE')
+        if not accessible_ids.issuperset(device_ids):
+            abort(403, message='You are not allowed to access devices ' +
+                  str(sorted(set(device_ids) - accessible_ids)),
+                  status='error')
+        try:
+            results = devices.run_custom_query_many(device_ids, args,
+                                                    result_format)
         except ValueError as e:
             abort(400, message=str(e), status='error')
+        return {'content': {str(device_id): result
+                            for device_id, result in results.items()}}, 200
 
 
 class DeviceListResource(ProtectedResource):
@@ -161,6 +274,13 @@ class DeviceListResource(ProtectedResource):
 
     @swag_from('swagger/get_devices_spec.yaml')
     def get(self):
+        limit, after = get_keyset_page_args('devices')
+        if limit is not None:
+            devices_page, next_key = devices.get_devices_page(
+                    g.current_account.id, limit, after)
+            return with_next_token(
+                    DeviceSchema().dump(devices_page, many=True),
+                    next_key, 'devices'), 200
         return DeviceSchema().dump(
                 devices.get_devices(g.current_account.id), many=True), 200
 
@@ -168,7 +288,8 @@ class DeviceListResource(ProtectedResource):
 class DeviceConfigurationResource(ProtectedResource):
     @swag_from('swagger/update_device_configuration_spec.yaml')
     def put(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'CONFIGURATION_WRITE',
+                                   'Updating configuration')
         updated_device = devices.set_device_configuration(
                 device_id, request.json)
         return DeviceWithConfigurationSchema().dump(
@@ -176,15 +297,48 @@ class DeviceConfigurationResource(ProtectedResource):
 
     @swag_from('swagger/get_device_configuration_spec.yaml')
     def get(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'CONFIGURATION_READ',
+                                   'Reading configuration')
         return devices.get_device_configuration(device_id), 200
 
 
+class FleetConfigurationResource(ProtectedResource):
+    @use_args(FleetConfigurationSchema(), locations=('json',))
+    @swag_from('swagger/update_fleet_configuration_spec.yaml')
+    def post(self, args):
+        device_ids = args.get('device_ids')
+        if device_ids is not None:
+            if not device_ids:
+                abort(422, message='At least one device is required',
+                      status='error')
+            accessible_ids = devices.get_accessible_device_ids(
+                    g.current_account.id, device_ids, 'CONFIGURATION_WRITE')
+            if not accessible_ids.issuperset(device_ids):
+                abort(403, message='Updating configuration is not allowed '
+                      'on devices ' +
+                      str(sorted(set(device_ids) - accessible_ids)),
+                      status='error')
+        push_id, device_count = devices.set_fleet_configuration(
+                g.current_account.id,
+                args['configuration'],
+                device_ids,
+                args.get('device_type_id'))
+        return {'content': {'id': push_id, 'devices': device_count}}, 202
+
+
+class FleetConfigurationProgressResource(ProtectedResource):
+    @swag_from('swagger/get_fleet_configuration_progress_spec.yaml')
+    def get(self, push_id):
+        return {'content': devices.get_fleet_configuration_progress(
+                    g.current_account.id, push_id)}, 200
+
+
 class DeviceDocumentationResource(ProtectedResource):
     @use_args(DeviceDocumentationSchema(), locations=('json',))
     @swag_from('swagger/update_device_documentation_spec.yaml')
     def put(self, args, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'MODIFY_DEVICE',
+                                   'Updating documentation')
         update_device_documentation = devices.update_device_documentation(
                 device_id, args['text'])
         return DeviceDocumentationSchema().dump(
@@ -192,7 +346,7 @@ class DeviceDocumentationResource(ProtectedResource):
 
     @swag_from('swagger/get_device_documentation_spec.yaml')
     def get(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id)
         return DeviceDocumentationSchema().dump(
                 devices.get_device_documentation(device_id)), 200
 
@@ -200,13 +354,14 @@ class DeviceDocumentationResource(ProtectedResource):
 class DeviceSecretResource(ProtectedResource):
     @swag_from('swagger/get_device_secret_spec.yaml')
     def get(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'SECRET_READ', 'Reading secret')
         return DeviceSecretSchema().dump(devices.get_device(device_id)), 200
 
     @use_args(DeviceSecretSchema(), locations=('json',))
     @swag_from('swagger/update_device_secret_spec.yaml')
     def put(self, args, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'MODIFY_DEVICE',
+                                   'Updating secret')
         return DeviceSecretSchema().dump(
                 devices.update_algorithm(
                     device_id,
@@ -218,7 +373,8 @@ class DeviceSecretResource(ProtectedResource):
 class DeviceSecretResetResource(ProtectedResource):
     @swag_from('swagger/reset_device_secret_spec.yaml')
     def post(self, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'MODIFY_DEVICE',
+                                   'Resetting secret')
         return DeviceSecretSchema().dump(
                 devices.reset_device_secret(device_id)), 200
 
@@ -227,7 +383,8 @@ class DeviceShareResource(ProtectedResource):
     @use_args(DeviceShareSchema(), locations=('json',))
     @swag_from('swagger/create_device_share_token_spec.yaml')
     def post(self, args, device_id):
-        validate_device_ownership(device_id)
+        validate_device_permission(device_id, 'MODIFY_DEVICE',
+                                   'Sharing device')
         created_token = devices.create_targeted_device_sharing_token(
                 device_id, args['access_level_id'], args.get('account_id'))
         activation_url = api.url_for(
@@ -0,0 +1,448 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+from collections import OrderedDict
+from dateutil import parser as date_parser
+from sqlalchemy import inspect, Date, DateTime
+from sqlalchemy.orm import make_transient_to_detached
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread safe, process-local cache with least recently used eviction and
+    time based expiration of entries
+
+    :param max_size: Maximum number of entries kept in cache
+    :param ttl: Number of seconds after which entry expires
+    :type max_size: int
+    :type ttl: float
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns cached value for given key, or default if it is not cached or
+        if it has expired
+        """
+        with self.__lock:
+            entry = self.__entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.__entries[key]
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Stores value under given key, evicting least recently used entries if
+        cache is full
+        """
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns cached value for given key. On miss, value is obtained by
+        calling loader and then stored
+
+        :param loader: Function without arguments which returns the value
+        :type loader: func()
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        Removes entry with given key, if present
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all entries
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """
+        Returns current cache statistics
+
+        :rtype: dict
+        """
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self.__entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / requests) if requests else None
+            }
+
+
+class TwoTierCache:
+    """
+    Cache shared by all processes, with in-process LRUCache in front of
+    Redis. Values are stored as JSON in both tiers, so every get returns a
+    fresh copy. Values which are not JSON compatible are converted by
+    optional dump and load functions (see get_cached_instance for models).
+
+    Invalidations delete the Redis entry and are broadcast over Redis
+    pub/sub, so every process drops its local copy. Local entries also
+    expire after local_ttl, in case a broadcast is missed. If Redis is not
+    available, cache falls back to the local tier only
+
+    Every key has a generation counter in Redis, incremented by
+    invalidations. Values are stored together with generation read before
+    they were loaded, and values of older generations are ignored, so a
+    value loaded before a concurrent invalidation is never served
+
+    Caches which are not shared keep values in local tiers only, and use
+    Redis just to broadcast invalidations. They are meant for values which
+    must not be written to Redis, like device secrets
+
+    :param redis_client: Redis client
+    :param name: Name of cache, used as prefix of Redis keys and channel
+    :param max_size: Maximum number of entries in local tier
+    :param local_ttl: Number of seconds after which local entry expires
+    :param ttl: Number of seconds after which Redis entry expires
+    :param dump: Function converting value to JSON compatible data
+    :param load: Function converting data back to value
+    :param shared: Whether values are stored in Redis
+    """
+
+    def __init__(self, redis_client, name, max_size, local_ttl, ttl,
+                 dump=None, load=None, shared=True):
+        self.redis_client = redis_client
+        self.name = name
+        self.ttl = ttl
+        self.shared = shared
+        self.dump = dump
+        self.load = load
+        self.local = LRUCache(max_size, local_ttl)
+        self.channel = 'cache-invalidation:' + name
+        self.__local_invalidations = 0
+        self.__listener_pid = None
+        self.__lock = threading.Lock()
+
+    def get_redis_key(self, key):
+        return 'cache:%s:%s' % (self.name, key)
+
+    def get_generation_key(self, key):
+        return 'cache-generation:%s:%s' % (self.name, key)
+
+    def get(self, key, default=None):
+        """
+        Returns cached value for given key from local tier or from Redis, or
+        default if it is not cached
+        """
+        values, generations = self.__get_many([str(key)])
+        return values.get(str(key), default)
+
+    def set(self, key, value):
+        """
+        Stores value under given key in both tiers
+        """
+        key = str(key)
+        generation = None
+        if self.shared:
+            try:
+                generation = self.__get_generations([key])[key]
+            except Exception:
+                print_cache_error("Cache " + self.name + " unavailable")
+        self.__set_many({key: value}, {key: generation},
+                        self.__local_invalidations)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns cached value for given key. On miss, value is obtained by
+        calling loader and then stored
+
+        :param loader: Function without arguments which returns the value
+        :type loader: func()
+        """
+        key = str(key)
+        return self.get_many_or_load(
+                [key], lambda keys: {key: loader()})[key]
+
+    def get_many_or_load(self, keys, loader):
+        """
+        Returns cached values for given keys. Values which are not cached
+        are obtained by single loader call and then stored
+
+        :param keys: Keys of values, converted to strings
+        :param loader: Function which takes list of missing keys and
+        returns dictionary of their values
+        :type loader: func(keys:list)
+        :returns: Dictionary of values keyed by (string) key
+        :rtype: dict
+        """
+        keys = [str(key) for key in keys]
+        self.__ensure_listener()
+        local_invalidations = self.__local_invalidations
+        values, generations = self.__get_many(keys)
+        missing_keys = [key for key in keys if key not in values]
+        if missing_keys:
+            loaded = loader(missing_keys)
+            self.__set_many(loaded, generations, local_invalidations)
+            values.update(loaded)
+        return values
+
+    def invalidate(self, key):
+        """
+        Removes entry with given key from Redis and from local tiers of all
+        processes
+        """
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        """
+        Removes entries with given keys from Redis and from local tiers of
+        all processes, in a single Redis round trip
+        """
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        self.__invalidate_local(keys)
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            if self.shared:
+                for key in keys:
+                    pipeline.incr(self.get_generation_key(key))
+                pipeline.delete(*[self.get_redis_key(key) for key in keys])
+            for key in keys:
+                pipeline.publish(self.channel, key)
+            pipeline.execute()
+        except Exception:
+            print_cache_error("Failed to invalidate cache " + self.name)
+
+    def stats(self):
+        return self.local.stats()
+
+    def __get_many(self, keys):
+        # Returns found values and Redis generations of keys which were not
+        # found (None if Redis is not available)
+        self.__ensure_listener()
+        values = {}
+        missing_keys = []
+        for key in keys:
+            data = self.local.get(key, _MISSING)
+            if data is _MISSING:
+                missing_keys.append(key)
+            else:
+                values[key] = self.__decode(data)
+        generations = {key: None for key in missing_keys}
+        if not missing_keys or not self.shared:
+            return values, generations
+
+        local_invalidations = self.__local_invalidations
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.mget([self.get_redis_key(key) for key in missing_keys])
+            pipeline.mget([self.get_generation_key(key)
+                           for key in missing_keys])
+            entries, current_generations = pipeline.execute()
+        except Exception:
+            print_cache_error("Cache " + self.name + " unavailable")
+            return values, generations
+
+        for key, entry, generation in zip(missing_keys, entries,
+                                          current_generations):
+            generation = int(generation) if generation is not None else 0
+            generations[key] = generation
+            if entry is None:
+                continue
+            try:
+                entry_generation, data = json.loads(entry.decode('utf-8'))
+            except (ValueError, TypeError):
+                continue
+            if entry_generation != generation:
+                continue
+            if local_invalidations == self.__local_invalidations:
+                self.local.set(key, data)
+            values[key] = self.__decode(data)
+        return values, generations
+
+    def __get_generations(self, keys):
+        generations = self.redis_client.mget(
+                [self.get_generation_key(key) for key in keys])
+        return {key: int(generation) if generation is not None else 0
+                for key, generation in zip(keys, generations)}
+
+    def __set_many(self, values, generations, local_invalidations):
+        # Local tier is not updated if any key was invalidated since values
+        # started loading, Redis entries carry generation they were loaded in
+        encoded = {key: self.__encode(value) for key, value in values.items()}
+        if local_invalidations == self.__local_invalidations:
+            for key, data in encoded.items():
+                self.local.set(key, data)
+        entries = [(key, data) for key, data in encoded.items()
+                   if generations.get(key) is not None]
+        if not entries:
+            return
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key, data in entries:
+                pipeline.set(self.get_redis_key(key),
+                             json.dumps([generations[key], data]),
+                             ex=self.ttl)
+            pipeline.execute()
+        except Exception:
+            print_cache_error("Failed to store value in cache " + self.name)
+
+    def __encode(self, value):
+        if value is not None and self.dump is not None:
+            value = self.dump(value)
+        return json.dumps(value)
+
+    def __decode(self, data):
+        value = json.loads(data)
+        if value is not None and self.load is not None:
+            value = self.load(value)
+        return value
+
+    def __invalidate_local(self, keys):
+        with self.__lock:
+            self.__local_invalidations += 1
+        for key in keys:
+            self.local.invalidate(key)
+
+    def __clear_local(self):
+        with self.__lock:
+            self.__local_invalidations += 1
+        self.local.clear()
+
+    def __ensure_listener(self):
+        # Started lazily and once per process, since processes may be forked
+        # after cache is created (threads do not survive fork)
+        if self.__listener_pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__listener_pid == os.getpid():
+                return
+            self.__listener_pid = os.getpid()
+            threading.Thread(target=self.__listen,
+                             name='cache-invalidation-' + self.name,
+                             daemon=True).start()
+        self.__clear_local()
+
+    def __listen(self):
+        while True:
+            try:
+                pubsub = self.redis_client.pubsub(
+                        ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Entries might have changed while listener was not
+                # subscribed
+                self.__clear_local()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.__invalidate_local(
+                                [message['data'].decode('utf-8')])
+            except Exception:
+                print_cache_error("Cache " + self.name +
+                                  " invalidation listener failed")
+                time.sleep(1)
+
+
+def print_cache_error(message):
+    print("ERROR! " + message)
+    error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
+
+
+def dump_instance(instance, exclude=()):
+    """
+    Returns column values of model instance as JSON compatible dictionary
+
+    :param exclude: Names of columns which are left out
+    """
+    values = {}
+    for attribute in inspect(type(instance)).column_attrs:
+        if attribute.key in exclude:
+            continue
+        value = getattr(instance, attribute.key)
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.isoformat()
+        values[attribute.key] = value
+    return values
+
+
+def load_instance(model, values):
+    """
+    Creates detached instance of model from values returned by
+    dump_instance, without calling its constructor. Relationships and
+    excluded columns are not loaded, so they are lazy loaded once instance
+    is attached to a session
+    """
+    mapper = inspect(model)
+    instance = mapper.class_manager.new_instance()
+    for attribute in mapper.column_attrs:
+        if attribute.key not in values:
+            continue
+        value = values[attribute.key]
+        column_type = attribute.columns[0].type
+        if value is not None and isinstance(column_type, DateTime):
+            value = date_parser.parse(value)
+        elif value is not None and isinstance(column_type, Date):
+            value = date_parser.parse(value).date()
+        setattr(instance, attribute.key, value)
+    make_transient_to_detached(instance)
+    return instance
+
+
+def get_cached_instance(cache, model, key, loader, session, exclude=()):
+    """
+    Returns model instance (or list of instances) cached under given key,
+    loading it with loader on miss. Only column values are cached, and
+    cached copies are attached to given session without querying the
+    database
+
+    :param model: Model class of instances
+    :param loader: Function which loads instance, instance list or None
+    :type loader: func()
+    :param exclude: Names of columns which are not cached, they are loaded
+    from database when accessed
+    """
+    def load_values():
+        value = loader()
+        if isinstance(value, list):
+            return [dump_instance(instance, exclude) for instance in value]
+        return (dump_instance(value, exclude) if value is not None
+                else None)
+
+    values = cache.get_or_load(key, load_values)
+    if values is None:
+        return None
+    if isinstance(values, list):
+        return [session.merge(load_instance(model, instance_values),
+                              load=False)
+                for instance_values in values]
+    return session.merge(load_instance(model, values), load=False)
@@ -1,4 +1,5 @@
 # App initialization
+import redis
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
@@ -6,6 +7,7 @@ from flask_mail import Mail
 from flasgger import Swagger
 from flask_cors import CORS
 from .tasks import celery_configurator
+from .cache import TwoTierCache
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object('config')
@@ -17,6 +19,11 @@ swagger = Swagger(app, template_file='swagger/template.yaml')
 swagger.template['info']['version'] = app.config['APP_VERSION']
 CORS(app)
 celery = celery_configurator.make_celery(app)
+redis_client = redis.StrictRedis.from_url(app.config['REDIS_URL'])
+model_cache = TwoTierCache(redis_client, 'models',
+                           app.config['MODEL_CACHE_SIZE'],
+                           app.config['MODEL_CACHE_LOCAL_TTL'],
+                           app.config['MODEL_CACHE_TTL'])
 
 
 def setup_blueprints(app):
@@ -1,4 +1,8 @@
 from .models import Dashboard, DashboardWidget
+import app.devices.api as devices
+
+# Keys of widget filters which form widget jsonql request
+WIDGET_REQUEST_KEYS = ['selections', 'filters', 'groups', 'orders']
 
 
 # Public interface
@@ -32,6 +36,80 @@ def get_dashboard(dashboard_id):
     return Dashboard.get(id=dashboard_id)
 
 
+def get_dashboard_with_widgets(dashboard_id):
+    """
+    Tries to fetch dashboard with given id, together with its widgets
+
+    :param dashboard_id: Id of requested dashboard
+    :type name: int
+    :returns: Dashboard object with loaded widgets
+    :rtype: Dashboard
+    """
+    return Dashboard.get_with_widgets(id=dashboard_id)
+
+
+def get_widget_request(widget):
+    """
+    Creates jsonql request from widget filters
+
+    :returns: jsonql request
+    :rtype: dict
+    :raises: ValueError if widget filters are not a valid request
+    """
+    if not isinstance(widget.filters, dict):
+        raise ValueError("Widget filters must be an object!")
+    request = {}
+    for key in WIDGET_REQUEST_KEYS:
+        value = widget.filters.get(key)
+        if value is not None and not isinstance(value, dict):
+            raise ValueError("Widget " + key + " must be an object!")
+        request[key] = value
+    return request
+
+
+def get_dashboard_data(dashboard, account_id, result_format='rows'):
+    """
+    Evaluates jsonql requests of all widgets of given dashboard. Widgets on
+    devices which account can no longer access, or which it may not read
+    widgets of, are not evaluated. Invalid or failed query of a widget is
+    reported only for widgets which share it
+
+    :param dashboard: Dashboard with loaded widgets
+    :type dashboard: Dashboard
+    :param account_id: Id of account viewing the dashboard
+    :type account_id: int
+    :param result_format: One of devices.RESULT_FORMATS
+    :type result_format: string
+    :returns: Dictionary keyed by widget id, where every value is either
+    {'content': result} or {'error': message}
+    :rtype: dict
+    """
+    if not dashboard.widgets:
+        return {}
+    accessible_ids = devices.get_accessible_device_ids(
+            account_id, set(widget.device_id for widget in dashboard.widgets),
+            'WIDGET_READ')
+    data = {}
+    queries = []
+    queried_widgets = []
+    for widget in dashboard.widgets:
+        if widget.device_id not in accessible_ids:
+            data[widget.id] = {
+                'error': 'You are not allowed to access this device'}
+            continue
+        try:
+            queries.append((widget.device_id, get_widget_request(widget)))
+        except ValueError as e:
+            data[widget.id] = {'error': str(e)}
+            continue
+        queried_widgets.append(widget)
+
+    results = devices.run_custom_queries(queries, result_format)
+    for widget, result in zip(queried_widgets, results):
+        data[widget.id] = result
+    return data
+
+
 def patch_dashboard(account_id, dashboard_id,
                     dashboard_data=None, active=None, name=None):
     """
@@ -141,6 +219,29 @@ def get_widgets(dashboard_id):
     return DashboardWidget.get_many_for_dashboard(dashboard_id)
 
 
+def get_widgets_page(dashboard_id, limit, after=None):
+    """
+    Tries to fetch one page of widgets of a dashboard with dashboard_id, using
+    keyset pagination on id
+
+    :param dashboard_id: Id of owner dashboard
+    :type name: int
+    :param limit: Maximum number of widgets in page
+    :type limit: int
+    :param after: Id of last widget of previous page, None for first page
+    :type after: int
+    :returns: Tuple (widgets, id of last widget or None if this is the last
+    page)
+    :rtype: tuple
+    """
+    widgets = DashboardWidget.get_page_for_dashboard(dashboard_id, limit,
+                                                     after)
+    if len(widgets) <= limit:
+        return widgets, None
+    widgets = widgets[:limit]
+    return widgets, widgets[-1].id
+
+
 def get_widget(widget_id):
     """
     Tries to fetch widget with given id
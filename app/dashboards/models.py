@@ -1,4 +1,6 @@
-from app.core import db
+from app.core import db, model_cache
+from app.cache import get_cached_instance
+from sqlalchemy.orm import selectinload
 from sqlalchemy.dialects.postgresql import JSON
 
 
@@ -34,13 +36,16 @@ class Dashboard(db.Model):
         """
         db.session.add(self)
         db.session.commit()
+        model_cache.invalidate('dashboard:%s' % self.id)
 
     def delete(self):
         """
         Deletes this dashboard from database
         """
+        dashboard_id = self.id
         db.session.delete(self)
         db.session.commit()
+        model_cache.invalidate('dashboard:%s' % dashboard_id)
 
     @staticmethod
     def exists_with_any_of(**kwargs):
@@ -88,7 +93,9 @@ class Dashboard(db.Model):
         Available filters:
          * active
         """
-        query = Dashboard.query.filter(Dashboard.account_id == account_id)
+        query = Dashboard.query.options(
+                selectinload(Dashboard.widgets)
+                ).filter(Dashboard.account_id == account_id)
         if active is not None:
             query = query.filter(Dashboard.active == active)
         return query.all()
@@ -98,9 +105,17 @@ class Dashboard(db.Model):
         """
         Deactivates all dashboards for this user
         """
-        db.session.query(Dashboard).filter(account_id == account_id) \
-                                   .update({'active': False})
+        active_ids = [row.id for row in Dashboard.query.with_entities(
+                Dashboard.id).filter(Dashboard.account_id == account_id,
+                                     Dashboard.active.is_(True))]
+        if not active_ids:
+            return
+        db.session.query(Dashboard).filter(Dashboard.id.in_(active_ids)) \
+                                   .update({'active': False},
+                                           synchronize_session=False)
         db.session.commit()
+        for dashboard_id in active_ids:
+            model_cache.invalidate('dashboard:%s' % dashboard_id)
 
     @staticmethod
     def get(**kwargs):
@@ -110,9 +125,31 @@ class Dashboard(db.Model):
         Available filters:
          * id
          * account_id
+
+        Dashboards fetched by id only are cached
         """
+        if list(kwargs.keys()) == ['id']:
+            return get_cached_instance(
+                    model_cache, Dashboard, 'dashboard:%s' % kwargs['id'],
+                    lambda: Dashboard.query.filter_by(
+                        **kwargs).first_or_404(),
+                    db.session)
         return Dashboard.query.filter_by(**kwargs).first_or_404()
 
+    @staticmethod
+    def get_with_widgets(**kwargs):
+        """
+        Get dashboard with given filters, loading its widgets eagerly in a
+        single additional query
+
+        Available filters:
+         * id
+         * account_id
+        """
+        return Dashboard.query.options(
+                selectinload(Dashboard.widgets)
+                ).filter_by(**kwargs).first_or_404()
+
     def __repr__(self):
         return '<Dashboard (dashboard_data=%s, account_id=%s)>' % (
                 self.dashboard_data, self.account_id)
@@ -222,6 +259,21 @@ class DashboardWidget(db.Model):
                 DashboardWidget.dashboard_id == dashboard_id)
         return query.paginate(None, None, False).items
 
+    @staticmethod
+    def get_page_for_dashboard(dashboard_id, limit, after=None):
+        """
+        Get one page of widgets for given dashboard, ordered by id and
+        starting after widget with id passed in after
+
+        :returns: List of widgets, with one widget more than limit if there
+        are more pages
+        """
+        query = DashboardWidget.query.filter(
+                DashboardWidget.dashboard_id == dashboard_id)
+        if after is not None:
+            query = query.filter(DashboardWidget.id > after)
+        return query.order_by(DashboardWidget.id).limit(limit + 1).all()
+
     @staticmethod
     def get(**kwargs):
         """
@@ -1,29 +1,163 @@
 import sys
 import hmac
+import json
 import urllib.parse
-import datetime
 import hashlib
+from collections import OrderedDict
 from secrets import token_urlsafe
+from celery import group, states
+from celery.result import GroupResult
+from celery.utils import uuid
+from dateutil import parser as date_parser
 from .models import (Device,
                      Recording,
+                     DeviceLatestRecording,
                      DeviceAssociation,
                      DeviceType,
                      AccessLevel,
                      DeviceDocumentation)
+from .recording_buffer import RecordingBuffer
+from .query_cache import RecordingQueryCache
+from .rollups import choose_rollup_period, build_rollup_query
 from itsdangerous import URLSafeSerializer
-from app.core import app
+from sqlalchemy.exc import SQLAlchemyError
+from app.core import app, db, redis_client
+from app.cache import TwoTierCache
 from app.errors import NotPresentError
 from app.jsonql import api as jsonql
+from app.mqtt.delivery import ConfigurationVersions
+
+
+# Result formats of custom queries
+RESULT_FORMATS = ['rows', 'columns']
+CONFIGURATION_PUSH_KEY_FORMAT = 'configuration-push:%s'
+
+query_cache = RecordingQueryCache(redis_client,
+                                  app.config['JSONQL_RESULT_CACHE_SIZE'],
+                                  app.config['JSONQL_RESULT_CACHE_TTL'])
+
+recording_buffer = RecordingBuffer(
+        app.config['RECORDING_BUFFER_SIZE'],
+        app.config['RECORDING_BATCH_SIZE'],
+        app.config['RECORDING_FLUSH_INTERVAL'],
+        app.config['RECORDING_BUFFER_TIMEOUT'],
+        lambda rows: query_cache.invalidate(row['device_id'] for row in rows),
+        app.config['RECORDING_FLUSH_RETRIES'],
+        app.config['RECORDING_FLUSH_RETRY_BACKOFF'])
+
+# Maps device id to (device_secret, secret_algorithm, exists). Secrets
+# stay in process, only invalidations are sent through Redis
+device_cache = TwoTierCache(redis_client, 'device-secrets',
+                            app.config['DEVICE_CACHE_SIZE'],
+                            app.config['DEVICE_CACHE_TTL'],
+                            app.config['DEVICE_CACHE_TTL'],
+                            shared=False)
+# Maps account id to its device access index (see get_device_access_index)
+device_access_cache = TwoTierCache(redis_client, 'device-access',
+                                   app.config['DEVICE_ACCESS_CACHE_SIZE'],
+                                   app.config['DEVICE_ACCESS_CACHE_TTL'],
+                                   app.config['DEVICE_ACCESS_CACHE_TTL'],
+                                   load=lambda index: {
+                                       int(device_id): permissions
+                                       for device_id, permissions
+                                       in index.items()})
+# Configuration version counters, used to skip superseded publishes
+configuration_versions = ConfigurationVersions(redis_client)
 
 
 # Private helpers
+def load_device_secret_info(device_id):
+    secret_info = Device.get_secret_info(device_id)
+    if secret_info is None:
+        return (None, None, False)
+    return (secret_info.device_secret, secret_info.secret_algorithm, True)
+
+
+def get_device_secret_info(device_id):
+    return device_cache.get_or_load(
+            device_id, lambda: load_device_secret_info(device_id))
+
+
+def load_device_secret_infos(device_ids):
+    device_ids = [int(device_id) for device_id in device_ids]
+    secret_infos = {device_id: (None, None, False)
+                    for device_id in device_ids}
+    for row in Device.get_secret_infos(device_ids):
+        secret_infos[row.id] = (row.device_secret, row.secret_algorithm,
+                                True)
+    return {str(device_id): secret_info
+            for device_id, secret_info in secret_infos.items()}
+
+
+def get_device_secret_infos(device_ids):
+    """
+    Gets secret info of many devices, loading those which are not cached
+    by a single query
+
+    :returns: Dictionary of (device_secret, secret_algorithm, exists)
+    keyed by device id
+    :rtype: dict
+    """
+    secret_infos = device_cache.get_many_or_load(device_ids,
+                                                 load_device_secret_infos)
+    return {int(device_id): secret_info
+            for device_id, secret_info in secret_infos.items()}
+
+
+def cached_device_exists(device_id):
+    device_secret, secret_algorithm, exists = get_device_secret_info(
+            device_id)
+    return exists
+
+
+def invalidate_device_access(account_ids):
+    for account_id in set(account_ids):
+        device_access_cache.invalidate(account_id)
+
+
+def invalidate_device_cache(device_id):
+    device_cache.invalidate(device_id)
+
+
 def generate_hmac_for_message(device_id, raw_json):
-    device = Device.get(id=device_id)
-    raw_json_bytes = urllib.parse.urlencode(raw_json).encode('utf-8')
+    device_secret, secret_algorithm, exists = get_device_secret_info(
+            device_id)
+    if not exists:
+        raise NotPresentError("Device with id %s does not exist" % device_id)
+    return sign_message(device_secret, secret_algorithm,
+                        encode_message(raw_json))
+
+
+def encode_message(raw_json):
+    return urllib.parse.urlencode(raw_json).encode('utf-8')
+
+
+def sign_message(device_secret, secret_algorithm, raw_json_bytes):
     return hmac.new(
-            bytes(device.device_secret, 'utf-8'),
+            bytes(device_secret, 'utf-8'),
             raw_json_bytes,
-            device.secret_algorithm).hexdigest()
+            secret_algorithm).hexdigest()
+
+
+def sign_configurations(secret_rows, configuration_json, versions):
+    """
+    Signs the same configuration for many devices. Configuration is encoded
+    only once, and only HMAC is computed for every device
+
+    :param secret_rows: (id, device_secret, secret_algorithm) rows
+    :param versions: Configuration versions keyed by device id
+    :returns: List of (device_id, signed configuration message, version)
+    :rtype: list
+    """
+    raw_json_bytes = encode_message(configuration_json)
+    messages = []
+    for device_id, device_secret, secret_algorithm in secret_rows:
+        signed_configuration = dict(configuration_json)
+        signed_configuration['hmac'] = sign_message(
+                device_secret, secret_algorithm, raw_json_bytes)
+        messages.append((device_id, str(signed_configuration),
+                         versions.get(device_id)))
+    return messages
 
 
 def validate_hmac_in_message(device_id, raw_json):
@@ -48,8 +182,10 @@ def create_device(name, account_id, device_type=1):
     """
     device = Device(name, None, device_type)
     device.save()
+    invalidate_device_cache(device.id)
     device_association = DeviceAssociation(device.id, account_id)
     device_association.save()
+    invalidate_device_access([account_id])
     return device
 
 
@@ -84,10 +220,141 @@ def set_device_configuration(device_id, configuration_json):
     configuration_json['hmac'] = generate_hmac_for_message(
             device_id,
             configuration_json)
-    send_config.delay(device_id, str(configuration_json))
+    version = configuration_versions.next_versions([device_id]).get(
+            device_id)
+    send_config.delay(device_id, str(configuration_json), version)
     return device
 
 
+def set_fleet_configuration(account_id, configuration_json,
+                            device_ids=None, device_type_id=None):
+    """
+    Applies configuration to many devices of account with given id in one
+    transaction and sends it to them through chunked tasks. Only devices on
+    which account has CONFIGURATION_WRITE permission are updated
+
+    :param account_id: Id of account pushing the configuration
+    :param configuration_json: New configuration
+    :param device_ids: Optional ids of devices to update
+    :param device_type_id: Optional id of device type to update
+    :type account_id: int
+    :type configuration_json: JSON
+    :type device_ids: list
+    :type device_type_id: int
+    :returns: Tuple (push id, number of updated devices)
+    :rtype: tuple
+    :raises: ValueError if no device matches given targets
+    """
+    target_ids = get_accessible_device_ids(
+            account_id,
+            device_ids if device_ids is not None
+            else get_device_access_index(account_id).keys(),
+            'CONFIGURATION_WRITE')
+    if not target_ids:
+        raise ValueError("No devices to configure")
+    secret_rows = Device.set_configuration_many(
+            target_ids, configuration_json, device_type_id)
+    if not secret_rows:
+        raise ValueError("No devices to configure")
+    versions = configuration_versions.next_versions(
+            row.id for row in secret_rows)
+    messages = sign_configurations(secret_rows, configuration_json,
+                                   versions)
+    # Push record is written before tasks start, so their progress can be
+    # read as soon as the push id is returned. Configuration is already
+    # stored, so it is sent even if the record can not be written
+    push_id = uuid()
+    try:
+        redis_client.set(CONFIGURATION_PUSH_KEY_FORMAT % push_id,
+                         json.dumps({'account_id': account_id,
+                                     'devices': len(messages)}),
+                         ex=app.config['CONFIGURATION_PUSH_TTL'])
+    except Exception:
+        print_api_error("Failed to store configuration push " + push_id)
+    push_configurations(messages, push_id)
+    return push_id, len(messages)
+
+
+def push_configurations(messages, push_id):
+    """
+    Splits signed configuration messages into chunks and sends every chunk
+    by single send_configs task
+
+    :param push_id: Id of group result of all chunk tasks, which is saved
+    for progress reports
+    :type push_id: string
+    """
+    from .tasks import send_configs
+    chunk_size = app.config['CONFIGURATION_PUSH_CHUNK_SIZE']
+    result = group(
+            send_configs.s(messages[start:start + chunk_size])
+            for start in range(0, len(messages), chunk_size)
+            ).apply_async(task_id=push_id)
+    try:
+        result.save()
+    except Exception:
+        print_api_error("Failed to save result of configuration push " +
+                        push_id)
+
+
+def get_fleet_configuration_progress(account_id, push_id):
+    """
+    Gets progress of configuration push with given id, started by account
+    with given id
+
+    :returns: Dictionary with state of push, number of devices and
+    number of devices configuration was sent to or failed for
+    :rtype: dict
+    :raises NotPresentError: if push does not exist, expired or was started
+    by another account
+    """
+    from .tasks import send_configs
+    push_info = redis_client.get(CONFIGURATION_PUSH_KEY_FORMAT % push_id)
+    if push_info is None:
+        raise NotPresentError(
+                "Configuration push with id %s does not exist" % push_id)
+    push_info = json.loads(push_info)
+    if push_info['account_id'] != account_id:
+        raise NotPresentError(
+                "Configuration push with id %s does not exist" % push_id)
+    result = GroupResult.restore(push_id, app=send_configs.app)
+    if result is None:
+        raise NotPresentError(
+                "Configuration push with id %s does not exist" % push_id)
+
+    progress = {
+        'id': push_id,
+        'state': states.PENDING,
+        'devices': push_info['devices'],
+        'sent': 0,
+        'coalesced': 0,
+        'failed': 0,
+        'failed_device_ids': []
+    }
+    chunk_states = set()
+    for chunk_result in result.results:
+        chunk_states.add(chunk_result.state)
+        info = chunk_result.info
+        if chunk_result.state == states.FAILURE:
+            continue
+        if isinstance(info, dict):
+            progress['sent'] += info.get('sent', 0)
+            progress['coalesced'] += info.get('coalesced', 0)
+            progress['failed'] += info.get('failed', 0)
+            progress['failed_device_ids'].extend(
+                    info.get('failed_device_ids', []))
+
+    unaccounted = (progress['devices'] - progress['sent'] -
+                   progress['coalesced'] - progress['failed'])
+    if all(state in states.READY_STATES for state in chunk_states):
+        progress['failed'] += unaccounted
+        progress['state'] = (states.SUCCESS if progress['failed'] == 0
+                             else states.FAILURE)
+    elif chunk_states != {states.PENDING}:
+        progress['state'] = 'PROGRESS'
+    return progress
+
+
 def get_device_configuration(device_id):
     """
     Tries to get configuration for device with given parameters.
@@ -142,21 +409,127 @@ def get_device_recordings_filtered(device_id, record_type=None,
                                        start_date, end_date)
 
 
-def get_latest_device_recording(device_id):
+def get_device_recordings_page(device_id, limit, after=None,
+                               record_type=None, start_date=None,
+                               end_date=None):
+    """
+    Tries to get one page of device recordings for device with given
+    parameters, using keyset pagination on (recorded_at, id). Raises error on
+    failure
+
+    :param device_id: Id of device
+    :param limit: Maximum number of recordings in page
+    :param after: Key of last recording of previous page, as returned by
+    previous call, None for first page
+    :param record_type: Type of recording
+    :param start_date: Lower date limit
+    :param end_date: Upper date limit
+    :type device_id: int
+    :type limit: int
+    :type after: List
+    :type record_type: int
+    :type start_date: Date (string: %d-%m-%Y)
+    :type end_date: Date (string: %d-%m-%Y)
+    :returns: Tuple (recordings, key of last recording or None if this is
+    the last page)
+    :rtype: tuple
+    :raises: ValueError if device does not exist or key is invalid
+    """
+    if not Device.exists(id=device_id):
+        raise NotPresentError("Device with id %s does not exist" % device_id)
+
+    if after is not None:
+        try:
+            after = (date_parser.parse(after[0]), int(after[1]))
+        except (TypeError, ValueError, IndexError, OverflowError):
+            raise ValueError("Invalid pagination key")
+
+    recordings = Recording.get_page_filtered(device_id, record_type,
+                                             start_date, end_date,
+                                             limit, after)
+    if len(recordings) <= limit:
+        return recordings, None
+    recordings = recordings[:limit]
+    last = recordings[-1]
+    return recordings, [last.recorded_at.isoformat(), last.id]
+
+
+def stream_device_recordings_filtered(device_id, record_type=None,
+                                      start_date=None, end_date=None,
+                                      chunk_size=1000):
+    """
+    Tries to get device recordings for device with given parameters as a
+    stream of chunks. Rows are fetched through a server-side cursor, so only
+    one chunk is held in memory at a time. Raises error on failure
+
+    :param device_id: Id of device
+    :param record_type: Type of recording
+    :param start_date: Lower date limit
+    :param end_date: Upper date limit
+    :param chunk_size: Number of recordings in each chunk
+    :type device_id: int
+    :type record_type: int
+    :type start_date: Date (string: %d-%m-%Y)
+    :type end_date: Date (string: %d-%m-%Y)
+    :type chunk_size: int
+    :returns: Generator of lists of recordings for given filters
+    :rtype: Generator of List of Recording
+    :raises: ValueError if device does not exist
+    """
+    if not Device.exists(id=device_id):
+        raise NotPresentError("Device with id %s does not exist" % device_id)
+
+    query = Recording.query_filtered(
+            device_id, record_type, start_date, end_date
+            ).execution_options(stream_results=True).yield_per(chunk_size)
+
+    def generate_chunks():
+        chunk = []
+        for row in query:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    return generate_chunks()
+
+
+def get_latest_device_recording(device_id, record_type=None):
     """
     Tries to get most recent recording for device with given parameters. Raises
     error on failure
 
     :param device_id: Id of device
+    :param record_type: Type of recording, any type if not passed
     :type device_id: int
+    :type record_type: int
     :returns: Single recording (last recording)
-    :rtpe: Recording
+    :rtpe: DeviceLatestRecording
+    :raises: ValueError if device does not exist
+    """
+    if not Device.exists(id=device_id):
+        raise NotPresentError("Device with id %s does not exist" % device_id)
+
+    return DeviceLatestRecording.get_latest(device_id, record_type)
+
+
+def get_latest_device_recordings(device_id):
+    """
+    Tries to get most recent recording of every record type for device with
+    given parameters. Raises error on failure
+
+    :param device_id: Id of device
+    :type device_id: int
+    :returns: Last recording of each record type
+    :rtpe: List of DeviceLatestRecording
     :raises: ValueError if device does not exist
     """
     if not Device.exists(id=device_id):
         raise NotPresentError("Device with id %s does not exist" % device_id)
 
-    return Recording.get_latest(device_id)
+    return DeviceLatestRecording.get_many_for_device(device_id)
 
 
 def get_device(device_id):
@@ -184,6 +557,7 @@ def reset_device_secret(device_id):
     device = Device.get(id=device_id)
     device.device_secret = token_urlsafe(32)
     device.save()
+    invalidate_device_cache(device_id)
     return device
 
 
@@ -208,22 +582,72 @@ def update_algorithm(device_id, algorithm):
     device = Device.get(id=device_id)
     device.secret_algorithm = algorithm
     device.save()
+    invalidate_device_cache(device_id)
     return device
 
 
-def can_user_access_device(account_id, device_id):
+def get_device_access_index(account_id):
+    """
+    Gets permissions of account with given id for every device it can
+    access. Index is cached for a short time and invalidated when account
+    gains or loses access to a device
+
+    :param account_id: Id of account
+    :type account_id: int
+    :returns: Dictionary of permission lists keyed by device id
+    :rtype: dict
+    """
+    return device_access_cache.get_or_load(
+            account_id, lambda: DeviceAssociation.get_access_index(account_id))
+
+
+def get_device_permissions(account_id, device_id):
+    """
+    Gets permissions of account with given id for device with given id
+
+    :returns: List of permissions or None if device is not accessible
+    :rtype: list
+    """
+    return get_device_access_index(account_id).get(device_id)
+
+
+def can_user_access_device(account_id, device_id, permission=None):
     """
     Checks if user with given account_id can access device with given device_id
 
     :param account_id: Id of account
     :param device_id: Id of device
+    :param permission: Optional permission which access level must include
     :type account_id: int
     :type device_id: int
+    :type permission: string
     :returns: true if device is accessible by this account, false otherwise
     :rtype: Boolean
     """
-    return len(DeviceAssociation.get_many(account_id=account_id,
-                                          device_id=device_id)) > 0
+    permissions = get_device_permissions(account_id, device_id)
+    if permissions is None:
+        return False
+    return permission is None or permission in permissions
+
+
+def get_accessible_device_ids(account_id, device_ids, permission=None):
+    """
+    Finds which of given devices can be accessed by user with given
+    account_id
+
+    :param account_id: Id of account
+    :param device_ids: Ids of devices
+    :param permission: Optional permission which access level must include
+    :type account_id: int
+    :type device_ids: list
+    :type permission: string
+    :returns: Ids of accessible devices
+    :rtype: set
+    """
+    access_index = get_device_access_index(account_id)
+    return set(device_id for device_id in device_ids
+               if device_id in access_index and
+               (permission is None or permission in access_index[device_id]))
 
 
 def get_device_type(device_type_id):
@@ -242,7 +666,11 @@ def delete_device(device_id):
     """
     Tries to delete device with given parameters. Does not raise errors
     """
+    account_ids = [association.account_id for association in
+                   DeviceAssociation.get_for_device(device_id)]
     Device.get(id=device_id).delete()
+    invalidate_device_cache(device_id)
+    invalidate_device_access(account_ids)
 
 
 def get_devices(account_id):
@@ -256,6 +684,28 @@ def get_devices(account_id):
     return Device.get_many_for_user(account_id)
 
 
+def get_devices_page(account_id, limit, after=None):
+    """
+    Tries to get one page of devices associated to account, using keyset
+    pagination on id. Raises error on failure
+
+    :param account_id: Id of account
+    :param limit: Maximum number of devices in page
+    :param after: Id of last device of previous page, None for first page
+    :type account_id: int
+    :type limit: int
+    :type after: int
+    :returns: Tuple (devices, id of last device or None if this is the last
+    page)
+    :rtype: tuple
+    """
+    devices = Device.get_page_for_user(account_id, limit, after)
+    if len(devices) <= limit:
+        return devices, None
+    devices = devices[:limit]
+    return devices, devices[-1].id
+
+
 def get_device_documentation(device_id):
     """
     Tries to get device documentation associated to given device.
@@ -323,7 +773,7 @@ def create_recording_and_return(device_id, raw_json,
     :type raw_json: json
     :raises: ValueError if parsing fails or device does not exist
     """
-    if not Device.exists(id=device_id):
+    if not cached_device_exists(device_id):
         raise NotPresentError("Device does not exist!")
 
     if not authenticated:
@@ -331,6 +781,7 @@ def create_recording_and_return(device_id, raw_json,
 
     recording = parse_raw_json_recording(device_id, raw_json)
     recording.save()
+    query_cache.invalidate([device_id])
     return recording
 
 
@@ -344,13 +795,35 @@ def create_recording(device_id, raw_json):
     :type raw_json: json
     :raises: ValueError if parsing fails or device does not exist
     """
-    if not Device.exists(id=device_id):
+    if not cached_device_exists(device_id):
         raise NotPresentError("Device does not exist!")
 
     validate_hmac_in_message(device_id, raw_json)
     recording = parse_raw_json_recording(device_id, raw_json)
     with app.app_context():
         recording.save()
+    query_cache.invalidate([device_id])
+
+
+def queue_recording(device_id, raw_json):
+    """
+    Validates recording with given parameters and queues it for batched
+    storing. Blocks while recording buffer is full. Raises error on failure
+
+    :param device_id: Id of device
+    :type device_id: int
+    :param raw_json: Raw json received
+    :type raw_json: json
+    :raises: ValueError if parsing fails or device does not exist
+    :raises: queue.Full if recording buffer stays full for too long
+    """
+    with app.app_context():
+        if not cached_device_exists(device_id):
+            raise NotPresentError("Device does not exist!")
+
+        validate_hmac_in_message(device_id, raw_json)
+    recording = parse_raw_json_recording(device_id, raw_json)
+    recording_buffer.put(recording.to_row())
 
 
 def create_targeted_device_sharing_token(
@@ -410,40 +883,298 @@ def activate_device_sharing_token(account_id, token):
     device_association = DeviceAssociation(device_id, account_id,
                                            access_level_id)
     device_association.save()
+    invalidate_device_access([account_id])
     return True
 
 
-def run_custom_query(device_id, request):
-    """
-    Runs custom query as defined by jsonql module
+def recording_field_provider(name):
+    if name == 'record_value':
+        return Recording.record_value
+    if name == 'record_type':
+        return Recording.record_type
+    if name == 'device_id':
+        return Recording.device_id
+    if name == 'recorded_at':
+        return Recording.recorded_at
+    if name == 'received_at':
+        return Recording.received_at
+
+
+def build_custom_query(device_id, request, many=False):
     """
-    if not Device.exists(id=device_id):
-        raise NotPresentError("Device does not exist!")
+    Builds query for custom request as defined by jsonql module, limited to
+    recordings of given device. Grouped requests which can be answered by
+    recording rollups use the coarsest such rollup instead of raw recordings
 
-    def recording_field_provider(name):
-        if name == 'record_value':
-            return Recording.record_value
-        if name == 'record_type':
-            return Recording.record_type
-        if name == 'device_id':
-            return Recording.device_id
-        if name == 'recorded_at':
-            return Recording.recorded_at
-        if name == 'received_at':
-            return Recording.received_at
+    :param device_id: Id of device, or bind parameter which provides it
+    :param many: If true, device_id is a list of device ids (or bind
+    parameter which provides it) and query is limited to all of them
+    """
+    rollup_period = choose_rollup_period(request)
+    if rollup_period is not None:
+        return build_rollup_query(device_id, rollup_period, request, many)
 
     resulting_query = jsonql.run_query_on(Recording.query.with_entities(),
                                           recording_field_provider,
                                           **request)
-    final_query = resulting_query.filter(Recording.device_id == device_id)
-    resulting_columns = final_query.column_descriptions
-    result = final_query.all()
-    formatted_result = []
-    for row in result:
-        formatted_row = {}
-        for idx, col in enumerate(row):
-            if isinstance(col, datetime.datetime):
-                col = col.replace(tzinfo=datetime.timezone.utc).isoformat()
-            formatted_row[resulting_columns[idx]['name']] = col
-        formatted_result.append(formatted_row)
-    return formatted_result
+    if many:
+        device_filter = Recording.device_id == db.any_(device_id)
+    else:
+        device_filter = Recording.device_id == device_id
+    return jsonql.fill_gaps(resulting_query.filter(device_filter), **request)
+
+
+def describe_custom_query(query, request):
+    """
+    Creates plan of built custom query
+
+    :returns: Tuple (statement, resulting column names, indexes of timestamp
+    columns, indexes of columns filled with previous values)
+    :rtype: tuple
+    """
+    descriptions = query.column_descriptions
+    column_names = [column['name'] for column in descriptions]
+    return (query.statement,
+            column_names,
+            [idx for idx, column in enumerate(descriptions)
+             if isinstance(column['type'], db.DateTime)],
+            jsonql.get_previous_fill_columns(column_names, **request))
+
+
+def get_custom_query_plan(request):
+    """
+    Gets plan for custom request as defined by jsonql module. Plan is built
+    once per distinct request and cached, with device id left as parameter
+
+    :returns: Tuple (statement, resulting column names, indexes of timestamp
+    columns, indexes of columns filled with previous values)
+    :rtype: tuple
+    :raises: ValueError if request is invalid
+    """
+    def build_plan():
+        query = build_custom_query(db.bindparam('device_id'), request)
+        return describe_custom_query(query, request)
+
+    return jsonql.get_cached_plan(request, build_plan)
+
+
+def get_device_column_request(request):
+    """
+    Extends custom request so it also returns device id of every row, by
+    grouping by device if request aggregates, or selecting it otherwise
+
+    :returns: Tuple (extended request, name of device id column)
+    :rtype: tuple
+    :raises: ValueError if parts of request are not objects
+    """
+    jsonql.validate_request_types(**request)
+    selections = request.get('selections') or {}
+    groups = request.get('groups')
+    batch_request = dict(request)
+    if groups or any(selection != 'value'
+                     for selection in selections.values()):
+        batch_request['groups'] = dict(groups or {}, device_id='value')
+        return batch_request, 'group_device_id'
+    batch_request['selections'] = dict(selections, device_id='value')
+    return batch_request, 'device_id'
+
+
+def get_custom_query_batch_plan(request):
+    """
+    Gets plan for custom request which runs for many devices at once, with
+    list of device ids left as parameter. Plan is cached like the one from
+    get_custom_query_plan
+
+    :returns: Tuple (statement, resulting column names, indexes of timestamp
+    columns, indexes of columns filled with previous values, index of
+    device id column)
+    :rtype: tuple
+    :raises: ValueError if request is invalid
+    """
+    batch_request, device_column = get_device_column_request(request)
+
+    def build_plan():
+        query = build_custom_query(db.bindparam('device_ids'),
+                                   batch_request, many=True)
+        plan = describe_custom_query(query, batch_request)
+        return plan + (plan[1].index(device_column),)
+
+    return jsonql.get_cached_plan(batch_request, build_plan, 'batch')
+
+
+def format_timestamp(value):
+    """
+    Formats naive UTC timestamp as ISO 8601 string with UTC offset
+    """
+    if value is None:
+        return None
+    return value.isoformat() + '+00:00'
+
+
+def transpose_query_rows(rows, column_count, timestamp_columns,
+                         previous_fill_columns=()):
+    """
+    Transposes fetched result rows into columns, formatting timestamp
+    columns and filling gaps in previous fill columns
+
+    :returns: List of column value lists
+    :rtype: list
+    """
+    if not rows:
+        return [[] for _ in range(column_count)]
+    columns = [list(column) for column in zip(*rows)]
+    for idx in timestamp_columns:
+        columns[idx] = list(map(format_timestamp, columns[idx]))
+    for idx in previous_fill_columns:
+        columns[idx] = jsonql.fill_previous(columns[idx])
+    return columns
+
+
+def format_query_result(column_names, columns, result_format='rows'):
+    """
+    Formats columns returned by transpose_query_rows
+
+    :param result_format: 'rows' for list of row objects or 'columns' for
+    column oriented object ({"columns": [...], "data": {...}})
+    :type result_format: string
+    """
+    if result_format == 'columns':
+        return {
+            'columns': column_names,
+            'data': dict(zip(column_names, columns))
+        }
+    return [dict(zip(column_names, row)) for row in zip(*columns)]
+
+
+def validate_result_format(result_format):
+    if result_format not in RESULT_FORMATS:
+        raise ValueError("Unknown result format: " + str(result_format))
+
+
+def run_custom_query(device_id, request, result_format='rows'):
+    """
+    Runs custom query as defined by jsonql module
+
+    :param result_format: One of RESULT_FORMATS
+    :type result_format: string
+    """
+    validate_result_format(result_format)
+    if not cached_device_exists(device_id):
+        raise NotPresentError("Device does not exist!")
+
+    (statement, column_names, timestamp_columns,
+     previous_fill_columns) = get_custom_query_plan(request)
+
+    def run_query():
+        rows = jsonql.execute_plan(statement,
+                                   {'device_id': device_id}).fetchall()
+        return transpose_query_rows(rows, len(column_names),
+                                    timestamp_columns, previous_fill_columns)
+
+    columns = query_cache.get_or_run(device_id, request, run_query)
+    return format_query_result(column_names, columns, result_format)
+
+
+def run_custom_query_many(device_ids, request, result_format='rows'):
+    """
+    Runs custom query as defined by jsonql module for each of given devices.
+    Results which are not cached are obtained with a single statement for
+    all devices, except for gap filled requests which run once per device.
+    Access to devices should be checked beforehand (see
+    get_accessible_device_ids)
+
+    :param device_ids: Ids of devices
+    :type device_ids: list
+    :param result_format: One of RESULT_FORMATS
+    :type result_format: string
+    :returns: Dictionary of results keyed by device id
+    :rtype: dict
+    """
+    validate_result_format(result_format)
+    device_ids = list(OrderedDict.fromkeys(device_ids))
+    if jsonql.get_gap_filled_group(request.get('groups')) is not None:
+        return {device_id: run_custom_query(device_id, request,
+                                            result_format)
+                for device_id in device_ids}
+
+    (statement, column_names, timestamp_columns, previous_fill_columns,
+     device_column) = get_custom_query_batch_plan(request)
+    result_columns = [name for idx, name in enumerate(column_names)
+                      if idx != device_column]
+
+    def run_query(missing_ids):
+        device_rows = {device_id: [] for device_id in missing_ids}
+        rows = jsonql.execute_plan(statement, {'device_ids': missing_ids})
+        for row in rows:
+            device_rows[row[device_column]].append(row)
+        results = {}
+        for device_id, rows in device_rows.items():
+            columns = transpose_query_rows(rows, len(column_names),
+                                           timestamp_columns,
+                                           previous_fill_columns)
+            del columns[device_column]
+            results[device_id] = columns
+        return results
+
+    results = query_cache.get_or_run_many(device_ids, request, run_query)
+    return {device_id: format_query_result(result_columns,
+                                           results[device_id],
+                                           result_format)
+            for device_id in device_ids}
+
+
+def run_custom_queries(queries, result_format='rows'):
+    """
+    Runs many custom queries as defined by jsonql module, each for its own
+    device. Devices which share the same request are queried together using
+    run_custom_query_many. Access to devices should be checked beforehand
+
+    :param queries: List of tuples (device_id, request)
+    :type queries: list
+    :param result_format: One of RESULT_FORMATS
+    :type result_format: string
+    :returns: List of results in order of queries. Every result is either
+    {'content': result} or {'error': message} if its request is invalid or
+    its query failed. Failure of one query does not affect the others
+    :rtype: list
+    """
+    validate_result_format(result_format)
+    requests = OrderedDict()
+    for device_id, request in queries:
+        request_key = jsonql.get_request_key(request)
+        if request_key not in requests:
+            requests[request_key] = (request, [])
+        requests[request_key][1].append(device_id)
+
+    results = {}
+    for request_key, (request, device_ids) in requests.items():
+        try:
+            device_results = run_custom_query_many(device_ids, request,
+                                                   result_format)
+        except ValueError as e:
+            device_results = {device_id: e for device_id in device_ids}
+        except SQLAlchemyError:
+            # Failed query aborts transaction, which is rolled back so
+            # queries of other groups can still run
+            db.session.rollback()
+            print_api_error("Custom query failed")
+            error = ValueError('Query failed')
+            device_results = {device_id: error for device_id in device_ids}
+        for device_id, result in device_results.items():
+            results[(device_id, request_key)] = result
+
+    formatted_results = []
+    for device_id, request in queries:
+        result = results[(device_id, jsonql.get_request_key(request))]
+        if isinstance(result, ValueError):
+            formatted_results.append({'error': str(result)})
+        else:
+            formatted_results.append({'content': result})
+    return formatted_results
+
+
+def print_api_error(message):
+    print("ERROR! " + message)
+    error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
@@ -1,16 +1,37 @@
-import time
 from datetime import datetime
 import datetime as datetime_module
-from app.core import db
-from sqlalchemy.dialects.postgresql import JSON
+from app.core import db, model_cache
+from app.cache import get_cached_instance
+from flask import request, has_request_context
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.postgresql import JSON, insert
 from secrets import token_urlsafe
 
 
+def is_first_default_page():
+    """
+    Checks if paginate would return first page of default size, which is
+    when current request does not pass page and per_page arguments
+    """
+    return (not has_request_context() or
+            ('page' not in request.args and 'per_page' not in request.args))
+
+
 class Recording(db.Model):
     __tablename__ = 'recordings'
+    __table_args__ = (
+        # Both also include remaining columns selected by API (see
+        # migrations), to allow index-only scans
+        db.Index('ix_recordings_device_type_recorded_at',
+                 'device_id', 'record_type', 'recorded_at'),
+        db.Index('ix_recordings_device_recorded_at',
+                 'device_id', 'recorded_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    recorded_at = db.Column(db.DateTime, index=True,
+    # Table is partitioned by recorded_at, which is why it is part of the key
+    recorded_at = db.Column(db.DateTime, index=True, primary_key=True,
+                            nullable=False,
                             default=db.func.current_timestamp())
     received_at = db.Column(db.DateTime, index=True,
                             default=db.func.current_timestamp())
@@ -30,17 +51,54 @@ class Recording(db.Model):
 
     def save(self):
         """
-        Stores this recording to database
+        Stores this recording to database, updating latest recordings of its
+        device
         This may raise errors
         """
         db.session.add(self)
+        DeviceLatestRecording.upsert_rows([self.to_row()])
+        RecordingRollup.upsert_rows([self.to_row()])
         db.session.commit()
 
     def delete(self):
         """
-        Deletes this recording from database
+        Deletes this recording from database, rebuilding rollups which
+        contained it
         """
         db.session.delete(self)
+        db.session.flush()
+        RecordingRollup.rebuild_buckets(self.device_id, self.record_type,
+                                        self.recorded_at)
+        db.session.commit()
+
+    def to_row(self):
+        """
+        Returns column values of this recording as a dict, suitable for bulk
+        inserts
+        """
+        return {
+            'device_id': self.device_id,
+            'record_type': self.record_type,
+            'record_value': self.record_value,
+            'recorded_at': self.recorded_at,
+            'received_at': self.received_at,
+            'raw_record': self.raw_record
+        }
+
+    @staticmethod
+    def bulk_save(rows):
+        """
+        Stores many recordings to database in a single transaction, using
+        executemany of a single insert statement. Latest recordings and
+        rollups of devices are updated in the same transaction
+        This may raise errors
+
+        :param rows: Column values of recordings (as returned by to_row)
+        :type rows: List of dict
+        """
+        db.session.execute(Recording.__table__.insert(), rows)
+        DeviceLatestRecording.upsert_rows(rows)
+        RecordingRollup.upsert_rows(rows)
         db.session.commit()
 
     @staticmethod
@@ -65,31 +123,71 @@ class Recording(db.Model):
         return Recording.query.filter_by(**kwargs).all()
 
     @staticmethod
-    def get_many_filtered(device_id, record_type, date_start, date_end):
+    def query_filtered(device_id, record_type, date_start, date_end):
         """
-        Get many recording with given filters as a list
+        Builds query of recordings with given filters
 
         Available filters:
          * record_type
          * recorded_at (upper and lower limit)
+
+        Date limits are compared as plain timestamps, so only partitions
+        of the requested months are scanned. Only columns covered by
+        ix_recordings_device_type_recorded_at are selected, which allows
+        index-only scans
         """
-        query = Recording.query.filter(Recording.device_id == device_id)
+        query = Recording.query.with_entities(
+                Recording.recorded_at,
+                Recording.record_type,
+                Recording.record_value
+                ).filter(Recording.device_id == device_id)
         if record_type is not None:
             query = query.filter(Recording.record_type == record_type)
         if date_start is not None:
-            lower_limit = time.mktime(datetime.strptime(date_start,
-                                      "%d-%m-%Y").timetuple())
-            query = query.filter(Recording.recorded_at >
-                                 db.func.to_timestamp(lower_limit))
+            lower_limit = datetime.strptime(date_start, "%d-%m-%Y")
+            query = query.filter(Recording.recorded_at > lower_limit)
         if date_end is not None:
-            upper_limit = time.mktime(
-                    (datetime.strptime(
-                        date_end,
-                        "%d-%m-%Y"
-                        )+datetime_module.timedelta(days=1)).timetuple())
-            query = query.filter(Recording.recorded_at <
-                                 db.func.to_timestamp(upper_limit))
-        return query.all()
+            upper_limit = (datetime.strptime(date_end, "%d-%m-%Y") +
+                           datetime_module.timedelta(days=1))
+            query = query.filter(Recording.recorded_at < upper_limit)
+        return query
+
+    @staticmethod
+    def get_many_filtered(device_id, record_type, date_start, date_end):
+        """
+        Get many recording with given filters as a list of
+        (recorded_at, record_type, record_value) rows
+
+        Available filters:
+         * record_type
+         * recorded_at (upper and lower limit)
+        """
+        return Recording.query_filtered(device_id, record_type,
+                                        date_start, date_end).all()
+
+    @staticmethod
+    def get_page_filtered(device_id, record_type, date_start, date_end,
+                          limit, after=None):
+        """
+        Get one page of recordings with given filters, ordered by
+        (recorded_at, id). Page starts right after given key, so the cost of
+        query depends only on page size
+
+        :param limit: Maximum number of recordings returned
+        :param after: Tuple (recorded_at, id) of last recording of previous
+        page, None for first page
+        :returns: List of (recorded_at, record_type, record_value, id) rows,
+        with one row more than limit if there are more pages
+        """
+        query = Recording.query_filtered(
+                device_id, record_type, date_start, date_end
+                ).add_columns(Recording.id)
+        if after is not None:
+            query = query.filter(
+                    db.tuple_(Recording.recorded_at, Recording.id) >
+                    db.tuple_(after[0], after[1]))
+        return query.order_by(Recording.recorded_at, Recording.id).limit(
+                limit + 1).all()
 
     @staticmethod
     def get(**kwargs):
@@ -108,20 +206,278 @@ class Recording(db.Model):
         """
         return Recording.query.filter_by(**kwargs).first_or_404()
 
+    def __repr__(self):
+        return '<Recording (value=%s, recorded_at=%s)>' % (
+            self.record_value, self.recorded_at)
+
+
+class DeviceLatestRecording(db.Model):
+    """
+    Latest recording of each record type of each device, maintained while
+    recordings are stored
+    """
+    __tablename__ = 'device_latest_recordings'
+
+    device_id = db.Column(db.Integer,
+                          db.ForeignKey('devices.id', ondelete='CASCADE'),
+                          primary_key=True)
+    record_type = db.Column(db.Integer, primary_key=True)
+    recorded_at = db.Column(db.DateTime, nullable=False)
+    received_at = db.Column(db.DateTime, nullable=True)
+    record_value = db.Column(db.Float, nullable=False)
+
+    @staticmethod
+    def get_latest_rows(rows):
+        """
+        Finds newest of given recording rows per device and record type
+
+        :param rows: Column values of recordings (as returned by
+        Recording.to_row)
+        :type rows: List of dict
+        :returns: Latest recording rows, sorted by device and record type
+        :rtype: List of dict
+        """
+        latest = {}
+        for row in rows:
+            key = (row['device_id'], row['record_type'])
+            if (key not in latest or
+                    latest[key]['recorded_at'] <= row['recorded_at']):
+                latest[key] = row
+        return [
+            {
+                'device_id': latest[key]['device_id'],
+                'record_type': latest[key]['record_type'],
+                'recorded_at': latest[key]['recorded_at'],
+                'received_at': latest[key]['received_at'],
+                'record_value': latest[key]['record_value']
+            } for key in sorted(latest.keys())]
+
+    @staticmethod
+    def upsert_rows(rows):
+        """
+        Updates latest recordings with given recording rows, keeping the
+        newest recording per device and record type. Changes are not
+        committed, so this can be a part of recording transaction
+
+        :param rows: Column values of recordings (as returned by
+        Recording.to_row)
+        :type rows: List of dict
+        """
+        latest_rows = DeviceLatestRecording.get_latest_rows(rows)
+        if not latest_rows:
+            return
+
+        statement = insert(DeviceLatestRecording.__table__)
+        statement = statement.on_conflict_do_update(
+                index_elements=['device_id', 'record_type'],
+                set_={
+                    'recorded_at': statement.excluded.recorded_at,
+                    'received_at': statement.excluded.received_at,
+                    'record_value': statement.excluded.record_value
+                },
+                where=(DeviceLatestRecording.__table__.c.recorded_at <=
+                       statement.excluded.recorded_at))
+        # Sorted to always lock rows in the same order
+        db.session.execute(statement, latest_rows)
+
     @staticmethod
-    def get_latest(device_id):
+    def get_many_for_device(device_id):
         """
-        Get latest recording for device with id device_id
+        Get latest recording of every record type of device with given id
         """
-        return Recording.query.order_by('recorded_at desc').first_or_404()
+        return DeviceLatestRecording.query.filter(
+                DeviceLatestRecording.device_id == device_id
+                ).order_by(DeviceLatestRecording.record_type).all()
+
+    @staticmethod
+    def get_latest(device_id, record_type=None):
+        """
+        Get latest recording for device with id device_id, optionally of given
+        record type only
+        """
+        query = DeviceLatestRecording.query.filter(
+                DeviceLatestRecording.device_id == device_id)
+        if record_type is not None:
+            query = query.filter(
+                    DeviceLatestRecording.record_type == record_type)
+        return query.order_by(
+                DeviceLatestRecording.recorded_at.desc()).first_or_404()
 
     def __repr__(self):
-        return '<Recording (value=%s, recorded_at=%s)>' % (
-            self.record_value, self.recorded_at)
+        return '<DeviceLatestRecording (device_id=%s, record_type=%s)>' % (
+            self.device_id, self.record_type)
+
+
+class RecordingRollup(db.Model):
+    """
+    Aggregates of recordings of each device and record type, in minute, hour
+    and day buckets of recorded_at, maintained while recordings are stored
+    and deleted (see also partitions.detach_partition)
+    """
+    __tablename__ = 'recording_rollups'
+
+    PERIODS = ['minute', 'hour', 'day']
+    PERIOD_LENGTHS = {
+        'minute': datetime_module.timedelta(minutes=1),
+        'hour': datetime_module.timedelta(hours=1),
+        'day': datetime_module.timedelta(days=1)
+    }
+
+    device_id = db.Column(db.Integer,
+                          db.ForeignKey('devices.id', ondelete='CASCADE'),
+                          primary_key=True)
+    record_type = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String, primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    sum = db.Column(db.Float, nullable=False)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+
+    @staticmethod
+    def truncate(recorded_at, period):
+        """
+        Returns start of bucket of given period which contains recorded_at
+        """
+        if period == 'minute':
+            return recorded_at.replace(second=0, microsecond=0)
+        if period == 'hour':
+            return recorded_at.replace(minute=0, second=0, microsecond=0)
+        if period == 'day':
+            return recorded_at.replace(hour=0, minute=0, second=0,
+                                       microsecond=0)
+        raise ValueError("Invalid rollup period (" + str(period) + ")")
+
+    @staticmethod
+    def get_bucket_rows(rows):
+        """
+        Aggregates given recording rows into buckets of every period
+
+        :param rows: Column values of recordings (as returned by
+        Recording.to_row)
+        :type rows: List of dict
+        :returns: Rollup rows, sorted by their primary key
+        :rtype: List of dict
+        """
+        buckets = {}
+        for row in rows:
+            value = row['record_value']
+            for period in RecordingRollup.PERIODS:
+                key = (row['device_id'], row['record_type'], period,
+                       RecordingRollup.truncate(row['recorded_at'], period))
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = {
+                        'device_id': key[0],
+                        'record_type': key[1],
+                        'period': key[2],
+                        'bucket_start': key[3],
+                        'count': 1,
+                        'sum': value,
+                        'min': value,
+                        'max': value
+                    }
+                else:
+                    bucket['count'] += 1
+                    bucket['sum'] += value
+                    bucket['min'] = min(bucket['min'], value)
+                    bucket['max'] = max(bucket['max'], value)
+        return [buckets[key] for key in sorted(buckets.keys())]
+
+    @staticmethod
+    def upsert_rows(rows):
+        """
+        Adds given recording rows to rollups of every period. Changes are not
+        committed, so this can be a part of recording transaction
+
+        :param rows: Column values of recordings (as returned by
+        Recording.to_row)
+        :type rows: List of dict
+        """
+        bucket_rows = RecordingRollup.get_bucket_rows(rows)
+        if not bucket_rows:
+            return
+
+        table = RecordingRollup.__table__
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+                index_elements=['device_id', 'record_type',
+                                'period', 'bucket_start'],
+                set_={
+                    'count': table.c.count + statement.excluded.count,
+                    'sum': table.c.sum + statement.excluded.sum,
+                    'min': db.func.least(table.c.min, statement.excluded.min),
+                    'max': db.func.greatest(table.c.max,
+                                            statement.excluded.max)
+                })
+        # Sorted to always lock rows in the same order
+        db.session.execute(statement, bucket_rows)
+
+    @staticmethod
+    def rebuild_buckets(device_id, record_type, recorded_at):
+        """
+        Recomputes buckets of every period which contain given moment from
+        stored recordings. Needed when recordings are removed, since minimum
+        and maximum can not be decremented. Changes are not committed
+
+        :param device_id: Id of device
+        :param record_type: Record type of rebuilt buckets
+        :param recorded_at: Moment contained in rebuilt buckets
+        :type recorded_at: datetime
+        """
+        table = RecordingRollup.__table__
+        # Sorted by primary key, like in upsert_rows
+        for period in sorted(RecordingRollup.PERIODS):
+            bucket_start = RecordingRollup.truncate(recorded_at, period)
+            bucket_end = bucket_start + RecordingRollup.PERIOD_LENGTHS[period]
+            RecordingRollup.query.filter(
+                    RecordingRollup.device_id == device_id,
+                    RecordingRollup.record_type == record_type,
+                    RecordingRollup.period == period,
+                    RecordingRollup.bucket_start == bucket_start
+                    ).delete(synchronize_session=False)
+            # Grouped, so empty buckets produce no row
+            aggregates = Recording.query.with_entities(
+                    Recording.device_id,
+                    Recording.record_type,
+                    db.literal(period),
+                    db.literal(bucket_start),
+                    db.func.count(),
+                    db.func.sum(Recording.record_value),
+                    db.func.min(Recording.record_value),
+                    db.func.max(Recording.record_value)
+                    ).filter(
+                    Recording.device_id == device_id,
+                    Recording.record_type == record_type,
+                    Recording.recorded_at >= bucket_start,
+                    Recording.recorded_at < bucket_end
+                    ).group_by(Recording.device_id, Recording.record_type)
+            db.session.execute(table.insert().from_select(
+                    ['device_id', 'record_type', 'period', 'bucket_start',
+                     'count', 'sum', 'min', 'max'],
+                    aggregates.statement))
+
+    @staticmethod
+    def delete_range(start, end):
+        """
+        Deletes buckets of all devices which start in given range, e.g.
+        when recordings of that range are removed. Range should be aligned
+        to days. Changes are not committed
+        """
+        RecordingRollup.query.filter(
+                RecordingRollup.bucket_start >= start,
+                RecordingRollup.bucket_start < end
+                ).delete(synchronize_session=False)
+
+    def __repr__(self):
+        return '<RecordingRollup (device_id=%s, period=%s, start=%s)>' % (
+            self.device_id, self.period, self.bucket_start)
 
 
 class Device(db.Model):
     __tablename__ = 'devices'
+    # Never stored in shared model cache
+    UNCACHED_COLUMNS = ('device_secret',)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     created_at = db.Column(db.DateTime,
@@ -142,6 +498,13 @@ class Device(db.Model):
                             cascade="save-update, merge, delete")
     recordings = db.relationship("Recording",
                                  cascade="save-update, merge, delete")
+    # Rows of these are deleted by database cascade, without loading them
+    latest_recordings = db.relationship("DeviceLatestRecording",
+                                        cascade="save-update, merge, delete",
+                                        passive_deletes=True)
+    recording_rollups = db.relationship("RecordingRollup",
+                                        cascade="save-update, merge, delete",
+                                        passive_deletes=True)
     widgets = db.relationship("DashboardWidget",
                               cascade="save-update, merge, delete")
     documentations = db.relationship("DeviceDocumentation",
@@ -161,13 +524,16 @@ class Device(db.Model):
         """
         db.session.add(self)
         db.session.commit()
+        model_cache.invalidate('device:%s' % self.id)
 
     def delete(self):
         """
         Deletes this recording from database
         """
+        device_id = self.id
         db.session.delete(self)
         db.session.commit()
+        model_cache.invalidate('device:%s' % device_id)
 
     @staticmethod
     def get_many(**kwargs):
@@ -191,10 +557,28 @@ class Device(db.Model):
         """
         Get many devices which are associated to account
         """
-        return Device.query.filter(
+        return Device.query.options(
+                joinedload(Device.device_type)
+                ).filter(
                 Device.users.any(account_id=account_id)
                 ).paginate(None, None, False).items
 
+    @staticmethod
+    def get_page_for_user(account_id, limit, after=None):
+        """
+        Get one page of devices which are associated to account, ordered by
+        id and starting after device with id passed in after
+
+        :returns: List of devices, with one device more than limit if there
+        are more pages
+        """
+        query = Device.query.options(
+                joinedload(Device.device_type)
+                ).filter(Device.users.any(account_id=account_id))
+        if after is not None:
+            query = query.filter(Device.id > after)
+        return query.order_by(Device.id).limit(limit + 1).all()
+
     @staticmethod
     def get(**kwargs):
         """
@@ -208,7 +592,13 @@ class Device(db.Model):
          * modified_at
          * configuration (useless)
 
+        Devices fetched by id only are cached
         """
+        if list(kwargs.keys()) == ['id']:
+            return get_cached_instance(
+                    model_cache, Device, 'device:%s' % kwargs['id'],
+                    lambda: Device.query.filter_by(**kwargs).first_or_404(),
+                    db.session, Device.UNCACHED_COLUMNS)
         return Device.query.filter_by(**kwargs).first_or_404()
 
     @staticmethod
@@ -220,6 +610,63 @@ class Device(db.Model):
             return True
         return False
 
+    @staticmethod
+    def set_configuration_many(device_ids, configuration,
+                               device_type_id=None):
+        """
+        Sets configuration of all devices with given ids in a single
+        transaction, optionally only of those with given device type
+
+        :returns: List of (id, device_secret, secret_algorithm) rows of
+        updated devices
+        :rtype: list
+        """
+        query = Device.query.filter(Device.id.in_(list(device_ids)))
+        if device_type_id is not None:
+            query = query.filter(Device.device_type_id == device_type_id)
+        rows = query.with_entities(
+                Device.id,
+                Device.device_secret,
+                Device.secret_algorithm
+                ).with_for_update().all()
+        if rows:
+            Device.query.filter(
+                    Device.id.in_([row.id for row in rows])
+                    ).update({'configuration': configuration},
+                             synchronize_session=False)
+        db.session.commit()
+        model_cache.invalidate_many('device:%s' % row.id for row in rows)
+        return rows
+
+    @staticmethod
+    def get_secret_info(device_id):
+        """
+        Get device secret and secret algorithm of device with given id,
+        without loading the rest of the device
+
+        :returns: Tuple (device_secret, secret_algorithm) or None if device
+        does not exist
+        """
+        return Device.query.with_entities(
+                Device.device_secret,
+                Device.secret_algorithm
+                ).filter(Device.id == device_id).first()
+
+    @staticmethod
+    def get_secret_infos(device_ids):
+        """
+        Get device secrets and secret algorithms of devices with given ids
+
+        :returns: List of (id, device_secret, secret_algorithm) rows of
+        existing devices
+        :rtype: list
+        """
+        return Device.query.with_entities(
+                Device.id,
+                Device.device_secret,
+                Device.secret_algorithm
+                ).filter(Device.id.in_(list(device_ids))).all()
+
     def __repr__(self):
         return '<Device (name=%s, type=%s)>' % (
             self.name, self.device_type_id)
@@ -285,6 +732,24 @@ class DeviceAssociation(db.Model):
         """
         return DeviceAssociation.get_many(device_id=device_id)
 
+    @staticmethod
+    def get_access_index(account_id):
+        """
+        Get permissions of account with given id for every device associated
+        to it, using a single query
+
+        :returns: Dictionary of permission lists keyed by device id
+        :rtype: dict
+        """
+        return {row.device_id: list(row.permissions) for row in
+                DeviceAssociation.query.with_entities(
+                    DeviceAssociation.device_id,
+                    AccessLevel.permissions
+                    ).join(
+                    AccessLevel,
+                    AccessLevel.id == DeviceAssociation.access_level
+                    ).filter(DeviceAssociation.account_id == account_id)}
+
     def __repr__(self):
         return '<DeviceAssociation (device_id=%s, accoount_id=%s)>' % (
                 self.device_id, self.account_id)
@@ -313,6 +778,7 @@ class DeviceType(db.Model):
         """
         db.session.add(self)
         db.session.commit()
+        model_cache.invalidate('device-types')
 
     @staticmethod
     def get_many(**kwargs):
@@ -322,9 +788,17 @@ class DeviceType(db.Model):
         Available filters:
          * id
          * name
+
+        Unfiltered first page of default size is cached
         """
-        return DeviceType.query.filter_by(**kwargs).paginate(
-                None, None, False).items
+        if kwargs or not is_first_default_page():
+            return DeviceType.query.filter_by(**kwargs).paginate(
+                    None, None, False).items
+
+        return get_cached_instance(
+                model_cache, DeviceType, 'device-types',
+                lambda: DeviceType.query.paginate(None, None, False).items,
+                db.session)
 
     @staticmethod
     def get(**kwargs):
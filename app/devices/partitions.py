@@ -0,0 +1,182 @@
+import re
+import datetime
+from sqlalchemy import text
+from app.core import db
+from .models import RecordingRollup
+
+PARENT_TABLE = 'recordings'
+DEFAULT_PARTITION = 'recordings_default'
+PARTITION_NAME_FORMAT = 'recordings_p%04d_%02d'
+PARTITION_NAME_PATTERN = re.compile(r'^recordings_p(\d{4})_(\d{2})$')
+# Key of advisory lock which serializes partition changes
+PARTITION_LOCK_KEY = 7202601
+
+
+def lock_partitions():
+    """
+    Takes advisory lock held until end of current transaction, so only one
+    process changes partitions at a time
+    """
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"),
+                       {'key': PARTITION_LOCK_KEY})
+
+
+def table_exists(name):
+    return db.session.execute(text("SELECT to_regclass(:name) IS NOT NULL"),
+                              {'name': name}).scalar()
+
+
+def month_start(date):
+    """
+    Returns first moment of the month of given date
+    """
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def add_months(date, months):
+    """
+    Returns first moment of the month which is given number of months after
+    month of given date
+    """
+    month_index = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(start):
+    return PARTITION_NAME_FORMAT % (start.year, start.month)
+
+
+def get_partitions():
+    """
+    Gets monthly partitions currently attached to recordings table
+
+    :returns: Dict of partition name to start of its month
+    :rtype: dict
+    """
+    result = db.session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :parent"), {'parent': PARENT_TABLE})
+    partitions = {}
+    for (name,) in result:
+        match = PARTITION_NAME_PATTERN.match(name)
+        if match:
+            partitions[name] = datetime.datetime(int(match.group(1)),
+                                                 int(match.group(2)), 1)
+    return partitions
+
+
+def create_partition(start):
+    """
+    Creates monthly partition starting at given month. Recordings of that
+    month which already ended up in default partition are moved to the new
+    partition
+
+    :returns: Name of created partition, or None if it already exists
+    :rtype: string
+    """
+    start = month_start(start)
+    end = add_months(start, 1)
+    name = partition_name(start)
+    bounds = {'start': start, 'end': end}
+
+    lock_partitions()
+    if table_exists(name):
+        db.session.commit()
+        return None
+
+    has_default_rows = db.session.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM " + DEFAULT_PARTITION + " "
+        "WHERE recorded_at >= :start AND recorded_at < :end)"),
+        bounds).scalar()
+
+    if has_default_rows:
+        db.session.execute(text(
+            "ALTER TABLE " + PARENT_TABLE + " DETACH PARTITION " +
+            DEFAULT_PARTITION))
+    db.session.execute(text(
+        "CREATE TABLE " + name + " PARTITION OF " + PARENT_TABLE + " "
+        "FOR VALUES FROM ('" + start.isoformat() + "') "
+        "TO ('" + end.isoformat() + "')"))
+    if has_default_rows:
+        db.session.execute(text(
+            "INSERT INTO " + PARENT_TABLE + " SELECT * FROM " +
+            DEFAULT_PARTITION + " "
+            "WHERE recorded_at >= :start AND recorded_at < :end"), bounds)
+        db.session.execute(text(
+            "DELETE FROM " + DEFAULT_PARTITION + " "
+            "WHERE recorded_at >= :start AND recorded_at < :end"), bounds)
+        db.session.execute(text(
+            "ALTER TABLE " + PARENT_TABLE + " ATTACH PARTITION " +
+            DEFAULT_PARTITION + " DEFAULT"))
+    db.session.commit()
+    return name
+
+
+def detach_partition(name, drop=False):
+    """
+    Detaches partition with given name from recordings table, and optionally
+    drops it. Rollups of its month are deleted with it, so they never include
+    recordings which are no longer in recordings table
+
+    :returns: True if partition was detached, False if it already was
+    :rtype: Boolean
+    """
+    match = PARTITION_NAME_PATTERN.match(name)
+    if match is None:
+        raise ValueError("Invalid partition name (" + name + ")")
+    start = datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+
+    lock_partitions()
+    if name not in get_partitions():
+        db.session.commit()
+        return False
+
+    db.session.execute(text(
+        "ALTER TABLE " + PARENT_TABLE + " DETACH PARTITION " + name))
+    RecordingRollup.delete_range(start, add_months(start, 1))
+    if drop:
+        db.session.execute(text("DROP TABLE " + name))
+    db.session.commit()
+    return True
+
+
+def manage_partitions(precreate_months, retention_months=None,
+                      drop_expired=False, now=None):
+    """
+    Makes sure partitions for current month and given number of future months
+    exist, and detaches (or drops) partitions older than retention period.
+    Changes are serialized by advisory lock, and partitions changed by a
+    concurrent run are skipped, so running it more than once is safe
+
+    :param precreate_months: Number of future months to create partitions for
+    :param retention_months: Number of past months to keep, None to keep all
+    :param drop_expired: Whether expired partitions are dropped or only
+    detached
+    :type precreate_months: int
+    :type retention_months: int
+    :type drop_expired: Boolean
+    :returns: Tuple (created partition names, expired partition names)
+    :rtype: tuple
+    """
+    current_month = month_start(now or datetime.datetime.utcnow())
+    partitions = get_partitions()
+
+    created = []
+    for offset in range(precreate_months + 1):
+        start = add_months(current_month, offset)
+        if partition_name(start) not in partitions:
+            name = create_partition(start)
+            if name is not None:
+                created.append(name)
+
+    expired = []
+    if retention_months is not None:
+        cutoff = add_months(current_month, -retention_months)
+        for name, start in sorted(partitions.items()):
+            if (add_months(start, 1) <= cutoff and
+                    detach_partition(name, drop_expired)):
+                expired.append(name)
+
+    return created, expired
@@ -0,0 +1,111 @@
+import sys
+from app.cache import LRUCache
+from app.jsonql import api as jsonql
+
+VERSION_KEY_FORMAT = 'recordings-version:%s'
+_MISSING = object()
+
+
+class RecordingQueryCache:
+    """
+    Caches results of jsonql queries on recordings, keyed by device and
+    normalised request. Results are kept in process, while every device has
+    a recordings version counter in Redis, which is incremented whenever new
+    recordings of the device are stored (by any process). Version is part of
+    the key, so cached results of a device are invalidated everywhere at once
+
+    If Redis is not available queries bypass the cache
+
+    :param redis_client: Redis client used for version counters
+    :param max_size: Maximum number of cached results
+    :param ttl: Number of seconds after which result expires
+    """
+
+    def __init__(self, redis_client, max_size, ttl):
+        self.redis_client = redis_client
+        self.results = LRUCache(max_size, ttl)
+
+    def get_version(self, device_id):
+        """
+        Returns current recordings version of given device
+
+        :raises: redis.RedisError if Redis is not available
+        """
+        version = self.redis_client.get(VERSION_KEY_FORMAT % device_id)
+        return int(version) if version is not None else 0
+
+    def get_or_run(self, device_id, request, runner):
+        """
+        Returns cached result of request for given device, or runs the query
+        using runner and caches its result
+
+        :param runner: Function without arguments which runs the query
+        :type runner: func()
+        """
+        try:
+            version = self.get_version(device_id)
+        except Exception:
+            print_error("Recording query cache unavailable")
+            return runner()
+        key = (device_id, version, jsonql.get_request_key(request))
+        return self.results.get_or_load(key, runner)
+
+    def get_or_run_many(self, device_ids, request, runner):
+        """
+        Returns results of request for each of given devices. Results which
+        are not cached are produced by single runner call and cached
+
+        :param runner: Function which runs the query for list of device ids
+        and returns dictionary of results keyed by device id
+        :type runner: func(device_ids:list)
+        :returns: Dictionary of results keyed by device id
+        :rtype: dict
+        """
+        device_ids = list(device_ids)
+        try:
+            versions = self.redis_client.mget(
+                    [VERSION_KEY_FORMAT % device_id
+                     for device_id in device_ids])
+        except Exception:
+            print_error("Recording query cache unavailable")
+            return runner(device_ids)
+
+        request_key = jsonql.get_request_key(request)
+        keys = {}
+        results = {}
+        for device_id, version in zip(device_ids, versions):
+            version = int(version) if version is not None else 0
+            keys[device_id] = (device_id, version, request_key)
+            result = self.results.get(keys[device_id], _MISSING)
+            if result is not _MISSING:
+                results[device_id] = result
+
+        missing_ids = [device_id for device_id in device_ids
+                       if device_id not in results]
+        if missing_ids:
+            for device_id, result in runner(missing_ids).items():
+                self.results.set(keys[device_id], result)
+                results[device_id] = result
+        return results
+
+    def invalidate(self, device_ids):
+        """
+        Invalidates cached results of given devices, in all processes
+        """
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for device_id in set(device_ids):
+                pipeline.incr(VERSION_KEY_FORMAT % device_id)
+            pipeline.execute()
+        except Exception:
+            print_error("Failed to invalidate recording query cache")
+
+    def stats(self):
+        return self.results.stats()
+
+
+def print_error(message):
+    print("ERROR! " + message)
+    error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
@@ -0,0 +1,75 @@
+import json
+from app.core import db
+from .models import Recording
+from .api import build_custom_query
+
+SAMPLE_QUERIES = {
+    'filtered_recordings': lambda device_id: Recording.query_filtered(
+        device_id, 1, '01-01-2018', '31-01-2018'),
+    'grouped_custom_query': lambda device_id: build_custom_query(
+        device_id, {
+            'selections': {'record_value': 'avg'},
+            'filters': {
+                'record_type': {'$eq': 1},
+                'recorded_at': {'$gt': '2018-01-01', '$lt': '2018-02-01'}
+            },
+            'groups': {'recorded_at': 'day'}
+        }),
+    'plain_custom_query': lambda device_id: build_custom_query(
+        device_id, {
+            'selections': {'recorded_at': 'value', 'record_value': 'value'},
+            'filters': {'record_type': {'$eq': 1}}
+        })
+}
+
+
+def explain(query):
+    """
+    Returns JSON execution plan of given query, as chosen with sequential
+    scans disabled. If a sequential scan still shows up, there is no index
+    which could be used instead
+    """
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + str(compiled),
+                       compiled.params)
+        plan = cursor.fetchone()[0]
+        connection.rollback()
+    finally:
+        connection.close()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def find_sequential_scans(plan):
+    """
+    Returns names of recording tables scanned sequentially in given plan
+    """
+    scans = []
+    if (plan.get('Node Type') == 'Seq Scan' and
+            plan.get('Relation Name', '').startswith('recordings')):
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        scans.extend(find_sequential_scans(child))
+    return scans
+
+
+def check_recording_plans(device_id):
+    """
+    Explains sample recording queries and reports those which would use
+    sequential scans of recordings
+
+    :returns: Dict of query name to list of sequentially scanned tables,
+    containing only queries with sequential scans
+    :rtype: dict
+    """
+    failures = {}
+    for name, build_query in SAMPLE_QUERIES.items():
+        scans = find_sequential_scans(explain(build_query(device_id)))
+        if scans:
+            failures[name] = scans
+    return failures
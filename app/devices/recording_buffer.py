@@ -0,0 +1,194 @@
+import sys
+import time
+import queue
+import threading
+from sqlalchemy.exc import (IntegrityError, DataError, OperationalError,
+                            InterfaceError)
+from app.core import app, db
+from .models import Recording
+
+
+class RecordingBuffer:
+    """
+    In-memory buffer placed between message handlers and the database.
+    Recordings are collected in a bounded queue and written by a single
+    background thread, many rows per transaction.
+
+    A batch is flushed when it reaches batch_size or when its oldest recording
+    has waited for flush_interval seconds, whichever comes first.
+
+    Failed flushes are retried with exponential backoff (starting at
+    retry_backoff seconds) up to retries times when the error is transient,
+    such as a lost connection. When rows violate constraints (for example
+    device was deleted), batch is split until the offending rows are found,
+    so only they are dropped.
+
+    Optional on_flush function is called with rows of every stored batch.
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval, put_timeout,
+                 on_flush=None, retries=0, retry_backoff=1.0):
+        self.on_flush = on_flush
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.flush_count = 0
+        self.flushed_recordings = 0
+        self.failed_recordings = 0
+        self.last_flush_size = 0
+        self.last_flush_latency = None
+        self.__thread = None
+        self.__stop_event = threading.Event()
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts background flushing thread if it is not already running
+        """
+        with self.__lock:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stop_event.clear()
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='recording-buffer',
+                                             daemon=True)
+            self.__thread.start()
+        print('Recording buffer started')
+
+    def stop(self):
+        """
+        Stops background flushing thread, writing everything still buffered
+        """
+        with self.__lock:
+            if self.__thread is None:
+                return
+            self.__stop_event.set()
+            self.__thread.join()
+            self.__thread = None
+        print('Recording buffer stopped')
+
+    def put(self, row):
+        """
+        Adds recording row to buffer. Blocks while buffer is full, which slows
+        down producers to the rate database can keep up with
+
+        :param row: Column values of recording (as returned by
+        Recording.to_row)
+        :type row: dict
+        :raises: queue.Full if buffer stayed full for put_timeout seconds
+        """
+        self.queue.put(row, timeout=self.put_timeout)
+
+    def stats(self):
+        """
+        Returns current buffer statistics
+
+        :rtype: dict
+        """
+        return {
+            'queued': self.queue.qsize(),
+            'flushes': self.flush_count,
+            'flushed_recordings': self.flushed_recordings,
+            'failed_recordings': self.failed_recordings,
+            'last_flush_size': self.last_flush_size,
+            'last_flush_latency': self.last_flush_latency
+        }
+
+    def __run(self):
+        while not self.__stop_event.is_set() or not self.queue.empty():
+            batch = self.__collect_batch()
+            if batch:
+                self.__flush(batch)
+
+    def __collect_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.__stop_event.is_set():
+                remaining = 0
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def __flush(self, batch):
+        started_at = time.perf_counter()
+        stored = self.__store(batch, 0)
+        latency = time.perf_counter() - started_at
+        if not stored:
+            return
+        if self.on_flush is not None:
+            self.on_flush(stored)
+
+        self.flush_count += 1
+        self.flushed_recordings += len(stored)
+        self.last_flush_size = len(stored)
+        self.last_flush_latency = latency
+        print('Flushed %d recordings in %.2f ms (%d queued)' % (
+            len(stored), latency * 1000, self.queue.qsize()))
+
+    def __store(self, batch, attempt):
+        # Returns stored rows. Transient errors are retried with backoff,
+        # while batches with rows which violate constraints are split in
+        # halves until the offending rows are found
+        with app.app_context():
+            try:
+                Recording.bulk_save(batch)
+                return batch
+            except (IntegrityError, DataError) as e:
+                db.session.rollback()
+                error, transient = e, False
+            except (OperationalError, InterfaceError) as e:
+                db.session.rollback()
+                error, transient = e, True
+            except Exception:
+                db.session.rollback()
+                self.failed_recordings += len(batch)
+                print_buffer_error("Failed to flush " + str(len(batch)) +
+                                   " recordings")
+                return []
+
+        if transient:
+            if attempt >= self.retries:
+                self.failed_recordings += len(batch)
+                print_buffer_error("Failed to flush " + str(len(batch)) +
+                                   " recordings", error)
+                return []
+            backoff = self.retry_backoff * 2 ** attempt
+            print("ERROR! Failed to flush recordings, retrying in " +
+                  str(backoff) + " seconds")
+            time.sleep(backoff)
+            return self.__store(batch, attempt + 1)
+
+        if len(batch) == 1:
+            self.failed_recordings += 1
+            print_buffer_error("Failed to store recording of device " +
+                               str(batch[0]['device_id']), error)
+            return []
+        middle = len(batch) // 2
+        return (self.__store(batch[:middle], attempt) +
+                self.__store(batch[middle:], attempt))
+
+
+def print_buffer_error(message, error=None):
+    # Error is passed when it is reported after its except clause, where
+    # sys.exc_info no longer has it
+    print("ERROR! " + message)
+    if error is not None:
+        error_type, error_instance = type(error), error
+    else:
+        error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
@@ -0,0 +1,131 @@
+from dateutil import parser as date_parser
+from app.core import db
+from app.jsonql import api as jsonql
+from .models import RecordingRollup
+
+# Finest rollup period which can still answer a group by given period
+GROUP_PERIODS = {
+    'minute': 'minute',
+    'hour': 'hour',
+    'day': 'day',
+    'week': 'day',
+    'month': 'day',
+    'year': 'day'
+}
+# Rollup periods from coarsest to finest
+ROLLUP_PERIODS = ['day', 'hour', 'minute']
+ROLLUP_AGGREGATES = ['sum', 'avg', 'count', 'min', 'max']
+# Columns which are never null in recordings of queried device, so their
+# count is the number of recordings kept in rollups
+ROLLUP_COUNT_COLUMNS = ['record_value', 'record_type', 'device_id',
+                        'recorded_at']
+# Filters which keep the same meaning on bucket starts, if aligned to buckets
+ROLLUP_TIME_FILTERS = ['$gte', '$lt']
+
+
+def rollup_field_provider(name):
+    if name == 'record_type':
+        return RecordingRollup.record_type
+    if name == 'device_id':
+        return RecordingRollup.device_id
+    if name == 'recorded_at':
+        return RecordingRollup.bucket_start
+
+
+def rollup_aggregate_provider(selection_name, column_name):
+    if selection_name == 'count':
+        return db.func.sum(RecordingRollup.count)
+    if selection_name == 'sum':
+        return db.func.sum(RecordingRollup.sum)
+    if selection_name == 'avg':
+        return (db.func.sum(RecordingRollup.sum) /
+                db.func.sum(RecordingRollup.count))
+    if selection_name == 'min':
+        return db.func.min(RecordingRollup.min)
+    if selection_name == 'max':
+        return db.func.max(RecordingRollup.max)
+
+
+def is_aligned(value, period):
+    try:
+        moment = date_parser.parse(str(value))
+    except (ValueError, OverflowError):
+        return False
+    if moment.tzinfo is not None:
+        return False
+    return RecordingRollup.truncate(moment, period) == moment
+
+
+def choose_rollup_period(request):
+    """
+    Finds coarsest rollup period which gives exactly the same result for
+    given jsonql request as raw recordings would
+
+    :param request: jsonql request
+    :type request: dict
+    :returns: Rollup period or None if request must run on raw recordings
+    :rtype: string
+    :raises: ValueError if parts of request are not objects
+    """
+    jsonql.validate_request_types(**request)
+    selections = request.get('selections') or {}
+    filters = request.get('filters') or {}
+    groups = request.get('groups') or {}
+    if not groups or not selections:
+        return None
+
+    candidates = list(ROLLUP_PERIODS)
+    for column, group in groups.items():
+        if column in ['record_type', 'device_id'] and group == 'value':
+            continue
+        if (column != 'recorded_at' or not isinstance(group, str) or
+                group not in GROUP_PERIODS):
+            return None
+        finest_allowed = ROLLUP_PERIODS.index(GROUP_PERIODS[group])
+        candidates = [period for period in candidates
+                      if ROLLUP_PERIODS.index(period) >= finest_allowed]
+
+    for column, selection in selections.items():
+        if (not isinstance(selection, str) or
+                selection not in ROLLUP_AGGREGATES):
+            return None
+        if column != 'record_value' and (
+                selection != 'count' or column not in ROLLUP_COUNT_COLUMNS):
+            return None
+
+    for column, column_filters in filters.items():
+        if column in ['record_type', 'device_id']:
+            continue
+        if column != 'recorded_at':
+            return None
+        for filter_key, filter_value in column_filters.items():
+            if filter_key not in ROLLUP_TIME_FILTERS:
+                return None
+            candidates = [period for period in candidates
+                          if is_aligned(filter_value, period)]
+
+    if not candidates:
+        return None
+    return candidates[0]
+
+
+def build_rollup_query(device_id, period, request, many=False):
+    """
+    Builds query for jsonql request on rollups of given period, limited to
+    given device
+
+    :param many: If true, device_id is a list of device ids (or bind
+    parameter which provides it) and query is limited to all of them
+    """
+    resulting_query = jsonql.run_query_on(
+            RecordingRollup.query.with_entities(),
+            rollup_field_provider,
+            rollup_aggregate_provider,
+            **request)
+    if many:
+        device_filter = RecordingRollup.device_id == db.any_(device_id)
+    else:
+        device_filter = RecordingRollup.device_id == device_id
+    return resulting_query.filter(
+            device_filter,
+            RecordingRollup.period == period)
@@ -1,40 +1,197 @@
-import sys
-from app.celery_builder import task_builder
+import time
+import redis
+from celery.signals import worker_process_init, worker_process_shutdown
+from app.celery_builder import task_builder, app as worker_app
+from app.mqtt.delivery import ConfigurationVersions
+from app.mqtt.publisher import get_publisher, stop_publisher
 from flask import current_app as app
 
+configuration_versions = ConfigurationVersions(
+        redis.StrictRedis.from_url(worker_app.config['REDIS_URL']))
 
-def connect_and_send_mqtt_message(topic, message):
-    from flask_mqtt import Mqtt, MQTT_ERR_SUCCESS
-    mqtt = Mqtt(app)
 
-    @mqtt.on_log()
-    def handle_logging(client, userdata, level, buf):
-        print(level, buf)
+@worker_process_init.connect
+def start_mqtt_publisher(**kwargs):
+    get_publisher(worker_app.config)
 
-    @mqtt.on_connect()
-    def handle_connect(client, userdata, flags, rc):
-        print('MQTT worker client connected')
-        print("Targeting topic: " + topic)
-        print("Sending message: " + message)
+
+@worker_process_shutdown.connect
+def stop_mqtt_publisher(**kwargs):
+    stop_publisher()
+
+
+def get_config_topic(device_id):
+    return 'device/' + str(device_id) + '/config'
+
+
+def get_retry_countdown(retries):
+    return min(app.config['MQTT_PUBLISHER_MIN_BACKOFF'] * 2 ** retries,
+               app.config['MQTT_PUBLISHER_MAX_BACKOFF'])
+
+
+def wait_for_deliveries(tracker, deliveries, on_round=None):
+    """
+    Waits for deliveries in rounds of MQTT_DELIVERY_TIMEOUT seconds, for at
+    most MQTT_DELIVERY_MAX_WAIT seconds. Messages which are not acknowledged
+    stay queued in paho, which sends them again after reconnecting, so they
+    are waited for rather than published again. Deliveries which still
+    are not completed are abandoned
+
+    :param on_round: Optional function called after every round
+    :returns: Abandoned deliveries
+    :rtype: list
+    """
+    round_timeout = app.config['MQTT_DELIVERY_TIMEOUT']
+    deadline = time.monotonic() + app.config['MQTT_DELIVERY_MAX_WAIT']
+    pending = tracker.wait(deliveries, round_timeout)
+    while pending and time.monotonic() < deadline:
+        print("Waiting for " + str(len(pending)) + " unacknowledged "
+              "configurations")
+        if on_round is not None:
+            on_round()
+        pending = tracker.wait(
+                pending, min(round_timeout, deadline - time.monotonic()))
+    tracker.abandon(pending)
+    return pending
+
+
+@task_builder.task(bind=True,
+                   max_retries=worker_app.config['MQTT_PUBLISH_MAX_RETRIES'])
+def send_config(self, device_id, config, version=None):
+    """
+    Publishes configuration to device and waits until broker acknowledges
+    it. Publish is retried with backoff if broker is unreachable, and
+    skipped if device has got a newer configuration in the meantime.
+    Message which was queued is never published again, see
+    wait_for_deliveries
+    """
+    if device_id in configuration_versions.get_superseded(
+            {device_id: version}):
+        print("Configuration " + str(version) + " of device " +
+              str(device_id) + " was superseded, skipping")
+        return
+    print("Sending configuration to device: " + str(device_id))
+    publisher = get_publisher(app.config)
+    try:
+        delivery = publisher.publish(
+                get_config_topic(device_id), config, 2,
+                app.config['MQTT_RETAIN_CONFIGURATION'], device_id)
+    except ConnectionError as e:
+        print("ERROR! Failed to send configuration: " + str(e))
+        raise self.retry(exc=e,
+                         countdown=get_retry_countdown(self.request.retries))
+
+    if wait_for_deliveries(publisher.tracker, [delivery]):
+        print("ERROR! Configuration of device " + str(device_id) +
+              " was not acknowledged (message id: " + str(delivery.mid) +
+              ")")
+        raise TimeoutError('MQTT publish was not acknowledged')
+    print("Configuration delivered to device %s in %.2f ms" % (
+        device_id, delivery.latency * 1000))
+
+
+@task_builder.task(bind=True,
+                   max_retries=worker_app.config['MQTT_PUBLISH_MAX_RETRIES'])
+def send_configs(self, messages, total=None, sent=0, coalesced=0,
+                 unacknowledged=None):
+    """
+    Publishes chunk of configuration messages over the shared connection
+    and waits until broker acknowledges them, reporting progress in task
+    state every CONFIGURATION_PUSH_PROGRESS_STEP messages. Messages whose
+    device has got a newer configuration are skipped as coalesced.
+    Messages which paho dropped are retried with backoff, until retries
+    run out and their devices are reported as failed. Queued messages are
+    never published again, those not acknowledged in time are reported as
+    failed (see wait_for_deliveries)
+
+    :param messages: List of (device_id, signed configuration, version)
+    :param total: Number of messages in original chunk
+    :param sent: Number of messages acknowledged in previous attempts
+    :param coalesced: Number of messages skipped in previous attempts
+    :param unacknowledged: Ids of devices whose messages were not
+    acknowledged in previous attempts
+    :returns: Dictionary with total, sent, coalesced and failed counts and
+    ids of devices which did not receive configuration
+    :rtype: dict
+    """
+    total = len(messages) if total is None else total
+    unacknowledged = list(unacknowledged or [])
+    superseded = configuration_versions.get_superseded(
+            {device_id: version for device_id, config, version in messages})
+    coalesced += len(superseded)
+    messages = [message for message in messages
+                if message[0] not in superseded]
+
+    progress_step = app.config['CONFIGURATION_PUSH_PROGRESS_STEP']
+    publisher = get_publisher(app.config)
+    deliveries = []
+    unpublished = []
+
+    def report_progress():
+        self.update_state(state='PROGRESS', meta={
+            'total': total,
+            'sent': sent + sum(1 for message, delivery in deliveries
+                               if delivery.completed.is_set()),
+            'coalesced': coalesced,
+            'failed': len(unacknowledged)
+        })
+
+    for index, message in enumerate(messages):
+        device_id, config, version = message
         try:
-            (result, mid) = mqtt.publish(topic, message, 2)
-            if (result == MQTT_ERR_SUCCESS):
-                print("Successfully sent a message")
-            print("Result: " + str(result))
-            print("Message id: " + str(mid))
-            mqtt.client.disconnect()
-        except Exception:
-            print("ERROR!")
-            error_type, error_instance, traceback = sys.exc_info()
-            print("Type: " + str(error_type))
-            print("Instance: " + str(error_instance))
-            mqtt.client.disconnect()
-            return
+            deliveries.append((message, publisher.publish(
+                    get_config_topic(device_id), config, 2,
+                    app.config['MQTT_RETAIN_CONFIGURATION'], device_id)))
+        except ConnectionError as e:
+            print("ERROR! Failed to send configurations: " + str(e))
+            unpublished = messages[index:]
+            break
+        if (index + 1) % progress_step == 0:
+            report_progress()
+
+    abandoned = set(wait_for_deliveries(
+            publisher.tracker,
+            [delivery for message, delivery in deliveries],
+            report_progress))
+    sent += len(deliveries) - len(abandoned)
+    unacknowledged += [message[0] for message, delivery in deliveries
+                       if delivery in abandoned]
+
+    if unpublished and self.request.retries < self.max_retries:
+        print("ERROR! " + str(len(unpublished)) + " configurations were not "
+              "published, retrying")
+        raise self.retry(
+                args=(unpublished,),
+                kwargs={'total': total, 'sent': sent,
+                        'coalesced': coalesced,
+                        'unacknowledged': unacknowledged},
+                countdown=get_retry_countdown(self.request.retries))
+    failed_device_ids = (unacknowledged +
+                         [message[0] for message in unpublished])
+    if failed_device_ids:
+        print("ERROR! Failed to send configurations to " +
+              str(len(failed_device_ids)) + " devices")
+    print("Configuration sent to " + str(sent) + " devices, " +
+          str(coalesced) + " coalesced")
+    stats = publisher.tracker.stats()
+    if stats['average_latency'] is not None:
+        print("Average delivery latency: %.2f ms" % (
+            stats['average_latency'] * 1000))
+    return {
+        'total': total,
+        'sent': sent,
+        'coalesced': coalesced,
+        'failed': len(failed_device_ids),
+        'failed_device_ids': failed_device_ids
+    }
 
 
 @task_builder.task()
-def send_config(device_id, config):
-    print("Sending configuration to device: " + str(device_id))
-    print("Configuration: " + str(config))
-    topic = 'device/' + str(device_id) + '/config'
-    connect_and_send_mqtt_message(topic, config)
+def manage_recording_partitions():
+    from .partitions import manage_partitions
+    created, expired = manage_partitions(
+            app.config['RECORDING_PARTITION_PRECREATE_MONTHS'],
+            app.config['RECORDING_RETENTION_MONTHS'],
+            app.config['RECORDING_DROP_EXPIRED_PARTITIONS'])
+    print("Created recording partitions: " + str(created))
+    print("Expired recording partitions: " + str(expired))
@@ -1,12 +1,106 @@
-from app.core import db
+import re
+import json
+import numbers
+from dateutil import parser as date_parser
+from sqlalchemy import util
+from sqlalchemy.dialects.postgresql import (array_agg, aggregate_order_by,
+                                            INTERVAL)
+from app.core import app, db
+from app.cache import LRUCache
 
-GROUPS = ['sum', 'avg', 'count']
-FILTERS = ['$gt', '$lt', '$eq']
+GROUPS = ['sum', 'avg', 'count', 'min', 'max', 'stddev', 'first', 'last']
+# Aggregates which take parameters, used as {"percentile": 0.95}
+PARAMETRISED_GROUPS = ['percentile']
+# Groups which take parameters, used as
+# {"histogram": {"min": 0, "max": 100, "buckets": 10}} or
+# {"bucket": "5 minutes", "fill": null}
+PARAMETRISED_PERIODS = ['histogram', 'bucket']
+# Optional keys of parametrised groups besides their parameters
+PARAMETRISED_PERIOD_OPTIONS = {'histogram': [], 'bucket': ['fill']}
+# Gap filling modes of bucket group, None fills empty buckets with null
+BUCKET_FILLS = [None, 'previous']
+# Length in seconds of bucket units which can be used with any count
+BUCKET_UNITS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 604800
+}
+# Bucket units which can only be used with count 1
+CALENDAR_BUCKET_UNITS = ['month', 'year']
+# Epoch is on Thursday, week buckets are shifted to start on Monday
+BUCKET_OFFSETS = {'week': 4 * 86400}
+BUCKET_PATTERN = re.compile(r'^\s*(\d+)\s+([a-z]+?)s?\s*$')
+# Field which determines order of values for first and last aggregates
+SEQUENCE_FIELD = 'recorded_at'
+FILTERS = ['$gt', '$lt', '$eq', '$gte', '$lte']
 PERIODS = ['year', 'month', 'week', 'day', 'hour', 'minute', 'second']
 ORDERS = ['asc', 'desc']
 
+# Statements built from requests, keyed by normalised request
+plan_cache = LRUCache(app.config['JSONQL_PLAN_CACHE_SIZE'],
+                      app.config['JSONQL_PLAN_CACHE_TTL'])
+# SQL compiled from cached statements
+compiled_cache = util.LRUCache(app.config['JSONQL_PLAN_CACHE_SIZE'])
 
-def run_query_on(query_object, field_provider, **kwargs):
+
+def get_request_key(request):
+    """
+    Normalises request into canonical string key. Key order is ignored,
+    except for orders, where it changes the meaning of request
+    """
+    normalised = dict(request)
+    if normalised.get('orders') is not None:
+        normalised['orders'] = list(normalised['orders'].items())
+    return json.dumps(normalised, sort_keys=True, separators=(',', ':'),
+                      default=str)
+
+
+def get_cached_plan(request, plan_builder, variant=None):
+    """
+    Returns plan for given request, building it with plan_builder only if
+    the same request was not seen before. Validation and query building are
+    done by plan_builder, so they are skipped for cached requests
+
+    :param request: jsonql request
+    :type request: dict
+    :param plan_builder: Function which builds plan (for example statement
+    with parameters left unbound)
+    :type plan_builder: func()
+    :param variant: Optional name of plan kind, for requests which are
+    planned in more than one way
+    :type variant: string
+    """
+    return plan_cache.get_or_load((variant, get_request_key(request)),
+                                  plan_builder)
+
+
+def execute_plan(statement, params):
+    """
+    Executes statement from cached plan in current session. SQL compiled
+    from statement is cached as well, so repeated executions skip
+    compilation
+
+    :param params: Values of bind parameters left in statement
+    :type params: dict
+    """
+    connection = db.session.connection().execution_options(
+            compiled_cache=compiled_cache)
+    return connection.execute(statement, params)
+
+
+def get_plan_cache_stats():
+    """
+    Returns statistics of plan cache, including its hit rate
+
+    :rtype: dict
+    """
+    return plan_cache.stats()
+
+
+def run_query_on(query_object, field_provider, aggregate_provider=None,
+                 **kwargs):
     """
     Generates a query for target object based on query provided as kwargs
 
@@ -17,6 +111,10 @@ def run_query_on(query_object, field_provider, **kwargs):
     optional parameter formatted which returns the field formatted using sql
     functions
     :type field_provider: func(col_name:String, formatted:Boolean)
+    :param aggregate_provider: Optional function which provides selected
+    columns based on selection and column name, for targets which store
+    pre-aggregated data. Returning None falls back to default columns
+    :type aggregate_provider: func(selection_name:String, col_name:String)
     """
     selections, filters, groups, orderings = validate_selections(**kwargs)
     entities = []
@@ -34,8 +132,14 @@ def run_query_on(query_object, field_provider, **kwargs):
                             )
 
         for selection in selections.keys():
-            entities.append(get_column(selections[selection],
-                            field_provider(selection)).label(selection))
+            column = None
+            if aggregate_provider is not None:
+                column = aggregate_provider(selections[selection], selection)
+            if column is None:
+                column = get_column(selections[selection],
+                                    field_provider(selection),
+                                    field_provider)
+            entities.append(column.label(selection))
 
         query_object = query_object.with_entities(*entities)
 
@@ -68,7 +172,9 @@ def run_query_on(query_object, field_provider, **kwargs):
     return query_object
 
 
-def get_column(selection_name, field):
+def get_column(selection_name, field, field_provider=None):
+    if isinstance(selection_name, dict):
+        return get_parametrised_column(selection_name, field)
     if selection_name == 'value':
         return field
     if selection_name == 'sum':
@@ -77,6 +183,23 @@ def get_column(selection_name, field):
         return db.func.avg(field)
     if selection_name == 'count':
         return db.func.count(field)
+    if selection_name == 'min':
+        return db.func.min(field)
+    if selection_name == 'max':
+        return db.func.max(field)
+    if selection_name == 'stddev':
+        return db.func.stddev_samp(field)
+    if selection_name in ['first', 'last']:
+        sequence_field = field_provider(SEQUENCE_FIELD)
+        if selection_name == 'last':
+            sequence_field = sequence_field.desc()
+        return array_agg(aggregate_order_by(field, sequence_field))[1]
+
+
+def get_parametrised_column(selection, field):
+    (selection_name, parameter), = selection.items()
+    if selection_name == 'percentile':
+        return db.func.percentile_cont(parameter).within_group(field)
 
 
 def get_filter(filter_column, filter_key, filter_value):
@@ -86,9 +209,15 @@ def get_filter(filter_column, filter_key, filter_value):
         return filter_column < filter_value
     if filter_key == '$eq':
         return filter_column == filter_value
+    if filter_key == '$gte':
+        return filter_column >= filter_value
+    if filter_key == '$lte':
+        return filter_column <= filter_value
 
 
 def get_group(group_column, group_value):
+    if isinstance(group_value, dict):
+        return get_parametrised_group(group_column, group_value)
     if group_value == 'value':
         return group_column
     if group_value in PERIODS:
@@ -97,11 +226,319 @@ def get_group(group_column, group_value):
     return db.func.to_char(group_column, group_value)
 
 
+def get_parametrised_group_name(group):
+    for group_name in PARAMETRISED_PERIODS:
+        if group_name in group:
+            return group_name
+
+
+def get_parametrised_group(group_column, group):
+    group_name = get_parametrised_group_name(group)
+    parameters = group[group_name]
+    if group_name == 'histogram':
+        # Bucket number, 0 and buckets + 1 are used for values out of range
+        return db.func.width_bucket(group_column,
+                                    parameters['min'],
+                                    parameters['max'],
+                                    int(parameters['buckets']))
+    if group_name == 'bucket':
+        return get_bucket(group_column, parameters)
+
+
+def parse_bucket(width):
+    """
+    Parses bucket width, such as "5 minutes" or "1 month"
+
+    :returns: Tuple (count, unit)
+    :rtype: tuple
+    :raises: ValueError if width is invalid
+    """
+    match = BUCKET_PATTERN.match(str(width).lower())
+    if match is None:
+        raise ValueError("Invalid bucket (" + str(width) + "). " +
+                         "Expected format is <count> <unit>")
+    count, unit = int(match.group(1)), match.group(2)
+    if count < 1:
+        raise ValueError("Bucket count must be a positive integer!")
+    if unit in CALENDAR_BUCKET_UNITS:
+        if count != 1:
+            raise ValueError("Only single " + unit + " buckets are " +
+                             "supported!")
+    elif unit not in BUCKET_UNITS:
+        raise ValueError("Invalid bucket unit (" + unit + "). Valid units: " +
+                         str(sorted(BUCKET_UNITS) + CALENDAR_BUCKET_UNITS))
+    return count, unit
+
+
+def get_bucket(column, width):
+    """
+    Returns start of bucket of given width in which timestamp column falls.
+    Single unit buckets are truncated timestamps, while others are counted
+    from epoch, so every bucket has the same length
+    """
+    count, unit = parse_bucket(width)
+    if count == 1:
+        return db.func.date_trunc(unit, column, type_=db.DateTime)
+    seconds = count * BUCKET_UNITS[unit]
+    offset = BUCKET_OFFSETS.get(unit, 0)
+    bucket_epoch = db.func.floor(
+            (db.extract('epoch', column) - offset) / seconds
+            ) * seconds + offset
+    return db.func.to_timestamp(bucket_epoch).op(
+            'AT TIME ZONE', return_type=db.DateTime)('UTC')
+
+
+def get_bucket_interval(width):
+    count, unit = parse_bucket(width)
+    return db.cast('%d %s' % (count, unit), INTERVAL)
+
+
+def get_gap_filled_group(groups):
+    """
+    Returns name of bucket group which should be gap filled or None
+    """
+    if groups is None:
+        return None
+    for key, group in groups.items():
+        if (isinstance(group, dict) and
+                get_parametrised_group_name(group) == 'bucket' and
+                'fill' in group):
+            return key
+
+
+def get_bucket_bound_value(column_filters, lower):
+    """
+    Returns value of filter which bounds bucketed column from below or
+    above, parsed the way Postgres casts it to timestamp, or None if filters
+    do not limit it
+
+    :raises: ValueError if filter value is not a timestamp
+    """
+    bound_filters = ['$gte', '$gt'] if lower else ['$lte', '$lt']
+    for filter_key in bound_filters:
+        if filter_key not in column_filters:
+            continue
+        try:
+            bound = date_parser.parse(str(column_filters[filter_key]))
+        except (ValueError, OverflowError):
+            raise ValueError("Invalid timestamp (" +
+                             str(column_filters[filter_key]) + ")")
+        # Casting to timestamp without time zone ignores the offset
+        return bound.replace(tzinfo=None)
+
+
+def get_min_bucket_seconds(width):
+    """
+    Returns shortest possible length of bucket of given width in seconds
+    """
+    count, unit = parse_bucket(width)
+    if unit == 'month':
+        return 28 * 86400
+    if unit == 'year':
+        return 365 * 86400
+    return count * BUCKET_UNITS[unit]
+
+
+def validate_filled_bucket_count(column_filters, width):
+    """
+    Checks that series of filled buckets spanning filtered range is not
+    longer than JSONQL_MAX_FILLED_BUCKETS
+
+    :raises: ValueError if there would be too many buckets
+    """
+    lower = get_bucket_bound_value(column_filters, True)
+    upper = get_bucket_bound_value(column_filters, False)
+    if lower is None or upper is None:
+        return
+    max_buckets = app.config['JSONQL_MAX_FILLED_BUCKETS']
+    bucket_count = ((upper - lower).total_seconds() //
+                    get_min_bucket_seconds(width)) + 1
+    if bucket_count > max_buckets:
+        raise ValueError("Too many buckets to fill (" +
+                         str(int(bucket_count)) + "), at most " +
+                         str(max_buckets) + " are allowed. Use wider " +
+                         "buckets or narrower filters")
+
+
+def get_bucket_bound(column_filters, width, lower):
+    """
+    Returns first or last bucket of series based on filters of the bucketed
+    column, or None if filters do not limit it
+    """
+    bound_filters = ['$gte', '$gt'] if lower else ['$lte', '$lt']
+    for filter_key in bound_filters:
+        if filter_key not in column_filters:
+            continue
+        bound = db.cast(column_filters[filter_key], db.DateTime)
+        if filter_key == '$lt':
+            bound = bound - db.cast('1 microsecond', INTERVAL)
+        return get_bucket(bound, width)
+
+
+def fill_gaps(query_object, **kwargs):
+    """
+    Adds empty buckets to query generated by run_query_on, if it groups by
+    bucket with fill option. Should be applied once all filters are added to
+    query. Series of buckets spans filtered range of bucketed column, or
+    range of returned buckets if filters do not limit it. Series is never
+    longer than JSONQL_MAX_FILLED_BUCKETS: filtered ranges which need more
+    buckets are rejected, while ranges of returned buckets are cut off.
+    Empty buckets have null selections, filling them with previous values
+    is done on results using fill_previous
+
+    :param query_object: Query generated by run_query_on
+    :type query_object: Query
+    :returns: Query with the same columns
+    :raises: ValueError if filtered range needs too many buckets
+    """
+    groups = kwargs.get('groups')
+    group = get_gap_filled_group(groups)
+    if group is None:
+        return query_object
+
+    selections = kwargs.get('selections')
+    column_filters = (kwargs.get('filters') or {}).get(group) or {}
+    orderings = kwargs.get('orders')
+    label = 'group_' + str(group)
+    width = groups[group]['bucket']
+
+    validate_filled_bucket_count(column_filters, width)
+    interval = get_bucket_interval(width)
+    max_span = interval * (app.config['JSONQL_MAX_FILLED_BUCKETS'] - 1)
+    data = query_object.cte('data')
+    first_bucket = get_bucket_bound(column_filters, width, True)
+    last_bucket = get_bucket_bound(column_filters, width, False)
+    if first_bucket is None and last_bucket is None:
+        first_bucket = db.session.query(
+                db.func.min(data.c[label])).as_scalar()
+    if first_bucket is None:
+        first_bucket = db.func.greatest(
+                db.session.query(db.func.min(data.c[label])).as_scalar(),
+                last_bucket - max_span)
+    if last_bucket is None:
+        last_bucket = db.func.least(
+                db.session.query(db.func.max(data.c[label])).as_scalar(),
+                first_bucket + max_span)
+    series = db.session.query(
+            db.func.generate_series(first_bucket, last_bucket, interval,
+                                    type_=db.DateTime).label(label)
+            ).subquery('series')
+
+    query_object = db.session.query(
+            series.c[label].label(label),
+            *[data.c[selection].label(selection)
+              for selection in selections.keys()]
+            ).select_from(
+                    series.outerjoin(data, data.c[label] == series.c[label]))
+    if orderings is not None:
+        for order in orderings.keys():
+            query_object = query_object.order_by(
+                    order + ' ' + orderings[order])
+    else:
+        query_object = query_object.order_by(series.c[label])
+    return query_object
+
+
+def get_previous_fill_columns(column_names, **kwargs):
+    """
+    Returns indexes of columns which should be filled with previous values,
+    if request groups by bucket with previous fill
+    """
+    groups = kwargs.get('groups')
+    group = get_gap_filled_group(groups)
+    if group is None or groups[group]['fill'] != 'previous':
+        return []
+    selections = kwargs.get('selections') or {}
+    return [idx for idx, name in enumerate(column_names)
+            if name in selections]
+
+
+def fill_previous(values):
+    """
+    Replaces null values in column with closest previous non null value
+    """
+    previous = None
+    filled = []
+    for value in values:
+        if value is None:
+            value = previous
+        else:
+            previous = value
+        filled.append(value)
+    return filled
+
+
+def is_number(value):
+    return (isinstance(value, numbers.Real) and
+            not isinstance(value, bool))
+
+
+def validate_parametrised_selection(selection):
+    if len(selection) != 1:
+        raise ValueError("Invalid selection (" + str(selection) + "). " +
+                         "Must contain exactly one of " +
+                         str(PARAMETRISED_GROUPS))
+    (selection_name, parameter), = selection.items()
+    if selection_name not in PARAMETRISED_GROUPS:
+        raise ValueError("Invalid selection (" + str(selection_name) +
+                         "). Valid parametrised selections: " +
+                         str(PARAMETRISED_GROUPS))
+    if selection_name == 'percentile':
+        if not is_number(parameter) or not 0 <= parameter <= 1:
+            raise ValueError("Percentile must be a number between 0 and 1!")
+
+
+def validate_parametrised_group(group):
+    group_name = get_parametrised_group_name(group)
+    if group_name is None:
+        raise ValueError("Invalid group (" + str(group) + "). " +
+                         "Valid parametrised groups: " +
+                         str(PARAMETRISED_PERIODS))
+    for key in group.keys():
+        if (key != group_name and
+                key not in PARAMETRISED_PERIOD_OPTIONS[group_name]):
+            raise ValueError("Invalid option (" + str(key) + ") of " +
+                             group_name + " group")
+    parameters = group[group_name]
+    if group_name == 'histogram':
+        if not isinstance(parameters, dict):
+            raise ValueError("Histogram requires min, max and buckets!")
+        for key in ['min', 'max', 'buckets']:
+            if not is_number(parameters.get(key)):
+                raise ValueError("Histogram " + key + " must be a number!")
+        if parameters['min'] >= parameters['max']:
+            raise ValueError("Histogram min must be lower than max!")
+        if (not float(parameters['buckets']).is_integer() or
+                parameters['buckets'] < 1):
+            raise ValueError("Histogram buckets must be a positive " +
+                             "integer!")
+    if group_name == 'bucket':
+        parse_bucket(parameters)
+        if group.get('fill') not in BUCKET_FILLS:
+            raise ValueError("Invalid fill (" + str(group.get('fill')) +
+                             "). Valid fills: " + str(BUCKET_FILLS))
+
+
 def is_group(**kwargs):
     if kwargs.get('group') is not None:
         return True
 
 
+def validate_request_types(**kwargs):
+    """
+    Checks that parts of request which are given are objects, so they can
+    be inspected before the rest of request is validated
+    """
+    for key in ['selections', 'filters', 'groups', 'orders']:
+        if kwargs.get(key) is not None and not isinstance(kwargs[key], dict):
+            raise ValueError("Invalid " + key + " (" + str(kwargs[key]) +
+                             "). Must be an object!")
+    for column_filters in (kwargs.get('filters') or {}).values():
+        if not isinstance(column_filters, dict):
+            raise ValueError("Invalid filter (" + str(column_filters) +
+                             "). Must be an object!")
+
+
 def validate_selections(**kwargs):
     selections = kwargs.get('selections')
     filters = kwargs.get('filters')
@@ -110,13 +547,32 @@ def validate_selections(**kwargs):
 
     if selections is None:
         raise ValueError("Missing selections!")
+    validate_request_types(**kwargs)
+
+    for key in selections.keys():
+        if isinstance(selections[key], dict):
+            validate_parametrised_selection(selections[key])
+        elif selections[key] != 'value' and selections[key] not in GROUPS:
+            raise ValueError("Invalid selection (" + str(
+                selections[key]) + "). Valid selections: " +
+                str(['value'] + GROUPS + PARAMETRISED_GROUPS))
 
     if is_group(**kwargs):
         for key in selections.keys():
-            if selections[key] not in GROUPS:
+            if (not isinstance(selections[key], dict) and
+                    selections[key] not in GROUPS):
                 raise ValueError("Can only use " + str(GROUPS) + " when " +
                                  "grouping!")
 
+    if groups is not None:
+        for key in groups.keys():
+            if isinstance(groups[key], dict):
+                validate_parametrised_group(groups[key])
+        gap_filled_group = get_gap_filled_group(groups)
+        if gap_filled_group is not None and len(groups) > 1:
+            raise ValueError("Gap filling is only supported when grouping " +
+                             "by bucket alone!")
+
     if filters is not None:
         for key in filters.keys():
             for inner_key in filters[key].keys():
@@ -0,0 +1,444 @@
+import re
+import sys
+import hmac
+import json
+import time
+import signal
+import asyncio
+import asyncpg
+from asyncpg.exceptions import (IntegrityConstraintViolationError, DataError,
+                                PostgresConnectionError, InterfaceError)
+from gmqtt import Client
+from gmqtt.mqtt.constants import MQTTv311
+import app.devices.api as devices
+from app.core import app as flask_app, db
+from app.devices.models import DeviceLatestRecording, RecordingRollup
+from .ingestion import get_subscription_topic
+from .mqtt_client import MqttClient
+
+RECORDING_COLUMNS = ['device_id', 'record_type', 'record_value',
+                     'recorded_at', 'received_at', 'raw_record']
+LATEST_COLUMNS = ['device_id', 'record_type', 'recorded_at', 'received_at',
+                  'record_value']
+ROLLUP_COLUMNS = ['device_id', 'record_type', 'period', 'bucket_start',
+                  'count', 'sum', 'min', 'max']
+# Rows are unnested from one array per column, so each upsert is a single
+# statement. Rows never repeat a key (see get_latest_rows, get_bucket_rows)
+UPSERT_LATEST = '''
+INSERT INTO device_latest_recordings
+    (device_id, record_type, recorded_at, received_at, record_value)
+SELECT * FROM unnest($1::integer[], $2::integer[], $3::timestamp[],
+                     $4::timestamp[], $5::double precision[])
+ON CONFLICT (device_id, record_type) DO UPDATE SET
+    recorded_at = excluded.recorded_at,
+    received_at = excluded.received_at,
+    record_value = excluded.record_value
+WHERE device_latest_recordings.recorded_at <= excluded.recorded_at
+'''
+UPSERT_ROLLUPS = '''
+INSERT INTO recording_rollups
+    (device_id, record_type, period, bucket_start, count, sum, min, max)
+SELECT * FROM unnest($1::integer[], $2::integer[], $3::varchar[],
+                     $4::timestamp[], $5::integer[], $6::double precision[],
+                     $7::double precision[], $8::double precision[])
+ON CONFLICT (device_id, record_type, period, bucket_start) DO UPDATE SET
+    count = recording_rollups.count + excluded.count,
+    sum = recording_rollups.sum + excluded.sum,
+    min = least(recording_rollups.min, excluded.min),
+    max = greatest(recording_rollups.max, excluded.max)
+'''
+# Seconds between reports of messages dropped while queue is full
+DROP_REPORT_INTERVAL = 10
+_STOP = object()
+
+
+def get_asyncpg_dsn(database_uri):
+    """
+    Converts SQLAlchemy database URI to DSN accepted by asyncpg, dropping
+    driver name if there is one
+    """
+    return re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://',
+                  database_uri)
+
+
+def get_secret_infos(device_ids):
+    # Runs in executor thread, which needs its own app context for database
+    # session used on cache misses
+    with flask_app.app_context():
+        return devices.get_device_secret_infos(device_ids)
+
+
+def get_columns(rows, column_names):
+    return [[row[column_name] for row in rows]
+            for column_name in column_names]
+
+
+class AsyncIngestionConsumer:
+    """
+    Standalone MQTT consumer which stores recordings of devices, running
+    on a single asyncio event loop. Meant to be run in its own process,
+    outside of web workers
+
+    Messages received during one event loop tick are verified together:
+    secrets of their devices are read from the device secret cache in one
+    executor call (so secret resets and deleted devices take effect
+    immediately), and HMACs are checked in one pass. Verified recordings
+    are written by MQTT_ASYNC_WRITERS writers, many rows per transaction,
+    using COPY and a single upsert statement for latest recordings and
+    rollups. Writes failed by connection errors are retried with backoff,
+    and batches with rows which violate constraints are split until the
+    offending rows are found
+
+    Topic is subscribed with QoS 1. While RECORDING_BUFFER_SIZE messages
+    are pending, acknowledgements of new messages are held back until
+    there is space, so broker stops sending once its in-flight window is
+    full. Messages published with QoS 0 can not be held back, so those are
+    dropped, counted and reported periodically
+
+    :param config: Application config
+    :param index: Index of this consumer on current node
+    :param shard: Shard handled by this consumer (sharded mode only)
+    :param shard_count: Total number of shards (sharded mode only)
+    """
+
+    def __init__(self, config, index, shard=None, shard_count=None):
+        self.config = config
+        self.index = index
+        self.shard = shard
+        self.shard_count = shard_count
+        self.topic = get_subscription_topic(config)
+        self.client_id = (config['MQTT_CLIENT_ID'] + '-ingest-' +
+                          config['MQTT_INGESTION_NODE'] + '-' + str(index))
+        self.max_pending = config['RECORDING_BUFFER_SIZE']
+        self.batch_size = config['RECORDING_BATCH_SIZE']
+        self.flush_interval = config['RECORDING_FLUSH_INTERVAL']
+        self.retries = config['RECORDING_FLUSH_RETRIES']
+        self.retry_backoff = config['RECORDING_FLUSH_RETRY_BACKOFF']
+        self.received = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.flush_count = 0
+        self.flushed_recordings = 0
+        self.failed_recordings = 0
+        self.loop = None
+        self.pool = None
+        self.client = None
+        self.rows = None
+        self.__has_space = None
+        self.__reported_drops = 0
+        self.__drops_reported_at = 0
+        self.__writers = []
+        self.__verifications = set()
+        self.__tick_messages = []
+        self.__in_verification = 0
+
+    def is_own_device(self, device_id):
+        if self.shard_count is None:
+            return True
+        return device_id % self.shard_count == self.shard
+
+    def handle_connect(self, client, flags, rc, properties):
+        print('Ingestion consumer ' + self.client_id + ' connected')
+        client.subscribe(self.topic, qos=1)
+
+    def handle_disconnect(self, client, packet, exc=None):
+        print('Ingestion consumer ' + self.client_id + ' disconnected')
+
+    async def handle_message(self, client, topic, payload, qos, properties):
+        try:
+            device_id = MqttClient.get_device_id(topic)
+        except Exception:
+            print_ingestion_error("Invalid topic " + str(topic))
+            return 0
+
+        if not self.is_own_device(device_id):
+            return 0
+        self.received += 1
+        if self.__is_full():
+            if qos == 0:
+                self.dropped += 1
+                self.__report_drops()
+                return 0
+            # Acknowledgement is sent once this returns
+            self.delayed += 1
+            while self.__is_full():
+                self.__has_space.clear()
+                await self.__has_space.wait()
+
+        if not self.__tick_messages:
+            self.loop.call_soon(self.__end_tick)
+        self.__tick_messages.append((device_id, payload))
+        self.__in_verification += 1
+        return 0
+
+    def stats(self):
+        """
+        Returns current consumer statistics
+
+        :rtype: dict
+        """
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'delayed': self.delayed,
+            'rejected': self.rejected,
+            'queued': self.rows.qsize() if self.rows is not None else 0,
+            'flushes': self.flush_count,
+            'flushed_recordings': self.flushed_recordings,
+            'failed_recordings': self.failed_recordings
+        }
+
+    async def start(self):
+        """
+        Opens database pool, starts writers and connects to broker
+        """
+        self.pool = await asyncpg.create_pool(
+                get_asyncpg_dsn(self.config['SQLALCHEMY_DATABASE_URI']),
+                min_size=1,
+                max_size=self.config['MQTT_ASYNC_DB_POOL_SIZE'])
+        self.__writers = [asyncio.ensure_future(self.__write_rows())
+                          for _ in range(self.config['MQTT_ASYNC_WRITERS'])]
+
+        self.client = Client(self.client_id)
+        self.client.on_connect = self.handle_connect
+        self.client.on_disconnect = self.handle_disconnect
+        self.client.on_message = self.handle_message
+        if self.config.get('MQTT_USERNAME'):
+            self.client.set_auth_credentials(self.config['MQTT_USERNAME'],
+                                             self.config.get('MQTT_PASSWORD'))
+        await self.client.connect(self.config['MQTT_BROKER_URL'],
+                                  self.config['MQTT_BROKER_PORT'],
+                                  version=MQTTv311)
+
+    async def stop(self):
+        """
+        Disconnects from broker and stops writers after they store
+        everything already received
+        """
+        if self.client is not None:
+            await self.client.disconnect()
+        if self.__tick_messages:
+            self.__end_tick()
+        if self.__verifications:
+            await asyncio.wait(list(self.__verifications))
+        for _ in self.__writers:
+            await self.rows.put(_STOP)
+        if self.__writers:
+            await asyncio.wait(self.__writers)
+        if self.pool is not None:
+            await self.pool.close()
+
+    def run(self):
+        """
+        Runs consumer on a new event loop until SIGTERM or SIGINT
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.rows = asyncio.Queue(maxsize=self.max_pending)
+        self.__has_space = asyncio.Event()
+        stop_event = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        self.loop.add_signal_handler(signal.SIGINT, stop_event.set)
+
+        async def consume():
+            try:
+                await self.start()
+                await stop_event.wait()
+            finally:
+                await self.stop()
+
+        try:
+            self.loop.run_until_complete(consume())
+        finally:
+            self.loop.close()
+            print('Ingestion consumer ' + self.client_id + ' stopped. ' +
+                  str(self.stats()))
+
+    def __is_full(self):
+        return self.__in_verification + self.rows.qsize() >= self.max_pending
+
+    def __release_space(self):
+        if not self.__is_full():
+            self.__has_space.set()
+
+    def __report_drops(self):
+        now = time.monotonic()
+        if now - self.__drops_reported_at < DROP_REPORT_INTERVAL:
+            return
+        print("ERROR! Ingestion consumer " + self.client_id + " dropped " +
+              str(self.dropped - self.__reported_drops) + " QoS 0 " +
+              "messages, queue is full")
+        self.__reported_drops = self.dropped
+        self.__drops_reported_at = now
+
+    def __end_tick(self):
+        messages = self.__tick_messages
+        self.__tick_messages = []
+        verification = asyncio.ensure_future(self.__verify(messages))
+        self.__verifications.add(verification)
+        verification.add_done_callback(self.__verifications.discard)
+
+    async def __verify(self, messages):
+        try:
+            secrets = await self.__get_secrets(
+                    set(device_id for device_id, payload in messages))
+            rows = []
+            for device_id, payload in messages:
+                row = self.__verify_message(device_id, payload,
+                                            secrets.get(device_id))
+                if row is not None:
+                    rows.append(row)
+            for row in rows:
+                await self.rows.put(row)
+        except Exception:
+            self.failed_recordings += len(messages)
+            print_ingestion_error("Failed to verify " + str(len(messages)) +
+                                  " messages")
+        finally:
+            self.__in_verification -= len(messages)
+            self.__release_space()
+
+    async def __get_secrets(self, device_ids):
+        return await self.loop.run_in_executor(None, get_secret_infos,
+                                               list(device_ids))
+
+    def __verify_message(self, device_id, payload, secret_info):
+        device_secret, secret_algorithm, exists = secret_info
+        if not exists:
+            self.rejected += 1
+            return None
+        try:
+            raw_json = json.loads(payload.decode())
+            hmac_value = raw_json.pop('hmac', None)
+            calculated_hmac = devices.sign_message(
+                    device_secret, secret_algorithm,
+                    devices.encode_message(raw_json))
+            if (not isinstance(hmac_value, str) or
+                    not hmac.compare_digest(hmac_value, calculated_hmac)):
+                self.rejected += 1
+                return None
+            return devices.parse_raw_json_recording(
+                    device_id, raw_json).to_row()
+        except (ValueError, TypeError, AttributeError):
+            self.rejected += 1
+            return None
+
+    async def __write_rows(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = await self.__collect_batch()
+            if batch:
+                await self.__flush(batch)
+
+    async def __collect_batch(self):
+        try:
+            return await self.__get_batch()
+        finally:
+            self.__release_space()
+
+    async def __get_batch(self):
+        row = await self.rows.get()
+        if row is _STOP:
+            return [], True
+
+        batch = [row]
+        deadline = self.loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - self.loop.time()
+            try:
+                if remaining > 0:
+                    row = await asyncio.wait_for(self.rows.get(), remaining)
+                else:
+                    row = self.rows.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            if row is _STOP:
+                return batch, True
+            batch.append(row)
+        return batch, False
+
+    async def __flush(self, batch):
+        started_at = time.perf_counter()
+        stored = await self.__store(batch, 0)
+        latency = time.perf_counter() - started_at
+        if not stored:
+            return
+
+        # Redis client is blocking, so it is used off the event loop
+        await self.loop.run_in_executor(
+                None, devices.query_cache.invalidate,
+                set(row['device_id'] for row in stored))
+        self.flush_count += 1
+        self.flushed_recordings += len(stored)
+        print('Flushed %d recordings in %.2f ms (%d queued)' % (
+            len(stored), latency * 1000, self.rows.qsize()))
+
+    async def __store(self, batch, attempt):
+        # Returns stored rows. Transient errors are retried with backoff,
+        # while batches with rows which violate constraints are split in
+        # halves until the offending rows are found
+        try:
+            await self.__write(batch)
+            return batch
+        except (IntegrityConstraintViolationError, DataError):
+            if len(batch) == 1:
+                self.failed_recordings += 1
+                print_ingestion_error("Failed to store recording of " +
+                                      "device " + str(batch[0]['device_id']))
+                return []
+            middle = len(batch) // 2
+            return (await self.__store(batch[:middle], attempt) +
+                    await self.__store(batch[middle:], attempt))
+        except (PostgresConnectionError, InterfaceError, OSError,
+                asyncio.TimeoutError):
+            if attempt >= self.retries:
+                self.failed_recordings += len(batch)
+                print_ingestion_error("Failed to flush " + str(len(batch)) +
+                                      " recordings")
+                return []
+            backoff = self.retry_backoff * 2 ** attempt
+            print("ERROR! Failed to flush recordings, retrying in " +
+                  str(backoff) + " seconds")
+            await asyncio.sleep(backoff)
+            return await self.__store(batch, attempt + 1)
+        except Exception:
+            self.failed_recordings += len(batch)
+            print_ingestion_error("Failed to flush " + str(len(batch)) +
+                                  " recordings")
+            return []
+
+    async def __write(self, batch):
+        latest_rows = DeviceLatestRecording.get_latest_rows(batch)
+        bucket_rows = RecordingRollup.get_bucket_rows(batch)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.copy_records_to_table(
+                        'recordings',
+                        records=[
+                            (row['device_id'], row['record_type'],
+                             row['record_value'], row['recorded_at'],
+                             row['received_at'],
+                             json.dumps(row['raw_record']))
+                            for row in batch],
+                        columns=RECORDING_COLUMNS)
+                await connection.execute(
+                        UPSERT_LATEST,
+                        *get_columns(latest_rows, LATEST_COLUMNS))
+                await connection.execute(
+                        UPSERT_ROLLUPS,
+                        *get_columns(bucket_rows, ROLLUP_COLUMNS))
+
+
+def print_ingestion_error(message):
+    print("ERROR! " + message)
+    error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
+
+
+def run_async_consumer(config, index, shard, shard_count):
+    # Connections inherited from parent process must not be shared, secrets
+    # are loaded through the engine in executor threads
+    db.engine.dispose()
+    AsyncIngestionConsumer(config, index, shard, shard_count).run()
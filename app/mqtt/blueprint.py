@@ -8,7 +8,8 @@ mqtt_bp = Blueprint('mqtt', __name__)
 # Setup
 @mqtt_bp.record
 def __on_blueprint_setup(setup_state):
-    MqttClient.setup(setup_state.app)
+    if setup_state.app.config['MQTT_WEB_INGESTION']:
+        MqttClient.setup(setup_state.app)
 
 
 # When app dies, stop mqtt connection
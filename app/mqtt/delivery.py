@@ -0,0 +1,218 @@
+import sys
+import time
+import threading
+from collections import deque
+
+VERSION_KEY_FORMAT = 'configuration-version:%s'
+# Seconds after which acknowledgement of unregistered message id is dropped
+EARLY_ACK_TIMEOUT = 60
+
+
+class Delivery:
+    """
+    Outstanding publish of a message, identified by its MQTT message id
+
+    :param mid: MQTT message id
+    :param generation: Sequence number of publish in its tracker, which
+    tells apart publishes reusing the same message id
+    :param key: Optional key of message (e.g. device id)
+    :param published_at: Monotonic time of publish
+    """
+
+    def __init__(self, mid, generation, key, published_at):
+        self.mid = mid
+        self.generation = generation
+        self.key = key
+        self.published_at = published_at
+        self.latency = None
+        self.completed = threading.Event()
+
+
+class DeliveryTracker:
+    """
+    Tracks outstanding publishes keyed by MQTT message id. Publish is
+    completed when broker acknowledges it (PUBACK for QoS 1, PUBCOMP for
+    QoS 2), which paho reports by on_publish callback from its network
+    thread. Completion latencies of recent deliveries are kept for
+    statistics
+
+    Acknowledgement may arrive before publishing thread registers message
+    id, so such early acknowledgements are kept until registered (or for
+    EARLY_ACK_TIMEOUT seconds). Abandoned publishes stay queued in paho,
+    which eventually sends them, so their acknowledgements are expected by
+    (mid, generation) and consumed before those of newer publishes which
+    reuse the message id. Lock of tracker is never held while calling paho,
+    which calls on_publish with its own locks held
+
+    :param history_size: Number of latencies kept for statistics
+    """
+
+    def __init__(self, history_size):
+        self.latencies = deque(maxlen=history_size)
+        self.completed_count = 0
+        self.abandoned_count = 0
+        self.__pending = {}
+        self.__early_acks = {}
+        self.__abandoned = {}
+        self.__generation = 0
+        self.__lock = threading.Lock()
+
+    def add(self, mid, key=None):
+        """
+        Starts tracking publish with given message id
+
+        :rtype: Delivery
+        """
+        with self.__lock:
+            self.__generation += 1
+            delivery = Delivery(mid, self.__generation, key, time.monotonic())
+            acknowledged_at = self.__early_acks.pop(mid, None)
+            if acknowledged_at is not None:
+                self.__complete(delivery, acknowledged_at)
+            else:
+                self.__pending[mid] = delivery
+        return delivery
+
+    def complete(self, mid):
+        """
+        Marks publish with given message id as acknowledged by broker
+        """
+        now = time.monotonic()
+        with self.__lock:
+            generations = self.__abandoned.get(mid)
+            if generations:
+                # Abandoned publish was sent first, so it is acknowledged
+                # before any newer publish with the same message id
+                generations.remove(min(generations))
+                if not generations:
+                    del self.__abandoned[mid]
+                return
+            delivery = self.__pending.pop(mid, None)
+            if delivery is not None:
+                self.__complete(delivery, now)
+                return
+            for early_mid, acknowledged_at in list(self.__early_acks.items()):
+                if now - acknowledged_at > EARLY_ACK_TIMEOUT:
+                    del self.__early_acks[early_mid]
+            self.__early_acks[mid] = now
+
+    def wait(self, deliveries, timeout):
+        """
+        Waits until all given deliveries are completed, or timeout passes
+
+        :param timeout: Number of seconds to wait for all deliveries
+        :returns: Deliveries which were not completed in time
+        :rtype: list
+        """
+        deadline = time.monotonic() + timeout
+        for delivery in deliveries:
+            remaining = max(deadline - time.monotonic(), 0)
+            delivery.completed.wait(remaining)
+        return [delivery for delivery in deliveries
+                if not delivery.completed.is_set()]
+
+    def abandon(self, deliveries):
+        """
+        Stops waiting for given deliveries. Their messages stay queued in
+        paho, so their late acknowledgements are expected and ignored
+        """
+        with self.__lock:
+            for delivery in deliveries:
+                if self.__pending.get(delivery.mid) is not delivery:
+                    continue
+                del self.__pending[delivery.mid]
+                self.__abandoned.setdefault(delivery.mid, []).append(
+                        delivery.generation)
+                self.abandoned_count += 1
+
+    def stats(self):
+        """
+        Returns delivery statistics, latencies are in seconds
+
+        :rtype: dict
+        """
+        with self.__lock:
+            latencies = list(self.latencies)
+            return {
+                'pending': len(self.__pending),
+                'completed': self.completed_count,
+                'abandoned': self.abandoned_count,
+                'average_latency': (sum(latencies) / len(latencies)
+                                    if latencies else None),
+                'max_latency': max(latencies) if latencies else None
+            }
+
+    def __complete(self, delivery, acknowledged_at):
+        delivery.latency = max(acknowledged_at - delivery.published_at, 0)
+        self.latencies.append(delivery.latency)
+        self.completed_count += 1
+        delivery.completed.set()
+
+
+class ConfigurationVersions:
+    """
+    Configuration version counters of devices, kept in Redis. Every stored
+    configuration gets next version of its device, so publishes of older
+    versions which are still queued can be recognised and skipped, and only
+    the newest configuration of a device is sent
+
+    If Redis is not available versions are not assigned and nothing is
+    considered superseded
+
+    :param redis_client: Redis client used for version counters
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def next_versions(self, device_ids):
+        """
+        Assigns next configuration version to every given device
+
+        :returns: Dictionary of versions keyed by device id
+        :rtype: dict
+        """
+        device_ids = list(device_ids)
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for device_id in device_ids:
+                pipeline.incr(VERSION_KEY_FORMAT % device_id)
+            return dict(zip(device_ids, pipeline.execute()))
+        except Exception:
+            print_delivery_error("Failed to assign configuration versions")
+            return {}
+
+    def get_superseded(self, versions):
+        """
+        Finds devices whose configuration of given version was replaced by
+        a newer one
+
+        :param versions: Dictionary of versions keyed by device id, None
+        version is never superseded
+        :returns: Ids of devices with newer configuration
+        :rtype: set
+        """
+        versions = [(device_id, version)
+                    for device_id, version in versions.items()
+                    if version is not None]
+        if not versions:
+            return set()
+        try:
+            current_versions = self.redis_client.mget(
+                    [VERSION_KEY_FORMAT % device_id
+                     for device_id, version in versions])
+        except Exception:
+            print_delivery_error("Failed to read configuration versions")
+            return set()
+        return set(device_id
+                   for (device_id, version), current_version
+                   in zip(versions, current_versions)
+                   if current_version is not None and
+                   int(current_version) > version)
+
+
+def print_delivery_error(message):
+    print("ERROR! " + message)
+    error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
@@ -0,0 +1,123 @@
+import sys
+import queue
+import threading
+
+
+_STOP = object()
+
+
+class MessageDispatcher:
+    """
+    Moves message handling off the MQTT network thread onto a pool of worker
+    threads. Every worker owns a bounded queue and messages are routed to
+    workers by hashing their key (device id), so messages of one device are
+    always handled in order, by the same worker.
+
+    Dispatching never blocks: when the target queue is full the message is
+    dropped and counted.
+
+    :param handler: Function called by workers for each dispatched item
+    :param worker_count: Number of worker threads
+    :param queue_size: Maximum number of pending items per worker
+    :type handler: func(item)
+    :type worker_count: int
+    :type queue_size: int
+    """
+
+    def __init__(self, handler, worker_count, queue_size):
+        self.handler = handler
+        self.worker_count = max(1, worker_count)
+        self.queues = [queue.Queue(maxsize=queue_size)
+                       for _ in range(self.worker_count)]
+        self.dispatched = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.__workers = []
+        self.__lock = threading.Lock()
+        self.__counter_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts worker threads if they are not already running
+        """
+        with self.__lock:
+            if self.__workers:
+                return
+            for index, worker_queue in enumerate(self.queues):
+                worker = threading.Thread(target=self.__run,
+                                          args=(worker_queue,),
+                                          name='mqtt-worker-' + str(index),
+                                          daemon=True)
+                worker.start()
+                self.__workers.append(worker)
+        print('MQTT dispatcher started with ' + str(self.worker_count) +
+              ' workers')
+
+    def stop(self):
+        """
+        Stops worker threads after they handle already queued items
+        """
+        with self.__lock:
+            if not self.__workers:
+                return
+            for worker_queue in self.queues:
+                worker_queue.put(_STOP)
+            for worker in self.__workers:
+                worker.join()
+            self.__workers = []
+        print('MQTT dispatcher stopped')
+
+    def dispatch(self, key, item):
+        """
+        Queues item on the worker selected by key
+
+        :param key: Routing key, items with equal keys keep their order
+        :param item: Item passed to handler
+        :returns: False if item was dropped because worker queue is full
+        :rtype: Boolean
+        """
+        worker_queue = self.queues[hash(key) % self.worker_count]
+        try:
+            worker_queue.put_nowait(item)
+        except queue.Full:
+            with self.__counter_lock:
+                self.dropped += 1
+            return False
+        with self.__counter_lock:
+            self.dispatched += 1
+        return True
+
+    def stats(self):
+        """
+        Returns current dispatcher statistics
+
+        :rtype: dict
+        """
+        queue_depths = [worker_queue.qsize() for worker_queue in self.queues]
+        return {
+            'workers': self.worker_count,
+            'queue_depths': queue_depths,
+            'queue_depth': sum(queue_depths),
+            'dispatched': self.dispatched,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'failed': self.failed
+        }
+
+    def __run(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                return
+            try:
+                self.handler(item)
+                with self.__counter_lock:
+                    self.processed += 1
+            except Exception:
+                with self.__counter_lock:
+                    self.failed += 1
+                print("ERROR!")
+                error_type, error_instance, traceback = sys.exc_info()
+                print("Type: " + str(error_type))
+                print("Instance: " + str(error_instance))
@@ -0,0 +1,175 @@
+import os
+import sys
+import signal
+import multiprocessing
+import paho.mqtt.client as paho
+from app.core import db
+import app.devices.api as devices
+from .dispatcher import MessageDispatcher
+from .mqtt_client import MqttClient
+
+DEVICE_TOPIC = 'device/+'
+MODES = ['shared', 'sharded']
+
+
+def get_subscription_topic(config):
+    """
+    Returns topic consumers subscribe to. In shared mode broker delivers each
+    message to only one member of the group, in sharded mode every consumer
+    receives all messages and keeps only those of its shard
+    """
+    if config['MQTT_INGESTION_MODE'] == 'shared':
+        return '$share/' + config['MQTT_SHARED_GROUP'] + '/' + DEVICE_TOPIC
+    return DEVICE_TOPIC
+
+
+class IngestionConsumer:
+    """
+    Standalone MQTT consumer which stores recordings of devices. Meant to be
+    run in its own process, outside of web workers
+
+    :param config: Application config
+    :param index: Index of this consumer on current node
+    :param shard: Shard handled by this consumer (sharded mode only)
+    :param shard_count: Total number of shards (sharded mode only)
+    """
+
+    def __init__(self, config, index, shard=None, shard_count=None):
+        self.config = config
+        self.index = index
+        self.shard = shard
+        self.shard_count = shard_count
+        self.topic = get_subscription_topic(config)
+        self.client_id = (config['MQTT_CLIENT_ID'] + '-ingest-' +
+                          config['MQTT_INGESTION_NODE'] + '-' + str(index))
+        self.dispatcher = MessageDispatcher(
+                MqttClient.handle_device_message,
+                config['MQTT_WORKER_COUNT'],
+                config['MQTT_WORKER_QUEUE_SIZE'])
+        self.client = paho.Client(client_id=self.client_id)
+        self.client.on_connect = self.handle_connect
+        self.client.on_disconnect = self.handle_disconnect
+        self.client.on_message = self.handle_message
+        if config.get('MQTT_USERNAME'):
+            self.client.username_pw_set(config['MQTT_USERNAME'],
+                                        config.get('MQTT_PASSWORD'))
+
+    def is_own_device(self, device_id):
+        if self.shard_count is None:
+            return True
+        return device_id % self.shard_count == self.shard
+
+    def handle_connect(self, client, userdata, flags, rc):
+        print('Ingestion consumer ' + self.client_id + ' connected')
+        client.subscribe(self.topic)
+
+    def handle_disconnect(self, client, userdata, rc):
+        print('Ingestion consumer ' + self.client_id + ' disconnected')
+
+    def handle_message(self, client, userdata, message):
+        try:
+            device_id = MqttClient.get_device_id(message.topic)
+        except Exception:
+            print("ERROR!")
+            error_type, error_instance, traceback = sys.exc_info()
+            print("Type: " + str(error_type))
+            print("Instance: " + str(error_instance))
+            return
+
+        if not self.is_own_device(device_id):
+            return
+
+        if not self.dispatcher.dispatch(device_id,
+                                        (device_id, message.payload)):
+            print("Dropped message for device " + str(device_id) +
+                  ", dispatcher queue is full")
+
+    def stop(self, *args):
+        self.client.disconnect()
+
+    def run(self):
+        """
+        Connects to broker and consumes messages until stopped
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        devices.recording_buffer.start()
+        self.dispatcher.start()
+        try:
+            self.client.connect(self.config['MQTT_BROKER_URL'],
+                                self.config['MQTT_BROKER_PORT'])
+            self.client.loop_forever()
+        finally:
+            self.dispatcher.stop()
+            devices.recording_buffer.stop()
+            print('Ingestion consumer ' + self.client_id + ' stopped. ' +
+                  'Dispatcher: ' + str(self.dispatcher.stats()) + ' ' +
+                  'Buffer: ' + str(devices.recording_buffer.stats()))
+
+
+def run_consumer(config, index, shard, shard_count):
+    # Connections inherited from parent process must not be shared
+    db.engine.dispose()
+    IngestionConsumer(config, index, shard, shard_count).run()
+
+
+def run_consumers(app, consumer_count, asynchronous=False):
+    """
+    Runs given number of ingestion consumers, each in its own process, and
+    waits for them to finish
+
+    :param app: Flask application
+    :param consumer_count: Number of consumer processes on this node
+    :param asynchronous: If true, asyncio consumers are run instead of paho
+    based ones (see AsyncIngestionConsumer)
+    :type consumer_count: int
+    :type asynchronous: Boolean
+    :raises: ValueError if ingestion mode is invalid or consumers of this
+    node would handle shards beyond MQTT_SHARD_COUNT
+    """
+    config = app.config
+    mode = config['MQTT_INGESTION_MODE']
+    if mode not in MODES:
+        raise ValueError("Invalid ingestion mode (" + str(mode) + "). " +
+                         "Valid modes: " + str(MODES))
+
+    shard_count = None
+    if mode == 'sharded':
+        shard_count = config['MQTT_SHARD_COUNT'] or consumer_count
+        shard_offset = config['MQTT_SHARD_OFFSET']
+        # Shards past shard count would never match a device, so their
+        # consumers would silently ingest nothing
+        if shard_offset < 0 or shard_offset + consumer_count > shard_count:
+            raise ValueError(
+                    "Shards " + str(shard_offset) + " to " +
+                    str(shard_offset + consumer_count - 1) + " do not " +
+                    "exist (MQTT_SHARD_COUNT is " + str(shard_count) + ")")
+
+    target = run_consumer
+    if asynchronous:
+        from .async_ingestion import run_async_consumer
+        target = run_async_consumer
+
+    processes = []
+    for index in range(consumer_count):
+        shard = None
+        if shard_count is not None:
+            shard = config['MQTT_SHARD_OFFSET'] + index
+        process = multiprocessing.Process(
+                target=target,
+                args=(config, index, shard, shard_count),
+                name='ingestion-consumer-' + str(index))
+        process.start()
+        processes.append(process)
+    print('Started ' + str(consumer_count) + ' ingestion consumers in ' +
+          mode + ' mode (node ' + config['MQTT_INGESTION_NODE'] + ')')
+
+    def stop_consumers(*args):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop_consumers)
+    signal.signal(signal.SIGINT, stop_consumers)
+    for process in processes:
+        process.join()
@@ -2,16 +2,24 @@ import sys
 import json
 from flask_mqtt import Mqtt
 import app.devices.api as devices
+from .dispatcher import MessageDispatcher
 
 
 class MqttClient:
     __initialized = False
     mqtt = Mqtt()
+    dispatcher = None
 
     # Mqtt setup
     @staticmethod
     def setup(app):
         if not MqttClient.__initialized:
+            MqttClient.dispatcher = MessageDispatcher(
+                    MqttClient.handle_device_message,
+                    app.config['MQTT_WORKER_COUNT'],
+                    app.config['MQTT_WORKER_QUEUE_SIZE'])
+            devices.recording_buffer.start()
+            MqttClient.dispatcher.start()
             MqttClient.mqtt.init_app(app)
             MqttClient.mqtt.client.on_message = MqttClient.handle_mqtt_message
             MqttClient.mqtt.client.on_subscribe = MqttClient.handle_subscribe
@@ -40,6 +48,8 @@ class MqttClient:
             if (hasattr(MqttClient.mqtt, 'client') and
                     MqttClient.mqtt.client is not None):
                 MqttClient.mqtt.client.disconnect()
+            MqttClient.dispatcher.stop()
+            devices.recording_buffer.stop()
             print('MQTT client destroyed')
 
     @staticmethod
@@ -48,14 +58,9 @@ class MqttClient:
 
     @staticmethod
     def handle_mqtt_message(client, userdata, message):
-        print("Received message!")
-        print("Topic: " + message.topic)
-        print("Payload: " + message.payload.decode())
+        # Runs on network thread, so actual handling is left to dispatcher
         try:
-            # If type is JSON
-            devices.create_recording(
-                    MqttClient.get_device_id(message.topic),
-                    json.loads(message.payload.decode()))
+            device_id = MqttClient.get_device_id(message.topic)
         except Exception:
             print("ERROR!")
             error_type, error_instance, traceback = sys.exc_info()
@@ -63,6 +68,20 @@ class MqttClient:
             print("Instance: " + str(error_instance))
             return
 
+        if not MqttClient.dispatcher.dispatch(
+                device_id, (device_id, message.payload)):
+            print("Dropped message for device " + str(device_id) +
+                  ", dispatcher queue is full")
+
+    @staticmethod
+    def handle_device_message(item):
+        device_id, payload = item
+        print("Received message!")
+        print("Device: " + str(device_id))
+        print("Payload: " + payload.decode())
+        # If type is JSON
+        devices.queue_recording(device_id, json.loads(payload.decode()))
+
     @staticmethod
     def handle_publish(client, userdata, mid):
         print("Published message! (" + str(mid) + ")")
@@ -0,0 +1,189 @@
+import os
+import sys
+import threading
+import paho.mqtt.client as paho
+from .delivery import DeliveryTracker
+
+
+class MqttPublisher:
+    """
+    Long-lived MQTT connection used to publish messages, meant to be created
+    once per process and reused by every publish. Network loop runs in a
+    background thread, which keeps the connection alive and reconnects with
+    exponential backoff whenever it is lost. Every publish is tracked until
+    broker acknowledges it
+
+    :param config: Application config
+    :param client_id: MQTT client id, must be unique per process
+    :type config: dict
+    :type client_id: string
+    """
+
+    def __init__(self, config, client_id):
+        self.host = config['MQTT_BROKER_URL']
+        self.port = config['MQTT_BROKER_PORT']
+        self.keepalive = config.get('MQTT_KEEPALIVE', 60)
+        self.min_backoff = config['MQTT_PUBLISHER_MIN_BACKOFF']
+        self.max_backoff = config['MQTT_PUBLISHER_MAX_BACKOFF']
+        self.publish_timeout = config['MQTT_PUBLISHER_TIMEOUT']
+        self.client_id = client_id
+        self.tracker = DeliveryTracker(config['MQTT_DELIVERY_HISTORY_SIZE'])
+        self.client = paho.Client(client_id=client_id)
+        self.client.on_connect = self.handle_connect
+        self.client.on_disconnect = self.handle_disconnect
+        self.client.on_publish = self.handle_publish
+        if config.get('MQTT_USERNAME'):
+            self.client.username_pw_set(config['MQTT_USERNAME'],
+                                        config.get('MQTT_PASSWORD'))
+        self.__connected = threading.Event()
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts background network loop, which connects to broker
+        """
+        with self.__lock:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stop_event.clear()
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='mqtt-publisher',
+                                             daemon=True)
+            self.__thread.start()
+        print('MQTT publisher ' + self.client_id + ' started')
+
+    def stop(self):
+        """
+        Disconnects from broker and stops background network loop
+        """
+        with self.__lock:
+            if self.__thread is None:
+                return
+            self.__stop_event.set()
+            self.__thread.join()
+            self.__thread = None
+        print('MQTT publisher ' + self.client_id + ' stopped')
+
+    def is_connected(self):
+        return self.__connected.is_set()
+
+    def publish(self, topic, payload, qos=2, retain=False, key=None):
+        """
+        Publishes message over the shared connection, waiting for connection
+        to be (re)established if needed
+
+        :param key: Optional key under which delivery is tracked
+        :returns: Delivery, which is completed when broker acknowledges it
+        :rtype: Delivery
+        :raises: ConnectionError if broker is not reachable within
+        MQTT_PUBLISHER_TIMEOUT seconds or paho dropped the message, so it
+        is safe to publish it again
+        """
+        self.start()
+        if not self.__connected.wait(self.publish_timeout):
+            raise ConnectionError('MQTT broker is not reachable')
+        result, mid = self.client.publish(topic, payload, qos, retain)
+        # Paho keeps messages with QoS above 0 queued while disconnected,
+        # and sends them once reconnected
+        if result == paho.MQTT_ERR_NO_CONN and qos > 0:
+            return self.tracker.add(mid, key)
+        if result != paho.MQTT_ERR_SUCCESS:
+            raise ConnectionError('MQTT publish failed: ' +
+                                  paho.error_string(result))
+        return self.tracker.add(mid, key)
+
+    def handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print('MQTT publisher ' + self.client_id + ' connected')
+            self.__connected.set()
+        else:
+            print('MQTT publisher connection refused: ' +
+                  paho.connack_string(rc))
+
+    def handle_publish(self, client, userdata, mid):
+        self.tracker.complete(mid)
+
+    def handle_disconnect(self, client, userdata, rc):
+        self.__connected.clear()
+        print('MQTT publisher ' + self.client_id + ' disconnected')
+
+    def __run(self):
+        backoff = self.min_backoff
+        connected = False
+        while not self.__stop_event.is_set():
+            if not connected:
+                try:
+                    self.client.connect(self.host, self.port, self.keepalive)
+                    connected = True
+                except Exception:
+                    print_publisher_error('MQTT publisher failed to connect, '
+                                          'retrying in ' + str(backoff) +
+                                          ' seconds')
+                    self.__stop_event.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+
+            result = self.client.loop(timeout=1.0)
+            if result == paho.MQTT_ERR_SUCCESS:
+                if self.__connected.is_set():
+                    backoff = self.min_backoff
+                continue
+
+            self.__connected.clear()
+            connected = False
+            print('MQTT publisher connection lost (' +
+                  paho.error_string(result) + '), reconnecting in ' +
+                  str(backoff) + ' seconds')
+            self.__stop_event.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+        if connected:
+            self.client.disconnect()
+            self.client.loop(timeout=1.0)
+        self.__connected.clear()
+
+
+def print_publisher_error(message):
+    print("ERROR! " + message)
+    error_type, error_instance, traceback = sys.exc_info()
+    print("Type: " + str(error_type))
+    print("Instance: " + str(error_instance))
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher(config):
+    """
+    Returns publisher of current process, creating and starting it on first
+    use. Forked processes get their own publisher and client id
+
+    :param config: Application config
+    :type config: dict
+    :rtype: MqttPublisher
+    """
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = MqttPublisher(
+                    config,
+                    config['MQTT_CLIENT_ID'] + '-publisher-' +
+                    str(os.getpid()))
+            _publisher_pid = os.getpid()
+            _publisher.start()
+        return _publisher
+
+
+def stop_publisher():
+    """
+    Stops publisher of current process, if it was created
+    """
+    global _publisher
+    with _publisher_lock:
+        if _publisher is not None and _publisher_pid == os.getpid():
+            _publisher.stop()
+        _publisher = None
@@ -1,4 +1,6 @@
 import os
+import socket
+import datetime
 
 # App configuration
 DEBUG = os.environ['DEBUG']
@@ -12,6 +14,10 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Define the database - we are working with
 SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Logs number of SQL statements issued by every API request, used to catch
+# lazy loading (N+1 queries) in list endpoints
+QUERY_COUNT_LOGGING = os.environ.get('QUERY_COUNT_LOGGING') == 'True'
+SQLALCHEMY_RECORD_QUERIES = QUERY_COUNT_LOGGING
 DATABASE_CONNECT_OPTIONS = {}
 
 # Application threads. A common general assumption is
@@ -40,10 +46,101 @@ MQTT_BROKER_PORT = 1883
 MQTT_USERNAME = 'user'
 MQTT_PASSWORD = 'secret'
 MQTT_REFRESH_TIME = 1.0  # refresh time in seconds
+MQTT_WORKER_COUNT = 4  # threads handling received messages
+MQTT_WORKER_QUEUE_SIZE = 1000  # pending messages per worker before dropping
+# Persistent publisher used by Celery workers to send configurations
+MQTT_PUBLISHER_MIN_BACKOFF = 1  # seconds before first reconnect attempt
+MQTT_PUBLISHER_MAX_BACKOFF = 30  # max seconds between reconnect attempts
+MQTT_PUBLISHER_TIMEOUT = 10  # seconds publish waits for connection
+MQTT_PUBLISH_MAX_RETRIES = 5  # retries of failed configuration tasks
+MQTT_DELIVERY_TIMEOUT = 30  # seconds to wait for broker acknowledgement
+MQTT_DELIVERY_MAX_WAIT = 300  # seconds queued publish is waited for
+MQTT_DELIVERY_HISTORY_SIZE = 1000  # latencies kept for delivery statistics
+# Broker keeps only newest configuration of device for its next connection
+MQTT_RETAIN_CONFIGURATION = True
+# Bulk configuration push is split into tasks publishing many messages each
+CONFIGURATION_PUSH_CHUNK_SIZE = 500  # devices handled by a single task
+CONFIGURATION_PUSH_PROGRESS_STEP = 50  # messages between progress updates
+CONFIGURATION_PUSH_TTL = 86400  # seconds push progress can be looked up
+
+# Recordings are ingested by `python manage.py ingest`, separately from web
+# workers. Set MQTT_WEB_INGESTION=True to subscribe from web process instead
+MQTT_WEB_INGESTION = os.environ.get('MQTT_WEB_INGESTION') == 'True'
+MQTT_INGESTION_CONSUMERS = int(os.environ.get('MQTT_INGESTION_CONSUMERS')
+                               or 2)
+MQTT_INGESTION_NODE = os.environ.get('DYNO') or socket.gethostname()
+# 'shared' uses shared subscriptions ($share/<group>/device/+), 'sharded'
+# subscribes to device/+ and keeps only devices with
+# device_id % MQTT_SHARD_COUNT equal to consumer's shard
+MQTT_INGESTION_MODE = os.environ.get('MQTT_INGESTION_MODE') or 'shared'
+MQTT_SHARED_GROUP = 'final-iot-backend-ingestion'
+MQTT_SHARD_COUNT = int(os.environ.get('MQTT_SHARD_COUNT') or 0)
+MQTT_SHARD_OFFSET = int(os.environ.get('MQTT_SHARD_OFFSET') or 0)
+# Asyncio consumers (`python manage.py ingest --async`) verify messages
+# of every event loop tick together and write recordings with asyncpg
+MQTT_ASYNC_DB_POOL_SIZE = 4  # database connections per consumer process
+MQTT_ASYNC_WRITERS = 2  # recording batches written concurrently
+
+# Maximum page size of keyset paginated lists (limit parameter)
+MAX_PAGE_SIZE = 1000
+
+# Recording ingestion configuration
+RECORDING_BUFFER_SIZE = 10000  # recordings held in memory before blocking
+RECORDING_BATCH_SIZE = 500  # max recordings stored in one transaction
+RECORDING_FLUSH_INTERVAL = 1.0  # max seconds a recording waits in buffer
+RECORDING_BUFFER_TIMEOUT = 5.0  # seconds a producer waits on a full buffer
+RECORDING_FLUSH_RETRIES = 3  # retries of flush failed by transient error
+RECORDING_FLUSH_RETRY_BACKOFF = 0.5  # seconds before first flush retry
+RECORDING_STREAM_CHUNK_SIZE = 1000  # rows fetched at once when streaming
+
+# Recordings are partitioned by month of recorded_at
+RECORDING_PARTITION_PRECREATE_MONTHS = 3  # future partitions kept ready
+RECORDING_RETENTION_MONTHS = (int(os.environ['RECORDING_RETENTION_MONTHS'])
+                              if os.environ.get('RECORDING_RETENTION_MONTHS')
+                              else None)  # None keeps recordings forever
+RECORDING_DROP_EXPIRED_PARTITIONS = (
+        os.environ.get('RECORDING_DROP_EXPIRED_PARTITIONS') == 'True')
+# Past months partitioned by migration when retention is not set, older
+# recordings stay in default partition
+RECORDING_PARTITION_HORIZON_MONTHS = 24
+
+# Device metadata cache (secrets used for HMAC verification)
+DEVICE_CACHE_SIZE = 10000  # max number of cached devices
+DEVICE_CACHE_TTL = 300  # seconds before cached device data is reloaded
+# Device access cache (permissions of account for each of its devices)
+DEVICE_ACCESS_CACHE_SIZE = 10000  # max number of cached accounts
+DEVICE_ACCESS_CACHE_TTL = 60  # seconds before access is reloaded
+
+# Authenticated accounts cache (account and role data used by every request)
+ACCOUNT_CACHE_SIZE = 10000  # max number of cached accounts
+ACCOUNT_CACHE_TTL = 60  # seconds before cached account is reloaded
+
+# JSONQL plans cache (compiled queries of repeated requests)
+JSONQL_PLAN_CACHE_SIZE = 1000  # max number of cached plans
+JSONQL_PLAN_CACHE_TTL = 3600  # seconds before cached plan is rebuilt
+# JSONQL results cache, invalidated when new recordings arrive
+JSONQL_RESULT_CACHE_SIZE = 1000  # max number of cached results
+JSONQL_RESULT_CACHE_TTL = 60  # seconds before cached result is rerun
+JSONQL_MAX_BATCH_DEVICES = 100  # max number of devices in batch query
+JSONQL_MAX_FILLED_BUCKETS = 10000  # max buckets in gap filled result
+
+# Redis (used by Celery and shared caches)
+REDIS_URL = os.environ['REDIS_URL']
+
+# Shared model cache (in-process tier in front of Redis)
+MODEL_CACHE_SIZE = 10000  # max number of entries kept in process
+MODEL_CACHE_LOCAL_TTL = 30  # seconds before entry kept in process expires
+MODEL_CACHE_TTL = 300  # seconds before entry kept in Redis expires
 
 # Celery config
 CELERY_BROKER_URL = os.environ['REDIS_URL']
 CELERY_RESULT_BACKEND = os.environ['REDIS_URL']
+CELERYBEAT_SCHEDULE = {
+    'manage-recording-partitions': {
+        'task': 'app.devices.tasks.manage_recording_partitions',
+        'schedule': datetime.timedelta(hours=12)
+    }
+}
 
 # Mailer config
 MAIL_SERVER = 'smtp.googlemail.com'
@@ -11,5 +11,59 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-c', '--consumers', dest='consumers', type=int,
+                help='Number of consumer processes')
+@manager.option('-a', '--async', dest='asynchronous', action='store_true',
+                help='Run asyncio consumers')
+def ingest(consumers=None, asynchronous=False):
+    """Runs MQTT recording ingestion consumers"""
+    from app.mqtt.ingestion import run_consumers
+    run_consumers(app, consumers or app.config['MQTT_INGESTION_CONSUMERS'],
+                  asynchronous)
+
+
+@manager.option('-d', '--device', dest='device_id', type=int, default=1,
+                help='Device id used in sample queries')
+def check_recording_plans(device_id=1):
+    """Fails if recording queries would use sequential scans"""
+    import sys
+    from app.devices.query_plans import check_recording_plans
+    failures = check_recording_plans(device_id)
+    for name, tables in failures.items():
+        print(name + ' uses sequential scan of ' + ', '.join(tables))
+    if failures:
+        sys.exit(1)
+    print('All recording queries use indexes')
+
+
+@manager.option('-a', '--account', dest='account_id', type=int, default=1,
+                help='Account whose lists are requested')
+@manager.option('-d', '--device', dest='device_id', type=int, default=1,
+                help='Device whose recordings are listed')
+@manager.option('-b', '--dashboard', dest='dashboard_id', type=int,
+                default=1, help='Dashboard whose widgets are listed')
+@manager.option('-r', '--rows', dest='rows', type=int, default=5,
+                help='Number of rows on larger compared page')
+@manager.option('-s', '--single-account', dest='single_account_id',
+                type=int, help='Account with exactly one dashboard')
+def check_query_counts(account_id=1, device_id=1, dashboard_id=1, rows=5,
+                       single_account_id=None):
+    """Fails if statement count of list endpoints depends on row count"""
+    import sys
+    from app.api.query_counts import check_query_counts
+    failures, skipped = check_query_counts(account_id, device_id,
+                                           dashboard_id, rows,
+                                           single_account_id)
+    for name in skipped:
+        print(name + ' has no data with 1 and ' + str(rows) +
+              ' rows, not checked')
+    for name, (single_count, many_count) in failures.items():
+        print('%s issues %d SQL statements for 1 row and %d for %d rows' % (
+            name, single_count, many_count, rows))
+    if failures:
+        sys.exit(1)
+    print('Statement counts of list endpoints do not depend on row count')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,44 @@
+"""Add device_latest_recordings table
+
+Revision ID: 2c6fff8c1599
+Revises: 7483d01c0eaa
+Create Date: 2026-10-18 11:41:52.630418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c6fff8c1599'
+down_revision = '7483d01c0eaa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('device_latest_recordings',
+    sa.Column('device_id', sa.Integer(), nullable=False),
+    sa.Column('record_type', sa.Integer(), nullable=False),
+    sa.Column('recorded_at', sa.DateTime(), nullable=False),
+    sa.Column('received_at', sa.DateTime(), nullable=True),
+    sa.Column('record_value', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('device_id', 'record_type')
+    )
+
+    op.execute("""
+        INSERT INTO device_latest_recordings (device_id, record_type,
+                                              recorded_at, received_at,
+                                              record_value)
+        SELECT DISTINCT ON (device_id, record_type)
+               device_id, record_type, recorded_at, received_at, record_value
+        FROM recordings
+        WHERE device_id IS NOT NULL
+        ORDER BY device_id, record_type, recorded_at DESC
+    """)
+
+
+def downgrade():
+    op.drop_table('device_latest_recordings')
@@ -0,0 +1,49 @@
+"""Add recording_rollups table
+
+Revision ID: 51fad101d33d
+Revises: 2c6fff8c1599
+Create Date: 2026-10-18 12:27:05.914263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '51fad101d33d'
+down_revision = '2c6fff8c1599'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('recording_rollups',
+    sa.Column('device_id', sa.Integer(), nullable=False),
+    sa.Column('record_type', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(), nullable=False),
+    sa.Column('bucket_start', sa.DateTime(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('sum', sa.Float(), nullable=False),
+    sa.Column('min', sa.Float(), nullable=False),
+    sa.Column('max', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('device_id', 'record_type', 'period',
+                            'bucket_start')
+    )
+
+    for period in ['minute', 'hour', 'day']:
+        op.execute("""
+            INSERT INTO recording_rollups (device_id, record_type, period,
+                                           bucket_start, count, sum, min, max)
+            SELECT device_id, record_type, '{0}',
+                   date_trunc('{0}', recorded_at), count(*),
+                   sum(record_value), min(record_value), max(record_value)
+            FROM recordings
+            WHERE device_id IS NOT NULL
+            GROUP BY device_id, record_type, date_trunc('{0}', recorded_at)
+        """.format(period))
+
+
+def downgrade():
+    op.drop_table('recording_rollups')
@@ -0,0 +1,29 @@
+"""Add composite covering index on recordings
+
+Revision ID: 7483d01c0eaa
+Revises: 7d1571e7255a
+Create Date: 2026-10-18 11:03:27.118950
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7483d01c0eaa'
+down_revision = '7d1571e7255a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Created on every partition. record_value is included so that queries
+    # selecting recorded values can be answered by index-only scans
+    op.execute('CREATE INDEX ix_recordings_device_type_recorded_at '
+               'ON recordings (device_id, record_type, recorded_at) '
+               'INCLUDE (record_value)')
+
+
+def downgrade():
+    op.drop_index('ix_recordings_device_type_recorded_at',
+                  table_name='recordings')
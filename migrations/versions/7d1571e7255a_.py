@@ -0,0 +1,120 @@
+"""Partition recordings by recorded_at
+
+Revision ID: 7d1571e7255a
+Revises: 9f71f5a68c53
+Create Date: 2026-10-18 10:12:41.502113
+
+"""
+import datetime
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d1571e7255a'
+down_revision = '9f71f5a68c53'
+branch_labels = None
+depends_on = None
+
+# Number of future monthly partitions created up front, the rest is created
+# by manage_recording_partitions task
+PRECREATED_MONTHS = 3
+
+
+def add_months(date, months):
+    month_index = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_horizon_months():
+    # Months older than retention would be expired right away, and without
+    # retention a single outlier must not create partitions for every month
+    # since then
+    return (current_app.config.get('RECORDING_RETENTION_MONTHS') or
+            current_app.config.get('RECORDING_PARTITION_HORIZON_MONTHS', 24))
+
+
+def upgrade():
+    op.drop_index('ix_recordings_recorded_at', table_name='recordings')
+    op.drop_index('ix_recordings_received_at', table_name='recordings')
+    op.rename_table('recordings', 'recordings_unpartitioned')
+    op.execute('ALTER TABLE recordings_unpartitioned '
+               'RENAME CONSTRAINT recordings_pkey '
+               'TO recordings_unpartitioned_pkey')
+
+    op.execute("""
+        CREATE TABLE recordings (
+            id integer NOT NULL DEFAULT nextval('recordings_id_seq'),
+            recorded_at timestamp without time zone NOT NULL,
+            received_at timestamp without time zone,
+            device_id integer REFERENCES devices (id),
+            record_type integer NOT NULL,
+            record_value double precision NOT NULL,
+            raw_record json,
+            CONSTRAINT recordings_pkey PRIMARY KEY (id, recorded_at)
+        ) PARTITION BY RANGE (recorded_at)
+    """)
+    op.execute('ALTER SEQUENCE recordings_id_seq OWNED BY recordings.id')
+    op.execute('CREATE TABLE recordings_default '
+               'PARTITION OF recordings DEFAULT')
+
+    conn = op.get_bind()
+    first_recorded_at = conn.execute(
+            'SELECT min(recorded_at) FROM recordings_unpartitioned').scalar()
+    current_month = datetime.datetime.utcnow().replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0)
+    horizon = add_months(current_month, -get_horizon_months())
+    month = max(add_months(first_recorded_at or current_month, 0), horizon)
+    last_month = add_months(current_month, PRECREATED_MONTHS)
+    while month <= last_month:
+        op.execute(
+            "CREATE TABLE recordings_p%04d_%02d PARTITION OF recordings "
+            "FOR VALUES FROM ('%s') TO ('%s')" % (
+                month.year, month.month,
+                month.isoformat(), add_months(month, 1).isoformat()))
+        month = add_months(month, 1)
+
+    op.execute("""
+        INSERT INTO recordings (id, recorded_at, received_at, device_id,
+                                record_type, record_value, raw_record)
+        SELECT id, coalesce(recorded_at, received_at, now()), received_at,
+               device_id, record_type, record_value, raw_record
+        FROM recordings_unpartitioned
+    """)
+    op.drop_table('recordings_unpartitioned')
+
+    op.create_index('ix_recordings_recorded_at', 'recordings',
+                    ['recorded_at'], unique=False)
+    op.create_index('ix_recordings_received_at', 'recordings',
+                    ['received_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_recordings_recorded_at', table_name='recordings')
+    op.drop_index('ix_recordings_received_at', table_name='recordings')
+    op.rename_table('recordings', 'recordings_partitioned')
+    op.execute('ALTER TABLE recordings_partitioned '
+               'RENAME CONSTRAINT recordings_pkey '
+               'TO recordings_partitioned_pkey')
+
+    op.create_table('recordings',
+    sa.Column('id', sa.Integer(), nullable=False,
+              server_default=sa.text("nextval('recordings_id_seq')")),
+    sa.Column('recorded_at', sa.DateTime(), nullable=True),
+    sa.Column('received_at', sa.DateTime(), nullable=True),
+    sa.Column('device_id', sa.Integer(), nullable=True),
+    sa.Column('record_type', sa.Integer(), nullable=False),
+    sa.Column('record_value', sa.Float(), nullable=False),
+    sa.Column('raw_record', sa.JSON(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('INSERT INTO recordings SELECT * FROM recordings_partitioned')
+    op.execute('ALTER SEQUENCE recordings_id_seq OWNED BY recordings.id')
+    op.drop_table('recordings_partitioned')
+
+    op.create_index('ix_recordings_received_at', 'recordings',
+                    ['received_at'], unique=False)
+    op.create_index('ix_recordings_recorded_at', 'recordings',
+                    ['recorded_at'], unique=False)
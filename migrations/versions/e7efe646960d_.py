@@ -0,0 +1,39 @@
+"""Add recording indexes for keyset pagination
+
+Revision ID: e7efe646960d
+Revises: 51fad101d33d
+Create Date: 2026-10-18 13:20:48.337561
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7efe646960d'
+down_revision = '51fad101d33d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Pages are ordered by (recorded_at, id), so id has to be available in
+    # index as well
+    op.drop_index('ix_recordings_device_type_recorded_at',
+                  table_name='recordings')
+    op.execute('CREATE INDEX ix_recordings_device_type_recorded_at '
+               'ON recordings (device_id, record_type, recorded_at) '
+               'INCLUDE (record_value, id)')
+    op.execute('CREATE INDEX ix_recordings_device_recorded_at '
+               'ON recordings (device_id, recorded_at, id) '
+               'INCLUDE (record_type, record_value)')
+
+
+def downgrade():
+    op.drop_index('ix_recordings_device_recorded_at',
+                  table_name='recordings')
+    op.drop_index('ix_recordings_device_type_recorded_at',
+                  table_name='recordings')
+    op.execute('CREATE INDEX ix_recordings_device_type_recorded_at '
+               'ON recordings (device_id, record_type, recorded_at) '
+               'INCLUDE (record_value)')